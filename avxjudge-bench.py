@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+avxjudge-bench.py measures how fast avxjudge.py judges files.
+
+It generates reproducible synthetic objdump -d listings with a chosen mix of
+SSE, AVX2 and AVX-512 instructions and feeds them to process_objdump_line,
+and builds small shared objects with the same mixes to time whole
+avxjudge.py runs.  Results can be saved as a baseline and later runs
+compared against it:
+
+    ./avxjudge-bench.py --save baseline.json
+    ./avxjudge-bench.py --compare baseline.json
+
+or, as make bench does, with --baseline FILE to compare against FILE if it
+exists and create it otherwise.
+"""
+
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# (mnemonic, operands as objdump prints them, operands as written for the
+# assembler, instruction bytes); DISP and DB are a random displacement below
+# 0x80 in hex and as an instruction byte
+PLAIN_INSTRUCTIONS = [
+    ("mov", "%rsp,%rbp", "%rsp,%rbp", "48 89 e5"),
+    ("add", "$0xDISP,%rax", "$0xDISP,%rax", "48 83 c0 DB"),
+    ("mov", "0xDISP(%rsp),%rdx", "0xDISP(%rsp),%rdx", "48 8b 54 24 DB"),
+    ("lea", "0xDISP(%rip),%rdi        # DISP <table>", "0xDISP(%rip),%rdi", "48 8d 3d DB 00 00 00"),
+    ("test", "%eax,%eax", "%eax,%eax", "85 c0"),
+    ("push", "%rbx", "%rbx", "53"),
+    ("pop", "%rbx", "%rbx", "5b"),
+]
+SSE_INSTRUCTIONS = [
+    ("addpd", "%xmm1,%xmm0", "%xmm1,%xmm0", "66 0f 58 c1"),
+    ("movaps", "%xmm0,0xDISP(%rsp)", "%xmm0,0xDISP(%rsp)", "0f 29 44 24 DB"),
+    ("pxor", "%xmm1,%xmm1", "%xmm1,%xmm1", "66 0f ef c9"),
+    ("cvtsi2sd", "%eax,%xmm0", "%eax,%xmm0", "f2 0f 2a c0"),
+    ("paddd", "%xmm2,%xmm3", "%xmm2,%xmm3", "66 0f fe da"),
+]
+AVX2_INSTRUCTIONS = [
+    ("vfmadd231pd", "%ymm2,%ymm1,%ymm0", "%ymm2,%ymm1,%ymm0", "c4 e2 f5 b8 c2"),
+    ("vpaddd", "%ymm1,%ymm2,%ymm3", "%ymm1,%ymm2,%ymm3", "c5 ed fe d9"),
+    ("vmovdqu", "0xDISP(%rdi),%ymm0", "0xDISP(%rdi),%ymm0", "c5 fe 6f 47 DB"),
+    ("shlx", "%rax,%rbx,%rcx", "%rax,%rbx,%rcx", "c4 e2 f9 f7 cb"),
+    ("vxorps", "%ymm0,%ymm0,%ymm0", "%ymm0,%ymm0,%ymm0", "c5 fc 57 c0"),
+]
+AVX512_INSTRUCTIONS = [
+    ("vaddpd", "%zmm1,%zmm2,%zmm3", "%zmm1,%zmm2,%zmm3", "62 f1 ed 48 58 d9"),
+    ("vmovdqu64", "(%rdi),%zmm16", "(%rdi),%zmm16", "62 e1 fe 48 6f 07"),
+    ("kmovw", "%k1,%eax", "%k1,%eax", "c5 f8 93 c1"),
+    ("vpaddd", "%zmm1,%zmm2,%zmm3{%k1}", "%zmm1,%zmm2,%zmm3{%k1}", "62 f1 6d 49 fe d9"),
+    ("vaddps", "(%rax){1to16},%zmm1,%zmm2", "(%rax){1to16},%zmm1,%zmm2", "62 f1 74 58 58 10"),
+]
+
+# name -> fraction of SSE, AVX2 and AVX-512 instructions
+DEFAULT_MIXES = {
+    "integer": (0.0, 0.0, 0.0),
+    "sse": (0.3, 0.0, 0.0),
+    "avx2": (0.1, 0.3, 0.0),
+    "avx512": (0.1, 0.1, 0.3),
+}
+
+# metric -> whether a larger value is better
+METRICS = {
+    "lines_per_s": True,
+    "functions_per_s": True,
+    "latency_s": False,
+    "objdump_latency_s": False,
+    "peak_rss_kib": False,
+}
+
+
+def setup_parser():
+    """Create commandline argument parser."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--avxjudge", help="avxjudge.py to measure (default: the one next to this script)",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "avxjudge.py"))
+    parser.add_argument("--mix", action="append", default=[], metavar="NAME=SSE,AVX2,AVX512",
+                        help="instruction mix to measure, as fractions of all instructions "
+                        "(default: %s)" % ", ".join(DEFAULT_MIXES))
+    parser.add_argument("--functions", type=int, default=4000,
+                        help="functions in each synthetic listing (default: 4000)")
+    parser.add_argument("--instructions", type=int, default=60,
+                        help="average instructions per function (default: 60)")
+    parser.add_argument("--elf-functions", type=int, default=400,
+                        help="functions in each shared object built (default: 400)")
+    parser.add_argument("--no-elf", action="store_true", help="do not build and judge shared objects")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated corpora (default: 1)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case, the best is kept (default: 3)")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with FILE if it exists, otherwise save the results to it")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="percentage a metric may get worse before it counts as a regression (default: 10)")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    return parser
+
+
+def parse_mix(text):
+    """NAME=SSE,AVX2,AVX512 into (name, fractions)."""
+    name, _, fractions = text.partition("=")
+    mix = tuple(float(f) for f in fractions.split(","))
+    if not name or len(mix) != 3 or sum(mix) > 1.0 or min(mix) < 0.0:
+        raise argparse.ArgumentTypeError("bad instruction mix: %s" % text)
+    return name, mix
+
+
+def generate_functions(mix, functions, instructions, seed):
+    """Functions as lists of (mnemonic, listing operands, asm operands, bytes)."""
+    rng = random.Random(seed)
+    sse, avx2, avx512 = mix
+    result = []
+    for _ in range(functions):
+        body = []
+        for _ in range(rng.randint(max(instructions // 2, 1), instructions + instructions // 2)):
+            pick = rng.random()
+            if pick < sse:
+                table = SSE_INSTRUCTIONS
+            elif pick < sse + avx2:
+                table = AVX2_INSTRUCTIONS
+            elif pick < sse + avx2 + avx512:
+                table = AVX512_INSTRUCTIONS
+            else:
+                table = PLAIN_INSTRUCTIONS
+            mnemonic, listed, written, code = rng.choice(table)
+            d = rng.randrange(8, 0x80, 8)
+            disp, byte = "%x" % d, "%02x" % d
+            body.append((mnemonic, listed.replace("DISP", disp), written.replace("DISP", disp),
+                         code.replace("DB", byte)))
+        body.append(("ret", "", "", "c3"))
+        result.append(body)
+    return result
+
+
+def generate_listing(functions):
+    """The objdump -d listing of functions, as the lines objdump prints."""
+    lines = [b"\n", b"synthetic.so:     file format elf64-x86-64\n", b"\n", b"\n",
+             b"Disassembly of section .text:\n", b"\n"]
+    address = 0x1000
+    for number, body in enumerate(functions):
+        if number:
+            lines.append(b"\n")
+        lines.append(b"%016x <f_%d>:\n" % (address, number))
+        for mnemonic, listed, written, code in body:
+            text = "%-6s %s" % (mnemonic, listed)
+            lines.append(("%8x:\t%-21s\t%s\n" % (address, code + " ", text)).encode())
+            address += len(code.split())
+    return lines
+
+
+def generate_source(functions):
+    """C source of a shared object holding functions as inline assembly."""
+    source = []
+    for number, body in enumerate(functions):
+        statements = "\\n\\t".join(("%s %s" % (mnemonic, written)).strip()
+                                   for mnemonic, listed, written, code in body[:-1])
+        source.append('void f_%d(void)\n{\n\tasm volatile("%s");\n}\n' % (number, statements))
+    return "\n".join(source)
+
+
+def load_avxjudge(path):
+    spec = importlib.util.spec_from_file_location("avxjudge_bench_target", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss_kib(who):
+    return resource.getrusage(who).ru_maxrss
+
+
+def run_measured(command):
+    """Run command, returning its peak RSS in KiB and none of other children's."""
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return usage.ru_maxrss
+
+
+def run_listing_case(case):
+    """Time process_objdump_line over a synthetic listing."""
+    avxjudge = load_avxjudge(case["avxjudge"])
+    functions = generate_functions(case["mix"], case["functions"], case["instructions"], case["seed"])
+    lines = generate_listing(functions)
+    del functions
+
+    # older versions take the line as text and a quiet flag
+    parameters = inspect.signature(avxjudge.process_objdump_line).parameters
+    if parameters["line"].annotation is not bytes:
+        lines = [line.decode("latin-1") for line in lines]
+    extra = (0,) * (len(parameters) - 3)
+
+    best = None
+    for _ in range(case["repeat"]):
+        records = avxjudge.RecordKeeper("")
+        process = avxjudge.process_objdump_line
+        start = time.perf_counter()
+        for line in lines:
+            process(records, line, 0, *extra)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "lines_per_s": len(lines) / best,
+        "functions_per_s": case["functions"] / best,
+        "peak_rss_kib": peak_rss_kib(resource.RUSAGE_SELF),
+    }
+
+
+def run_elf_case(case):
+    """Time whole avxjudge.py runs over a freshly built shared object."""
+    functions = generate_functions(case["mix"], case["functions"], case["instructions"], case["seed"])
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "bench.c")
+        library = os.path.join(workdir, "libbench.so")
+        with open(source, "w") as f:
+            f.write(generate_source(functions))
+        subprocess.run(["cc", "-shared", "-fPIC", "-O1", "-nostdlib", "-o", library, source], check=True)
+
+        command = [sys.executable, case["avxjudge"]]
+        usage = subprocess.run(command + ["--help"], stdout=subprocess.PIPE, check=True).stdout
+        runs = {"latency_s": []}
+        if b"--objdump" in usage:
+            runs["objdump_latency_s"] = ["--objdump"]
+        # the peak of the avxjudge runs alone, not of cc building the
+        # library or of the --help probe
+        result = {}
+        peak = 0
+        for metric, options in runs.items():
+            best = None
+            for _ in range(case["repeat"]):
+                start = time.perf_counter()
+                peak = max(peak, run_measured(command + options + [library]))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            result[metric] = best
+    result["peak_rss_kib"] = peak
+    return result
+
+
+def run_case(case):
+    """Run one case in a fresh interpreter, so its peak RSS is its own."""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+                            stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output)
+
+
+def compare(results, baseline, tolerance):
+    """Print results against baseline; returns whether anything regressed."""
+    regressed = False
+    print("%-16s %-18s %14s %14s %9s" % ("case", "metric", "baseline", "current", "change"))
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not before:
+                print("%-16s %-18s %14s %14.6g %9s" % (name, metric, "-", value, "new"))
+                continue
+            change = 100.0 * (value - before) / before
+            worse = -change if METRICS[metric] else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSED"
+                regressed = True
+            print("%-16s %-18s %14.6g %14.6g %+8.1f%%%s" % (name, metric, before, value, change, flag))
+    return regressed
+
+
+def report(results):
+    print("%-16s %-18s %14s" % ("case", "metric", "value"))
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            print("%-16s %-18s %14.6g" % (name, metric, value))
+
+
+def main():
+    args = setup_parser().parse_args()
+
+    if args.run_case:
+        case = json.loads(args.run_case)
+        result = run_elf_case(case) if case["kind"] == "elf" else run_listing_case(case)
+        json.dump(result, sys.stdout)
+        return
+
+    mixes = dict(parse_mix(mix) for mix in args.mix) if args.mix else DEFAULT_MIXES
+    build = not args.no_elf and shutil.which("cc") is not None
+    if not args.no_elf and not build:
+        print("avxjudge-bench: no cc found, not building shared objects", file=sys.stderr)
+
+    results = {}
+    for name, mix in mixes.items():
+        case = {"avxjudge": os.path.abspath(args.avxjudge), "mix": mix, "seed": args.seed,
+                "repeat": args.repeat, "instructions": args.instructions}
+        results[name] = run_case(dict(case, kind="listing", functions=args.functions))
+        if build:
+            results[name + "-elf"] = run_case(dict(case, kind="elf", functions=args.elf_functions))
+
+    compare_with = args.compare
+    save_to = args.save
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            compare_with = compare_with or args.baseline
+        else:
+            save_to = save_to or args.baseline
+
+    regressed = False
+    if compare_with:
+        with open(compare_with) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+    else:
+        report(results)
+    if save_to:
+        with open(save_to, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
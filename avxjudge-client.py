@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+avxjudge-client.py hands its files to a running avxjudge.py --serve.
+
+It takes the same arguments as avxjudge.py, prints what avxjudge.py would
+and exits with its status, but the server listening on $AVXJUDGE_SOCKET
+does the judging, so a build that judges many files only pays for
+starting avxjudge.py and building its tables once:
+
+    avxjudge.py --serve /tmp/avxjudge.sock &
+    AVXJUDGE_SOCKET=/tmp/avxjudge.sock avxjudge-client.py -q -2 libfoo.so
+
+Without $AVXJUDGE_SOCKET, or with no server listening on it, it runs
+avxjudge.py from its own directory instead.
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+def main():
+    path = os.environ.get("AVXJUDGE_SOCKET")
+    connection = None
+    if path:
+        connection = socket.socket(socket.AF_UNIX)
+        try:
+            connection.connect(path)
+        except OSError:
+            connection.close()
+            connection = None
+    if connection is None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "avxjudge.py")
+        os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
+
+    request = {"cwd": os.getcwd(), "argv": sys.argv[1:], "cache": os.environ.get("AVXJUDGE_CACHE")}
+    with connection, connection.makefile("rwb") as stream:
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            reply = json.loads(line)
+            if "status" in reply:
+                sys.exit(reply["status"])
+            if "stdout" in reply:
+                sys.stdout.write(reply["stdout"])
+                sys.stdout.flush()
+            else:
+                sys.stderr.write(reply["stderr"])
+                sys.stderr.flush()
+    sys.exit("avxjudge-client: %s: the server closed the connection" % path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/bin/bash
+
+set -eEu -o pipefail
+
+TESTDIR=$(mktemp -d)
+
+function cleanup() {
+    rm -fr "${TESTDIR}"
+}
+trap 'cleanup' EXIT
+
+# A library without AVX2 and with too few SSE instructions to keep, whose
+# -q verdict is certain before the whole file is read
+cat > "${TESTDIR}/t.c" <<EOF
+double scale(double *a, int n) { double s = 0; for (int i = 0; i < n; i++) s += a[i] * 1.5; return s; }
+int add(int a, int b) { return a + b; }
+int mul(int a, int b) { return a * b; }
+EOF
+gcc -O2 -shared -fPIC -o "${TESTDIR}/t.so" "${TESTDIR}/t.c"
+
+# The native scan knows which instructions score, so it stops before
+# reading the code; the objdump listing can only skip the last block,
+# which is never scored, and does not report stopping early for that
+function test_early_stop() {
+    local unlink=$1
+    local early=$2
+    shift 2
+    local out
+
+    cp "${TESTDIR}/t.so" "${TESTDIR}/q.so"
+    out=$(python3 avxjudge.py "$@" -q "${unlink}" "${TESTDIR}/q.so")
+    [ ! -f "${TESTDIR}/q.so" ]
+    if [ "${early}" = 1 ]; then
+        [[ "${out}" == *"stopped early"* ]]
+    else
+        [[ "${out}" != *"stopped early"* ]]
+    fi
+
+    cp "${TESTDIR}/t.so" "${TESTDIR}/f.so"
+    out=$(python3 avxjudge.py "$@" "${unlink}" "${TESTDIR}/f.so")
+    [ ! -f "${TESTDIR}/f.so" ]
+    [[ "${out}" != *"stopped early"* ]]
+}
+
+test_early_stop -1 1
+test_early_stop -2 1
+test_early_stop -1 0 --objdump
+test_early_stop -2 0 --objdump
+
+# A file a hotness profile has no samples for is judged by its unweighted
+# totals, so one that is kept without the profile is kept with it
+function test_unprofiled() {
+    cat > "${TESTDIR}/v.c" <<EOF2
+void add(float *a, float *b, int n) { for (int i = 0; i < n; i++) a[i] += b[i] * 2.0f; }
+EOF2
+    gcc -O3 -mavx2 -mfma -shared -fPIC -o "${TESTDIR}/v.so" "${TESTDIR}/v.c"
+    printf "libother.so\thot_function\t100\n" > "${TESTDIR}/other.perf"
+
+    python3 avxjudge.py -q -2 "${TESTDIR}/v.so" > /dev/null
+    [ -f "${TESTDIR}/v.so" ]
+    out=$(python3 avxjudge.py --hotness "${TESTDIR}/other.perf" -q -2 "${TESTDIR}/v.so")
+    [ -f "${TESTDIR}/v.so" ]
+    [[ "${out}" != *"weighted"* ]]
+    out=$(python3 avxjudge.py --hotness "${TESTDIR}/other.perf" "${TESTDIR}/v.so")
+    [[ "${out}" != *"Weighted total"* ]]
+
+    # a profile of the file itself still weighs it
+    printf "v.so\tadd\t100\n" > "${TESTDIR}/v.perf"
+    out=$(python3 avxjudge.py --hotness "${TESTDIR}/v.perf" "${TESTDIR}/v.so")
+    [[ "${out}" == *"Weighted total (AVX2)"* ]]
+}
+
+test_unprofiled
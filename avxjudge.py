@@ -8,7 +8,22 @@ import subprocess
 import sys
 import re
 import argparse
+import heapq
 import os
+import struct
+import tempfile
+import io
+import contextlib
+import copy
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import resource
+import signal
+import socket
+import socketserver
+import time
 
 # MMX and SSE2 instructions
 sse_instructions_xmm = set([
@@ -53,41 +68,377 @@ avx2_instructions_hv = set([
 ])
 avx512_instructions_hv = set()
 
+# APX: legacy integer instructions that take a new data destination (NDD)
+# operand, and how many operands they have without one
+apx_instructions_ndd = {
+    "add": 2, "sub": 2, "and": 2, "or": 2, "xor": 2, "adc": 2, "sbb": 2,
+    "adcx": 2, "adox": 2, "inc": 1, "dec": 1, "neg": 1, "not": 1,
+    "shl": 2, "sal": 2, "shr": 2, "sar": 2, "rol": 2, "ror": 2, "rcl": 2, "rcr": 2,
+    "imul": 2, "shld": 3, "shrd": 3,
+}
+# APX instructions without a legacy form; the conditional ones by the
+# family their condition codes are appended to
+apx_instructions_lv = set(["pushp", "popp", "setzu"])
+apx_instructions = set(["ccmp", "ctest", "cfcmov"])
+apx_instructions_hv = set(["push2", "pop2", "push2p", "pop2p"])
+
+# x86-64 microarchitecture levels, and apx for what the apx build type
+# (VA) adds on top of v4
+levels = ("v1", "v2", "v3", "v4", "apx")
+
+# x86-64-v2: SSE3, SSSE3, SSE4.1, SSE4.2, POPCNT, CMPXCHG16B and LAHF/SAHF;
+# SSE4.1 sign and zero extensions by their prefix
+v2_instructions = set([
+    "addsubpd", "addsubps", "haddpd", "haddps", "hsubpd", "hsubps", "lddqu", "movddup",
+    "movshdup", "movsldup", "fisttp", "fisttps", "fisttpl", "fisttpll",
+    "pabsb", "pabsw", "pabsd", "palignr", "phaddw", "phaddd", "phaddsw", "phsubw", "phsubd",
+    "phsubsw", "pmaddubsw", "pmulhrsw", "pshufb", "psignb", "psignw", "psignd",
+    "blendpd", "blendps", "blendvpd", "blendvps", "dppd", "dpps", "extractps", "insertps",
+    "movntdqa", "mpsadbw", "packusdw", "pblendvb", "pblendw", "pcmpeqq", "pextrb", "pextrd",
+    "pextrq", "phminposuw", "pinsrb", "pinsrd", "pinsrq", "pmaxsb", "pmaxsd", "pmaxud", "pmaxuw",
+    "pminsb", "pminsd", "pminud", "pminuw", "pmuldq", "pmulld", "ptest", "roundpd", "roundps",
+    "roundsd", "roundss",
+    "crc32b", "crc32w", "crc32l", "crc32q", "pcmpestri", "pcmpestrm", "pcmpistri", "pcmpistrm",
+    "pcmpgtq", "popcnt", "cmpxchg16b", "lahf", "sahf",
+])
+v2_prefixes = ("pmovsx", "pmovzx")
+# x86-64-v3 besides anything VEX encoded: BMI1, BMI2, LZCNT and MOVBE
+v3_instructions = set([
+    "andn", "bextr", "blsi", "blsmsk", "blsr", "bzhi", "mulx", "pdep", "pext", "rorx", "sarx",
+    "shlx", "shrx", "lzcnt", "tzcnt", "movbe",
+])
+# Mnemonics starting with v that are not VEX encoded
+v_non_vex_instructions = set([
+    "verr", "verw", "vmcall", "vmclear", "vmfunc", "vmlaunch", "vmload", "vmmcall", "vmptrld",
+    "vmptrst", "vmread", "vmresume", "vmrun", "vmsave", "vmwrite", "vmxoff", "vmxon",
+])
+# x86-64-v4: AVX-512 instructions that also exist for xmm and ymm registers
+# without a mask, which the operands alone do not give away
+_V4_MNEMONIC = re.compile(
+    r"k(and|andn|or|xor|xnor|not|mov|shift|test|ortest|unpck|add)|vpternlog|vperm[it]2|vperm[bw]$|vpro[lr]"
+    r"|valign[dq]|vp?compress|vp?expand|vrndscale|vrange|vreduce|vgetexp|vgetmant|vscalef|vfixupimm"
+    r"|vrcp14|vrsqrt14|vpmov(s|us)?[qdw][bwd]$|vpmov[bwdq]2m|vpmovm2|vcvtu|vcvt\w*(u[dq]q|qq|2usi)"
+    r"|vpabsq|vp(max|min)[su]q|vpsraq|vpmullq|vpbroadcastm|vpconflict|vplzcnt|vdbpsadbw"
+    r"|vpmultishiftqb|vpsh[lr]dv?[wdq]|v\w+[36][24]x[248]$|vmovdq[au](8|16|32|64)$")
+
 # Minimum thresholds for keeping libraries
 min_count = 10
 min_score = 1.0
 
+# The most a single instruction adds to each score, and the fewest bytes it
+# can take: an xmm operand needs at least 0f, the opcode and a ModRM byte,
+# ymm, mask and high registers need a VEX or EVEX prefix, and APX a REX2
+# or EVEX prefix
+max_instruction_score = {"sse": 1.0, "avx2": 2.0, "avx512": 2.0, "apx": 2.0}
+min_instruction_bytes = {"sse": 3, "avx2": 4, "avx512": 4, "apx": 3}
+
+# Listings of less code than this are not split into address ranges: the
+# worker startup costs more than the parallel parsing saves (libz, 100 KiB
+# of code, lists in 0.2s)
+range_min_bytes = 1 << 20
+
 debug = 0
+# FileStats of the file being judged with --profile
+stats = None
 
 class FunctionRecord():
+    __slots__ = ("scores", "counts", "instructions", "name", "level")
+
     def __init__(self):
-        self.scores = {"sse": 0.0, "avx2": 0.0, "avx512": 0.0}
-        self.counts = {"sse": 0, "avx2": 0, "avx512": 0}
+        self.scores = {"sse": 0.0, "avx2": 0.0, "avx512": 0.0, "apx": 0.0}
+        self.counts = {"sse": 0, "avx2": 0, "avx512": 0, "apx": 0}
         self.instructions = 0
         self.name = ""
+        # index into levels of the highest level an instruction needs
+        self.level = 0
+
+
+# Functions shown in each top list
+top_function_count = 5
+
+
+class TopFunctions():
+    """The top_function_count best functions of one table, kept while scanning.
+
+    Only the top itself is stored, as a min-heap of (value, -order, name),
+    so memory does not grow with the number of functions.  order is the
+    number of the function when its name entered the top, and equal values
+    rank in that order, as they did in a dict keyed by name.  A name seen
+    again while in the top takes its new value in place.  Names that left
+    the top are forgotten, so one seen again is ranked as a new function;
+    this only matters for local functions of one name in several objects.
+    """
+    __slots__ = ("heap",)
+
+    def __init__(self):
+        self.heap = []
+
+    def set(self, name: str, value: float, order: int) -> None:
+        heap = self.heap
+        for position, (top_value, top_order, top_name) in enumerate(heap):
+            if top_name == name:
+                heap[position] = (value, top_order, name)
+                heapq.heapify(heap)
+                return
+        entry = (value, -order, name)
+        if len(heap) < top_function_count:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def top(self) -> list:
+        """(name, value) pairs, best first."""
+        return [(name, value) for value, order, name in sorted(self.heap, reverse=True)]
 
 
 class RecordKeeper():
-    def __init__(self, delete_type):
-        self.total_counts = {"sse": 0, "avx2": 0, "avx512": 0}
-        self.total_scores = {"sse": 0.0, "avx2": 0.0, "avx512": 0.0}
-        self.functions = {"sse": dict(), "avx2": dict(), "avx512": dict()}
-        self.ratios = {"sse": dict(), "avx2": dict(), "avx512": dict()}
+    __slots__ = ("total_counts", "total_scores", "functions", "ratios", "function_record",
+                 "delete_type", "code_bytes", "skipped_bytes", "stopped", "finalized", "instructions", "function_records",
+                 "weights", "max_weight", "weighted_counts", "weighted_scores")
+
+    def __init__(self, delete_type, keep_functions: bool = False, weights: dict = None):
+        self.total_counts = {"sse": 0, "avx2": 0, "avx512": 0, "apx": 0}
+        self.total_scores = {"sse": 0.0, "avx2": 0.0, "avx512": 0.0, "apx": 0.0}
+        # with a hotness profile, each function's counts and scores also
+        # go into the weighted totals times its weight, and those decide
+        self.weights = weights
+        self.max_weight = max(weights.values(), default=0.0) if weights is not None else 1.0
+        self.weighted_counts = {"sse": 0.0, "avx2": 0.0, "avx512": 0.0, "apx": 0.0}
+        self.weighted_scores = {"sse": 0.0, "avx2": 0.0, "avx512": 0.0, "apx": 0.0}
+        self.functions = {i: TopFunctions() for i in ("sse", "avx2", "avx512", "apx")}
+        self.ratios = {i: TopFunctions() for i in ("sse", "avx2", "avx512", "apx")}
         self.function_record = FunctionRecord()
         self.delete_type = delete_type
+        # bytes of executable sections, and how many of them were never
+        # looked at because the verdict was already certain
+        self.code_bytes = 0
+        self.skipped_bytes = 0
+        # whether scoring stopped there, leaving partial totals
+        self.stopped = False
+        # functions finalized and the instructions they held
+        self.finalized = 0
+        self.instructions = 0
+        # every finalized FunctionRecord by name, for comparing builds
+        self.function_records = {} if keep_functions else None
+
+    def decision_totals(self) -> tuple:
+        """(counts, scores) the keep/delete decision goes by."""
+        if self.weights is not None:
+            return self.weighted_counts, self.weighted_scores
+        return self.total_counts, self.total_scores
 
     def should_delete(self) -> bool:
-        if self.delete_type and self.total_counts[self.delete_type] < min_count and self.total_scores[self.delete_type] <= min_score:
+        counts, scores = self.decision_totals()
+        if self.delete_type and counts[self.delete_type] < min_count and scores[self.delete_type] <= min_score:
             return True
         return False
 
+    def verdict_certain(self, remaining: int = None, scoring: int = 0) -> bool:
+        """Whether the rest of the file can no longer change should_delete().
+
+        The totals only grow, so a file that is kept stays kept.  A file
+        that would be deleted stays deleted once the scoring instructions
+        left, the scoring known ones plus as many as the remaining bytes of
+        code of unknown ones can hold, cannot reach the thresholds;
+        remaining None means that is not known.
+        """
+        if not self.should_delete():
+            return True
+        if remaining is None:
+            return False
+        more = (scoring + remaining // min_instruction_bytes[self.delete_type]) * self.max_weight
+        counts, scores = self.decision_totals()
+        return (counts[self.delete_type] + more < min_count and
+                scores[self.delete_type] + more * max_instruction_score[self.delete_type] <= min_score)
+
     def finalize_function_attrs(self):
-        for i in ("sse", "avx2", "avx512"):
+        self.finalized += 1
+        self.instructions += self.function_record.instructions
+        name = self.function_record.name
+        for i in ("sse", "avx2", "avx512", "apx"):
             if self.function_record.counts[i] >= 1:
-                self.functions[i][self.function_record.name] = self.function_record.scores[i]
-                self.ratios[i][self.function_record.name] = 100.0 * self.function_record.counts[i] / self.function_record.instructions
+                self.functions[i].set(name, self.function_record.scores[i], self.finalized)
+                self.ratios[i].set(name, 100.0 * self.function_record.counts[i] / self.function_record.instructions,
+                                   self.finalized)
             self.total_scores[i] += self.function_record.scores[i]
             self.total_counts[i] += self.function_record.counts[i]
+        if self.weights is not None:
+            weight = self.weights.get(profile_symbol(self.function_record.name), 0.0)
+            if weight:
+                for i in ("sse", "avx2", "avx512", "apx"):
+                    self.weighted_scores[i] += weight * self.function_record.scores[i]
+                    self.weighted_counts[i] += weight * self.function_record.counts[i]
+        if self.function_records is not None:
+            self.keep_function(self.function_record)
+
+    def keep_function(self, record: FunctionRecord) -> None:
+        kept = self.function_records.get(record.name)
+        if kept is None:
+            self.function_records[record.name] = record
+            return
+        # local functions of the same name in different objects
+        kept.instructions += record.instructions
+        kept.level = max(kept.level, record.level)
+        for i in kept.counts:
+            kept.counts[i] += record.counts[i]
+            kept.scores[i] += record.scores[i]
+
+
+_SYMBOL_DECORATION = re.compile(r"(?:[+-]0x[0-9a-f]+)?(?:@.*)?$")
+# perf report --stdio: the overhead columns, the sort keys (by default the
+# command and the object) and the symbol after its [.] or [k] marker
+_PERF_REPORT = re.compile(r"^\s*((?:[0-9.]+%\s+)+)(.*?)\[[.kgu]\]\s+(.+?)\s*$")
+# perf script: a frame of a call chain, and the end of a sample line
+# without one, both "address symbol+offset (object)"
+_PERF_FRAME = re.compile(r"^\s+[0-9a-f]+\s+(.+?)(?:\+0x[0-9a-f]+)?\s+\(([^()]*)\)\s*$")
+_PERF_SAMPLE = re.compile(r"\s[0-9a-f]+\s+(\S+?)(?:\+0x[0-9a-f]+)?\s+\(([^()]*)\)\s*$")
+
+
+def profile_symbol(name: str) -> str:
+    """The symbol a profile names for the block objdump labels name."""
+    return _SYMBOL_DECORATION.sub("", name, count=1)
+
+
+class Hotness():
+    """Where a profiled run spent its time, by symbol, for --hotness.
+
+    Reads the output of perf report --stdio, the output of perf script, or
+    plain "symbol weight" lines, optionally with the object file first.
+    Every weight is a percentage of the run: perf report's self overhead
+    as printed, and for perf script samples and plain weights their share
+    of all of them in the file.  Symbols are kept under the basename of the
+    object perf found them in, so a profile of the baseline build applies
+    to its optimized copies in other directories.
+    """
+    def __init__(self, filename: str):
+        # object basename ("" where the profile does not say) -> symbol -> weight
+        self.weights = {}
+        report = {}
+        samples = {}
+        plain = {}
+        leaf = False
+        with open(filename, errors="replace") as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    leaf = False
+                    continue
+                if line.startswith("\t"):
+                    # the innermost frame of a call chain is the hot one
+                    match = leaf and _PERF_FRAME.match(line)
+                    if match:
+                        self._add(samples, match.group(2), match.group(1), 1)
+                    leaf = False
+                    continue
+                match = _PERF_REPORT.match(line)
+                if match:
+                    keys = match.group(2).split()
+                    self._add(report, keys[-1] if keys else "", match.group(3),
+                              float(match.group(1).split()[-1][:-1]))
+                    continue
+                fields = line.split()
+                if len(fields) in (2, 3):
+                    try:
+                        weight = float(fields[-1])
+                    except ValueError:
+                        pass
+                    else:
+                        self._add(plain, fields[0] if len(fields) == 3 else "", fields[-2], weight)
+                        continue
+                match = _PERF_SAMPLE.search(line)
+                if match:
+                    self._add(samples, match.group(2), match.group(1), 1)
+                leaf = not match
+
+        for table, scale in ((report, 1.0), (samples, None), (plain, None)):
+            if scale is None:
+                total = sum(sum(symbols.values()) for symbols in table.values())
+                scale = 100.0 / total if total else 0.0
+            for dso, symbols in table.items():
+                weights = self.weights.setdefault(dso, {})
+                for symbol, weight in symbols.items():
+                    weights[symbol] = weights.get(symbol, 0.0) + weight * scale
+
+    @staticmethod
+    def _add(table: dict, dso: str, symbol: str, weight: float) -> None:
+        if symbol.startswith("[unknown]"):
+            return
+        symbols = table.setdefault(os.path.basename(dso), {})
+        symbol = profile_symbol(symbol)
+        symbols[symbol] = symbols.get(symbol, 0.0) + weight
+
+    def for_file(self, filename: str) -> dict:
+        """symbol -> weight for the functions of filename.
+
+        None when the profile has no samples that can be in filename, which
+        is then judged by its unweighted totals: a profile of other objects
+        says nothing about it.
+        """
+        weights = dict(self.weights.get("", {}))
+        weights.update(self.weights.get(os.path.basename(filename), {}))
+        if not any(weight > 0 for weight in weights.values()):
+            return None
+        return weights
+
+
+class FileStats():
+    """Where the time judging one file went, for --profile.
+
+    Each phase gets wall time, CPU time of this process and CPU time of the
+    processes reaped meanwhile (objdump, range workers).  A phase running
+    inside another is only counted in the inner one.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.phases = {}
+        self.nested = []
+        self.path = ""
+        self.cache = None
+        self.lines = 0
+        self.start = self.clock()
+
+    @staticmethod
+    def clock() -> tuple:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.perf_counter(), time.process_time(), children.ru_utime + children.ru_stime
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = self.clock()
+        self.nested.append([0.0, 0.0, 0.0])
+        try:
+            yield
+        finally:
+            spent = [now - then for now, then in zip(self.clock(), start)]
+            inner = self.nested.pop()
+            totals = self.phases.setdefault(name, [0.0, 0.0, 0.0])
+            for i in range(3):
+                totals[i] += spent[i] - inner[i]
+                if self.nested:
+                    self.nested[-1][i] += spent[i]
+
+    def record(self, records: RecordKeeper) -> dict:
+        def times(spent: list) -> dict:
+            return {"wall": spent[0], "cpu": spent[1], "child_cpu": spent[2]}
+
+        entry = {"file": self.filename, "path": self.path, "cache": self.cache}
+        entry.update(times([now - then for now, then in zip(self.clock(), self.start)]))
+        entry["phases"] = {name: times(spent) for name, spent in self.phases.items()}
+        entry.update({
+            "lines": self.lines,
+            "instructions": records.instructions + records.function_record.instructions,
+            "functions": records.finalized,
+            "code_bytes": records.code_bytes,
+            "skipped_bytes": records.skipped_bytes,
+            "verdict": None if not records.delete_type else "delete" if records.should_delete() else "keep",
+        })
+        return entry
+
+
+def phase(name: str):
+    """Context timing a phase of judging the current file for --profile."""
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.phase(name)
 
 
 def is_sse(instruction:str, args:str) -> float:
@@ -156,15 +507,82 @@ def is_avx512(instruction:str, args:str) -> float:
     return val
 
 
+_APX_REGISTER = re.compile(r"%r(1[6-9]|2[0-9]|3[01])")
+_OPERAND_PARTS = re.compile(r"\([^)]*\)|\{[^}]*\}")
+
+
+def operands(args: str) -> list:
+    """The operands in args, without the insides of memory operands and {}
+    decorations.
+    """
+    args = _OPERAND_PARTS.sub("", args).strip()
+    return [operand.strip() for operand in args.split(",")] if args else []
+
+
+def is_apx(instruction:str, args:str) -> float:
+    val: float = -1.0
+
+    prefix, _, instruction = instruction.rpartition(" ")
+    base = instruction
+    if base not in apx_instructions_ndd and base[-1:] in ("b", "w", "l", "q") and base[:-1] in apx_instructions_ndd:
+        base = base[:-1]
+
+    if prefix == "{nf}": # leaves the flags alone, so nothing waits on them
+        val = max(val, 0.1)
+    if _APX_REGISTER.search(args): # 16 more registers, fewer spills
+        val = max(val, 1.0)
+
+    ndd = False
+    if base.startswith("cmov"):
+        ndd = len(operands(args)) > 2
+    elif base in apx_instructions_ndd:
+        ops = operands(args)
+        ndd = len(ops) > apx_instructions_ndd[base]
+        if base in ("shl", "sal", "shr", "sar", "rol", "ror", "rcl", "rcr") and len(ops) == 2:
+            # shifting by %cl or an immediate is the legacy form
+            ndd = ops[0] != "%cl" and not ops[0].startswith("$")
+        elif base == "imul" and len(ops) == 3:
+            ndd = not ops[0].startswith("$")
+    if ndd: # a separate destination saves a mov
+        val = max(val, 1.0)
+
+    for family in ("ccmp", "ctest", "cfcmov", "setzu"):
+        if base.startswith(family):
+            base = family
+    if base in apx_instructions_lv:
+        val = max(val, 0.1)
+    if base in apx_instructions:
+        val = max(val, 1.0)
+    if base in apx_instructions_hv:
+        val = max(val, 2.0)
+
+    return val
+
+
+def isa_level(instruction:str, args:str) -> int:
+    """Index into levels of the x86-64 level instruction needs, not
+    counting APX.
+    """
+    mnemonic = instruction.rpartition(" ")[2]
+    if "%zmm" in args or "%k" in args or "{1to" in args or has_high_register(args) or _V4_MNEMONIC.match(mnemonic):
+        return 3
+    if "%ymm" in args or mnemonic in v3_instructions or \
+            mnemonic.startswith("v") and mnemonic not in v_non_vex_instructions:
+        return 2
+    if mnemonic in v2_instructions or mnemonic.startswith(v2_prefixes):
+        return 1
+    return 0
+
+
 def ratio(f: float) -> str:
     f = f * 100
     f = round(f)/100.0
     return str(f)
 
 def print_top_functions(records:RecordKeeper) -> None:
-    def summarize(table: dict, is_pct: bool, max_funcs: int = 5) -> None:
-        for f in sorted(table, key=table.get, reverse=True)[:max_funcs]:
-            f = "    %-30s\t%s" % (f, ratio(table[f]))
+    def summarize(table: TopFunctions, is_pct: bool) -> None:
+        for f, value in table.top():
+            f = "    %-30s\t%s" % (f, ratio(value))
 
             if is_pct:
                 print(f, "%s")
@@ -175,6 +593,7 @@ def print_top_functions(records:RecordKeeper) -> None:
         ("SSE", records.functions["sse"], records.ratios["sse"]),
         ("AVX2", records.functions["avx2"], records.ratios["avx2"]),
         ("AVX512", records.functions["avx512"], records.ratios["avx512"]),
+        ("APX", records.functions["apx"], records.ratios["apx"]),
     )
 
     for set_name, funcs, funcs_ratio in sets:
@@ -194,24 +613,133 @@ def print_function_summary(records):
           "\t", ratio(records.function_record.counts["sse"] / records.function_record.instructions),
           "\t", ratio(records.function_record.counts["avx2"] / records.function_record.instructions),
           "\t", ratio(records.function_record.counts["avx512"] / records.function_record.instructions),
+          "\t", ratio(records.function_record.counts["apx"] / records.function_record.instructions),
           "\t", records.function_record.scores["sse"],
           "\t", records.function_record.scores["avx2"],
-          "\t", records.function_record.scores["avx512"])
+          "\t", records.function_record.scores["avx512"],
+          "\t", records.function_record.scores["apx"])
+
+# objdump -d lines, as bytes: "  addr:\t<hex bytes>\t<mnemonic> <operands>"
+# and "<address> <<name>>:" block headers.  The mnemonic keeps the
+# APX {nf} pseudo prefix objdump prints for instructions that leave the
+# flags alone.  Lines with other pseudo prefixes, such as {evex} and {vex},
+# are still not counted.
+_INSTRUCTION = re.compile(rb".*[0-9a-f]+\:\t[0-9a-f\ ]+\t((?:\{nf\} )?[a-zA-Z0-9]+) (.*)")
+_APX_PREFIX = b"{nf} "
+_HEADER = re.compile(rb"^[0-9a-f]+ <(.+)>:$")
+# the address and bytes of an objdump -D -b binary line
+_LISTED_AT = re.compile(rb" *([0-9a-f]+):\t([0-9a-f ]+)\t")
+_HEX_DIGITS = b"0123456789abcdef"
+_HEX_BYTES = _HEX_DIGITS + b" "
+
+# Operands standing in for the features the is_* functions look at: xmm,
+# ymm and zmm registers, masking, broadcast, and registers 16 to 31 last;
+# and for isa_level, a mask register as an operand of its own
+_OPERAND_STAND_INS = ("%xmm0", "%ymm0", "%zmm0", "{%k1}", "{1to8}", "mm16")
+_MASK_STAND_IN = "%k1"
+_HIGH_REGISTERS = tuple(("mm%d" % n).encode() for n in range(16, 32))
+
+# is_apx looks at APX registers anywhere, and for the instructions that can
+# take a new destination at the number of operands and whether the first is
+# an immediate or %cl; the stand-in for that first operand
+_APX_REGISTER_BYTES = re.compile(rb"%r(1[6-9]|2[0-9]|3[01])")
+_NDD_MNEMONICS = frozenset((name + suffix).encode() for name in apx_instructions_ndd
+                           for suffix in ("", "b", "w", "l", "q"))
+_APX_FIRST_STAND_INS = ("%rax", "$0x1", "%cl")
+
+# (mnemonic, operand signature) -> (sse, avx2, avx512, apx) scores and level
+_classified = {}
+# Instruction text of a line (mnemonic and operands) -> parse_instruction()
+# result; most of a listing repeats a few hundred thousand of them
+_parsed = {}
+_PARSED_LIMIT = 1 << 18
+
+
+def parse_instruction(line: bytes) -> tuple:
+    """(mnemonic, operands, classify() result) of an objdump instruction
+    line, () for any other line.
+    """
+    fields = line.split(b"\t")
+    if len(fields) != 3:
+        match = len(fields) > 3 and _INSTRUCTION.search(line)
+        return match.groups() + (classify(*match.groups()),) if match else ()
+    address, code, text = fields
+    if len(address) < 2 or address[-1] != 0x3a or address[-2] not in _HEX_DIGITS \
+            or not code or code.translate(None, _HEX_BYTES):
+        return ()
+    parsed = _parsed.get(text)
+    if parsed is None:
+        if len(_parsed) >= _PARSED_LIMIT:
+            _parsed.clear()
+        parsed = _parsed[text] = _parse_text(text)
+    return parsed
+
+
+def _parse_text(text: bytes) -> tuple:
+    start = len(_APX_PREFIX) if text.startswith(_APX_PREFIX) else 0
+    space = text.find(b" ", start)
+    if space <= start or not text[start:space].isalnum():
+        return ()
+    ins = text[:space]
+    arg = text[space + 1:-1] if text.endswith(b"\n") else text[space + 1:]
+    return ins, arg, classify(ins, arg)
+
+
+def classify(ins: bytes, arg: bytes) -> tuple:
+    """(sse, avx2, avx512, apx) scores of one instruction, -1.0 where it does
+    not count, and the index into levels of the level it needs.
+
+    The scores only depend on the mnemonic and on a few operand features,
+    so each combination is scored once by the is_* functions, from a
+    stand-in operand string with the same features.
+    """
+    signature = 0
+    if b"mm" in arg or b"{" in arg:
+        signature = ((b"%xmm" in arg) | (b"%ymm" in arg) << 1 | (b"%zmm" in arg) << 2 |
+                     (b"{%k" in arg) << 3 | (b"{1to" in arg) << 4 | arg.endswith(_HIGH_REGISTERS) << 5 |
+                     (b"%k" in arg) << 11)
+    if _APX_REGISTER_BYTES.search(arg):
+        signature |= 1 << 6
+    mnemonic = ins.rpartition(b" ")[2]
+    if mnemonic in _NDD_MNEMONICS or mnemonic.startswith(b"cmov"):
+        ops = operands(arg.decode("latin-1"))
+        if ops:
+            first = 1 if ops[0].startswith("$") else 2 if ops[0] == "%cl" else 0
+            signature |= min(len(ops), 7) << 7 | first << 10
+    scores = _classified.get((ins, signature))
+    if scores is None:
+        with phase("score"):
+            instruction = ins.decode("latin-1")
+            args = ",".join(stand_in for bit, stand_in in enumerate(_OPERAND_STAND_INS) if signature & 1 << bit)
+            apx_args = ["%rax"] * (signature >> 7 & 7)
+            if apx_args:
+                apx_args[0] = _APX_FIRST_STAND_INS[signature >> 10 & 3]
+            if signature & 1 << 6:
+                apx_args[-1:] = ["%r16"]
+            # the SSE and AVX scores go by the mnemonic after any APX prefix
+            mnemonic = instruction.rpartition(" ")[2]
+            avx2_score = -1.0
+            sse_score = -1.0
+            avx512_score = is_avx512(mnemonic, args)
+            if avx512_score <= 0:
+                avx2_score = is_avx2(mnemonic, args)
+            if avx2_score <= 0 and avx512_score <= 0:
+                sse_score = is_sse(mnemonic, args)
+            apx_score = is_apx(instruction, ",".join(apx_args))
+            if apx_score >= 0.0:
+                level = len(levels) - 1
+            else:
+                level = isa_level(instruction, _MASK_STAND_IN + "," + args if signature & 1 << 11 else args)
+            scores = _classified[ins, signature] = (sse_score, avx2_score, avx512_score, apx_score, level)
+    return scores
 
-def process_objdump_line(records:RecordKeeper, line:str, verbose:int, quiet:int) -> None:
-    sse_score = -1.0
-    avx2_score = -1.0
-    avx512_score = -1.0
-    sse_str = " "
-    avx2_str = " "
-    avx512_str = ""
 
+def process_objdump_line(records:RecordKeeper, line:bytes, verbose:int) -> None:
     global sse_avx2_duplicate_cnt
     global avx2_avx512_duplicate_cnt
     global debug
 
-    match = re.search("^$", line)
-    if match:
+    if line == b"\n" or not line:
         if records.function_record.instructions > 0 and verbose > 0:
             print()
             print_function_summary(records)
@@ -222,105 +750,1537 @@ def process_objdump_line(records:RecordKeeper, line:str, verbose:int, quiet:int)
             records.function_record = FunctionRecord()
         return
 
-    match = re.search("^(.*)\#.*", line)
-    if match:
-        line = match.group(1)
+    comment = line.rfind(b"#")
+    if comment >= 0:
+        line = line[:comment]
+
+    record = records.function_record
+    sse_score = avx2_score = avx512_score = apx_score = -1.0
+    parsed = parse_instruction(line)
+    if parsed:
+        ins, arg, (sse_score, avx2_score, avx512_score, apx_score, level) = parsed
+        record.instructions += 1
+        if level > record.level:
+            record.level = level
+        if sse_score >= 0.0:
+            record.scores["sse"] += sse_score
+            record.counts["sse"] += 1
+        if avx2_score >= 0.0:
+            record.scores["avx2"] += avx2_score
+            record.counts["avx2"] += 1
+        if avx512_score >= 0.0:
+            record.scores["avx512"] += avx512_score
+            record.counts["avx512"] += 1
+        if apx_score >= 0.0:
+            record.scores["apx"] += apx_score
+            record.counts["apx"] += 1
+    elif line.endswith(b">:\n") or line.endswith(b">:"):
+        match = _HEADER.search(line)
+        if match:
+            record.name = match.group(1).decode("latin-1")
 
-    match = re.search(".*[0-9a-f]+\:\t[0-9a-f\ ]+\t([a-zA-Z0-9]+) (.*)", line)
-    if match:
-        ins = match.group(1)
-        arg = match.group(2)
+    if sse_score >=0.0 and avx2_score >= 0.0 and debug:
+        sse_avx2_duplicate_cnt +=1
+        print("duplicate count for sse & avx2 ?", ins.decode("latin-1"), arg.decode("latin-1"), sse_avx2_duplicate_cnt)
 
-        avx512_score = is_avx512(ins, arg)
-        if avx512_score <= 0:
-            avx2_score = is_avx2(ins, arg)
-        if avx2_score <= 0 and avx512_score <= 0:
-            sse_score = is_sse(ins, arg)
+    if avx512_score >= 0.0 and avx2_score >= 0.0 and debug:
+        avx2_avx512_duplicate_cnt +=1
+        print("duplicate count for avx2 & avx512 ?", ins.decode("latin-1"), arg.decode("latin-1"), avx2_avx512_duplicate_cnt)
 
-        records.function_record.instructions += 1
+    if verbose > 0:
+        sse_str = str(sse_score) if sse_score >= 0.0 else " "
+        avx2_str = str(avx2_score) if avx2_score >= 0.0 else " "
+        avx512_str = str(avx512_score) if avx512_score >= 0.0 else ""
+        apx_str = str(apx_score) if apx_score >= 0.0 else ""
+        print(sse_str,"\t",avx2_str,"\t", avx512_str,"\t", apx_str,"\t", line.decode("latin-1"))
+
+
+# In-process decoding of the executable sections.
+#
+# objdump -d stays the reference for every score.  The native path walks the
+# same sections and symbol blocks objdump prints and length-decodes the x86-64
+# instruction stream itself.  Plain integer instructions, which can never
+# score, are only counted.  Every other encoding (SSE, AVX, AVX-512, x87,
+# prefixed forms) is reduced to its bytes with the displacement zeroed, and
+# each distinct one is disassembled once by objdump, so the scores come from
+# the very text objdump would have printed for it.  A block holding an
+# encoding objdump reads differently (usually data in the text section) is
+# rescored from objdump's listing of just that block; anything else the
+# decoder cannot follow raises NativeDecodeError and the whole file goes
+# through the plain objdump listing instead.
+
+class NativeDecodeError(Exception):
+    pass
+
+
+_LEGACY_PREFIXES = frozenset([0x26, 0x2e, 0x36, 0x3e, 0x64, 0x65, 0x66, 0x67,
+                              0xf0, 0xf2, 0xf3])
+
+# Opcode attributes: immediate kind in the low bits plus flags.  The fast
+# tables only describe unprefixed integer instructions whose objdump line is
+# known without looking at it: _OP_OPS marks the ones printed with operands
+# (only those lines are counted), _OP_WOK/_OP_GRP/_OP_PLUSR say which REX
+# bits they use and _OP_BAD that some ModRM bytes are invalid with them.
+# Everything marked _OP_SLOW goes through objdump.
+_IMM_NONE, _IMM_B, _IMM_W, _IMM_Z, _IMM_V, _IMM_ENTER, _IMM_MOFFS, _IMM_GROUP3 = range(8)
+# immediate bytes of the kinds the fast tables use, without prefixes
+_IMM_SIZES = (0, 1, 2, 4, 4, 3)
+_OP_MODRM = 0x08
+_OP_OPS = 0x10
+_OP_GRP = 0x20
+_OP_SLOW = 0x40
+_OP_WOK = 0x80
+_OP_PLUSR = 0x100
+_OP_BAD = 0x200
+
+
+def _opcode_table(entries: dict, default: int = _OP_SLOW) -> list:
+    table = [default] * 256
+    for opcodes, flags in entries.items():
+        for opcode in opcodes:
+            table[opcode] = flags
+    return table
+
+
+def _arith_opcodes(*columns) -> tuple:
+    return tuple(base + column for base in range(0, 0x40, 8) for column in columns)
+
+
+_ONE_BYTE = _opcode_table({
+    _arith_opcodes(0, 2): _OP_MODRM | _OP_OPS,
+    _arith_opcodes(1, 3): _OP_MODRM | _OP_OPS | _OP_WOK,
+    _arith_opcodes(4): _OP_OPS | _IMM_B,
+    _arith_opcodes(5): _OP_OPS | _OP_WOK | _IMM_Z,
+    tuple(range(0x50, 0x60)): _OP_OPS | _OP_PLUSR,
+    (0x63,): _OP_MODRM | _OP_OPS | _OP_WOK,
+    (0x68,): _OP_OPS | _IMM_Z,
+    (0x69,): _OP_MODRM | _OP_OPS | _OP_WOK | _IMM_Z,
+    (0x6a,): _OP_OPS | _IMM_B,
+    (0x6b,): _OP_MODRM | _OP_OPS | _OP_WOK | _IMM_B,
+    (0x6c, 0x6d, 0x6e, 0x6f): _OP_OPS,
+    tuple(range(0x70, 0x80)): _OP_OPS | _IMM_B,
+    (0x80,): _OP_MODRM | _OP_OPS | _OP_GRP | _IMM_B,
+    (0x81,): _OP_MODRM | _OP_OPS | _OP_GRP | _OP_WOK | _IMM_Z,
+    (0x83,): _OP_MODRM | _OP_OPS | _OP_GRP | _OP_WOK | _IMM_B,
+    (0x84, 0x86, 0x88, 0x8a): _OP_MODRM | _OP_OPS,
+    (0x8c, 0x8e): _OP_MODRM | _OP_OPS | _OP_GRP,
+    (0x85, 0x87, 0x89, 0x8b): _OP_MODRM | _OP_OPS | _OP_WOK,
+    (0x8d,): _OP_MODRM | _OP_OPS | _OP_WOK | _OP_BAD,
+    tuple(range(0x91, 0x98)): _OP_OPS | _OP_PLUSR | _OP_WOK,
+    (0x98, 0x99, 0xcb, 0xcf): _OP_WOK,
+    (0x90, 0x9c, 0x9d, 0x9e, 0x9f, 0xc3, 0xc9, 0xcc, 0xf1, 0xf4, 0xf5,
+     0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd): 0,
+    (0xa4, 0xa6, 0xaa, 0xac, 0xae): _OP_OPS,
+    (0xa5, 0xa7, 0xab, 0xad, 0xaf): _OP_OPS | _OP_WOK,
+    (0xa8,): _OP_OPS | _IMM_B,
+    (0xa9,): _OP_OPS | _OP_WOK | _IMM_Z,
+    tuple(range(0xb0, 0xb8)): _OP_OPS | _OP_PLUSR | _IMM_B,
+    tuple(range(0xb8, 0xc0)): _OP_OPS | _OP_PLUSR | _OP_WOK | _IMM_V,
+    (0xc0,): _OP_MODRM | _OP_OPS | _OP_GRP | _IMM_B,
+    (0xc1,): _OP_MODRM | _OP_OPS | _OP_GRP | _OP_WOK | _IMM_B,
+    (0xd0, 0xd2): _OP_MODRM | _OP_OPS | _OP_GRP,
+    (0xd1, 0xd3): _OP_MODRM | _OP_OPS | _OP_GRP | _OP_WOK,
+    (0xc2, 0xca): _OP_OPS | _IMM_W,
+    (0xc8,): _OP_OPS | _IMM_ENTER,
+    (0xcd,): _OP_OPS | _IMM_B,
+    (0xd7, 0xec, 0xed, 0xee, 0xef): _OP_OPS,
+    (0xe0, 0xe1, 0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xeb): _OP_OPS | _IMM_B,
+    (0xe8, 0xe9): _OP_OPS | _IMM_Z,
+    (0xfe,): _OP_MODRM | _OP_OPS | _OP_GRP | _OP_BAD,
+    (0xff,): _OP_MODRM | _OP_OPS | _OP_GRP | _OP_WOK | _OP_BAD,
+})
+
+# ModRM bytes that make an _OP_BAD opcode invalid; objdump prints a lone
+# (bad) for the opcode and decodes the ModRM byte as the next instruction
+_BAD_FORMS = {
+    0x8d: frozenset(range(0xc0, 0x100)),
+    0xfe: frozenset(modrm for modrm in range(256) if modrm & 0x38 >= 0x10),
+    0xff: frozenset(modrm for modrm in range(256)
+                    if modrm & 0x38 == 0x38 or modrm >= 0xc0 and modrm & 0x38 in (0x18, 0x28)),
+}
+
+# 0f opcodes without a ModRM byte; the fast path handles these directly
+_TWO_BYTE = _opcode_table({
+    (0x05, 0x06, 0x08, 0x09, 0x0b, 0x0e, 0x30, 0x31, 0x32, 0x33, 0x34, 0x35,
+     0x37, 0x77, 0xa2, 0xaa): 0,
+    (0xa0, 0xa1, 0xa8, 0xa9): _OP_OPS,
+    tuple(range(0x80, 0x90)): _OP_OPS | _IMM_Z,
+    tuple(range(0xc8, 0xd0)): _OP_OPS | _OP_PLUSR | _OP_WOK,
+})
+_TWO_BYTE_NO_MODRM = frozenset([0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b,
+                                0x0c, 0x0e, 0x24, 0x25, 0x26, 0x27, 0x30, 0x31,
+                                0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x39, 0x3b,
+                                0x3c, 0x3d, 0x3e, 0x3f, 0x77, 0xa0, 0xa1, 0xa2,
+                                0xa8, 0xa9, 0xaa]
+                               + list(range(0x80, 0x90)) + list(range(0xc8, 0xd0)))
+
+# Layout of every one-byte opcode for the general decoder: ModRM presence
+# and immediate kind.  Opcodes invalid in 64-bit mode are a lone byte.
+def _layout_table(entries: dict) -> list:
+    table = [0 if flags & _OP_SLOW else flags & (_OP_MODRM | 7) for flags in _ONE_BYTE]
+    for opcodes, layout in entries.items():
+        for opcode in opcodes:
+            table[opcode] = layout
+    return table
+
+
+_ONE_BYTE_LAYOUT = _layout_table({
+    (0x8f, 0xd8, 0xd9, 0xda, 0xdb, 0xdc, 0xdd, 0xde, 0xdf): _OP_MODRM,
+    (0xc6,): _OP_MODRM | _IMM_B,
+    (0xc7,): _OP_MODRM | _IMM_Z,
+    (0xf6, 0xf7): _OP_MODRM | _IMM_GROUP3,
+    (0xa0, 0xa1, 0xa2, 0xa3): _IMM_MOFFS,
+})
+
+# 3DNow! opcodes, the trailing byte of 0f 0f; objdump prints a lone (bad)
+# 0f for any other
+_3DNOW_SUFFIXES = frozenset([0x0c, 0x0d, 0x1c, 0x1d, 0x8a, 0x8e, 0x90, 0x94, 0x96, 0x97,
+                             0x9a, 0x9e, 0xa0, 0xa4, 0xa6, 0xa7, 0xaa, 0xae, 0xb0, 0xb4,
+                             0xb6, 0xb7, 0xbb, 0xbf])
+# 0f and VEX map 1 opcodes taking an 8-bit immediate
+_TWO_BYTE_IMM8 = frozenset([0x70, 0x71, 0x72, 0x73, 0xa4, 0xac, 0xba, 0xc2, 0xc4,
+                            0xc5, 0xc6])
+
+
+def _modrm_sizes() -> tuple:
+    """ModRM+SIB bytes and ModRM+SIB+displacement bytes for each ModRM."""
+    core, full = [], []
+    for modrm in range(256):
+        mod, rm = modrm >> 6, modrm & 7
+        sib = mod != 3 and rm == 4
+        disp = 1 if mod == 1 else 4 if mod == 2 or mod == 0 and rm == 5 else 0
+        core.append(2 if sib else 1)
+        full.append((2 if sib else 1) + disp)
+    return core, full
+
+
+_MODRM_CORE, _MODRM_FULL = _modrm_sizes()
+
+
+def _instruction_layout(data: bytes, pos: int) -> tuple:
+    """Length-decode the instruction at pos.
+
+    Returns (core, disp, end): the instruction is data[pos:end], and
+    data[core:disp] is its displacement, the only part that never changes
+    what the instruction scores.  core is None for the few byte sequences
+    objdump prints without operands whatever follows them, and everything
+    is None if the layout cannot be told.  Other malformed encodings get a
+    best guess; _objdump_encodings catches every one objdump reads
+    differently.
+    """
+    p = pos
+    while data[p] in _LEGACY_PREFIXES or data[p] == 0x9b or 0x40 <= data[p] <= 0x4f:
+        p += 1
+    if data[pos:p].count(0x9b) > 1:
+        # objdump's reading of these depends on what follows
+        return None, None, None
+    if 0x9b in data[pos:p] and not 0xd8 <= data[p] <= 0xdf:
+        # fwait is printed on its own unless an x87 instruction follows
+        p = data.find(b"\x9b", pos) + 1
+        return (None, None, p) if p == pos + 1 else (p, p, p)
+    p = pos
+    n66 = addr32 = repne = False
+    while data[p] in _LEGACY_PREFIXES or data[p] == 0x9b:
+        if data[p] == 0x66:
+            n66 = True
+        elif data[p] == 0x67:
+            addr32 = True
+        elif data[p] == 0xf2:
+            repne = True
+        p += 1
+    rex = 0
+    if 0x40 <= data[p] <= 0x4f:
+        rex = data[p]
+        p += 1
+        if data[p] in _LEGACY_PREFIXES or 0x40 <= data[p] <= 0x4f:
+            # objdump prints a REX byte that is not last on its own line
+            return (None, None, p) if p - 1 == pos else (p, p, p)
+    opcode = data[p]
+    p += 1
+    if opcode == 0xd5 and not rex:
+        # APX REX2 prefix: its payload holds REX.W and whether the opcode
+        # is one of the 0f map, which then follows without the 0f
+        rex = 0x40 | data[p] & 0x0f
+        if data[p] & 0x80:
+            opcode = 0x0f
+        else:
+            opcode = data[p + 1]
+            p += 1
+        p += 1
+    modrm = True
+    amd3dnow = False
+    imm = 0
+    if opcode == 0x0f:
+        opcode = data[p]
+        p += 1
+        if opcode == 0x38:
+            p += 1
+        elif opcode == 0x3a:
+            p += 1
+            imm = 1
+        elif opcode in _TWO_BYTE_NO_MODRM:
+            modrm = False
+            if 0x80 <= opcode < 0x90:
+                imm = 2 if n66 and not rex & 8 else 4
+        elif opcode == 0x0f:
+            amd3dnow = True
+            imm = 1
+        elif opcode in _TWO_BYTE_IMM8:
+            imm = 1
+        elif opcode == 0x78 and (n66 or repne):
+            imm = 2
+    elif opcode in (0xc4, 0xc5, 0x62) or opcode == 0x8f and data[p] & 0x38:
+        lead = opcode
+        if opcode == 0xc5:
+            vex_map = 1
+            p += 1
+        elif opcode == 0x62:
+            vex_map = data[p] & 7
+            p += 3
+        else:
+            vex_map = data[p] & 31
+            p += 2
+        opcode = data[p]
+        p += 1
+        if opcode == 0x77 and vex_map == 1 and lead != 0x62:
+            modrm = False
+        if vex_map in (3, 8):
+            imm = 1
+        elif vex_map == 4 and lead == 0x62:
+            # APX promoted integer instructions keep their legacy
+            # immediates; the second payload byte holds W and pp (66)
+            if opcode in (0x24, 0x2c, 0x6b, 0x80, 0x83, 0xc0, 0xc1) or opcode == 0xf6 and not data[p] & 0x30:
+                imm = 1
+            elif opcode in (0x69, 0x81) or opcode == 0xf7 and not data[p] & 0x30:
+                imm = 2 if data[p - 3] & 0x83 == 0x01 else 4
+        elif vex_map == 0x0a:
+            imm = 4
+        elif vex_map == 1 and opcode in _TWO_BYTE_IMM8:
+            imm = 1
+    else:
+        layout = _ONE_BYTE_LAYOUT[opcode]
+        modrm = layout & _OP_MODRM
+        kind = layout & 7
+        if kind == _IMM_B:
+            imm = 1
+        elif kind == _IMM_W:
+            imm = 2
+        elif kind == _IMM_Z:
+            imm = 2 if n66 and not rex & 8 else 4
+        elif kind == _IMM_V:
+            imm = 8 if rex & 8 else 2 if n66 else 4
+        elif kind == _IMM_ENTER:
+            imm = 3
+        elif kind == _IMM_MOFFS:
+            imm = 4 if addr32 else 8
+        elif kind == _IMM_GROUP3 and not data[p] & 0x30:
+            imm = 1 if opcode == 0xf6 else 2 if n66 and not rex & 8 else 4
+    if not modrm:
+        return p, p, p + imm
+    m = data[p]
+    core = p + _MODRM_CORE[m]
+    disp = p + _MODRM_FULL[m]
+    if m < 0xc0 and m & 0xc7 == 4 and data[p + 1] & 7 == 5:
+        disp += 4
+    if amd3dnow and p - 2 == pos and data[disp] not in _3DNOW_SUFFIXES:
+        return None, None, pos + 1
+    return core, disp, disp + imm
+
+
+def _rex_used(rex: int, flags: int, modrm: int, sib: int) -> bool:
+    """Whether an instruction with a ModRM byte uses every REX bit it has."""
+    if rex & 8 and not flags & _OP_WOK:
+        return False
+    if rex & 4 and flags & _OP_GRP:
+        return False
+    memory = modrm < 0xc0
+    if rex & 2 and not (memory and modrm & 7 == 4):
+        return False
+    if rex & 1 and memory and (modrm & 0xc7 == 5 or modrm & 0xc7 == 4 and sib & 7 == 5):
+        return False
+    return True
+
+
+def _native_block(data: bytes, pos: int, stop: int, layouts: dict, encodings: list, ids: list) -> int:
+    """Walk data[pos:stop] the way objdump prints one symbol block.
+
+    Returns the number of counted integer instructions and appends the
+    encoding id of every other instruction to ids, or None where the walk
+    lost track; layouts and encodings collect the distinct encodings across
+    the whole file.
+    """
+    one = _ONE_BYTE
+    two = _TWO_BYTE
+    modrm_full = _MODRM_FULL
+    modrm_core = _MODRM_CORE
+    prefixes = _LEGACY_PREFIXES
+    instructions = 0
+
+    while pos < stop:
+        b = data[pos]
+        if b == 0:
+            # objdump prints "..." for runs of zero bytes instead of decoding
+            z = pos + 1
+            while z < stop and data[z] == 0:
+                z += 1
+            run = z - pos
+            if run >= 8 or z == stop and run < 3:
+                pos = z if z == stop else pos + (run & ~3)
+                continue
+
+        p = pos
+        rex = 0
+        if 0x40 <= b <= 0x4f:
+            rex = b
+            p += 1
+            b = data[p]
+        flags = one[b]
+        hdr = 0
+        if flags & _OP_SLOW:
+            if b == 0x0f:
+                b = data[p + 1]
+                if b in _TWO_BYTE_NO_MODRM:
+                    if not rex:
+                        flags = two[b]
+                        p += 1
+                elif b != 0x0f:
+                    hdr = p + (3 if b == 0x38 or b == 0x3a else 2)
+            elif rex:
+                pass
+            elif b == 0xc5 or b == 0xc4 or b == 0x62:
+                hdr = pos + (5 if b == 0x62 else 4 if b == 0xc4 else 3)
+                if data[hdr - 1] == 0x77 and (b == 0xc5 or b == 0xc4 and data[pos + 1] & 31 == 1):
+                    hdr = 0
+            elif b in prefixes:
+                q = pos + 1
+                while data[q] in prefixes:
+                    q += 1
+                if 0x40 <= data[q] <= 0x4f:
+                    q += 1
+                if data[q] == 0x0f and data[q + 1] != 0x0f and data[q + 1] not in _TWO_BYTE_NO_MODRM:
+                    hdr = q + (3 if data[q + 1] == 0x38 or data[q + 1] == 0x3a else 2)
+        elif flags & _OP_BAD and data[p + 1] in _BAD_FORMS[b]:
+            flags = _OP_SLOW
+        elif rex and flags & _OP_MODRM and not _rex_used(rex, flags, data[p + 1], data[p + 2]):
+            flags = _OP_SLOW
+        elif rex and not flags & _OP_MODRM and (rex & 8 and not flags & _OP_WOK or rex & 6
+                                              or rex & 1 and not flags & _OP_PLUSR
+                                              or not flags & _OP_OPS and rex != 0x48):
+            flags = _OP_SLOW
+        elif rex & 8 and b == 0xff and 2 <= (data[p + 1] >> 3) & 7 <= 6:
+            flags = _OP_SLOW
+
+        if not flags & _OP_SLOW:
+            p += 1
+            if flags & _OP_MODRM:
+                m = data[p]
+                if m & 0xc7 == 4 and data[p + 1] & 7 == 5:
+                    p += 4
+                p += modrm_full[m]
+            imm = flags & 7
+            if imm:
+                p += 8 if imm == _IMM_V and rex & 8 else _IMM_SIZES[imm]
+            if p > stop:
+                # objdump does not read past the block: it prints the first
+                # byte on its own and carries on after it
+                pos += 1
+                continue
+            if flags & _OP_OPS:
+                instructions += 1
+        else:
+            if hdr:
+                m = data[hdr]
+                core = hdr + modrm_core[m]
+                disp = hdr + modrm_full[m]
+                if m < 0xc0 and m & 0xc7 == 4 and data[hdr + 1] & 7 == 5:
+                    disp += 4
+            else:
+                core, disp, end = _instruction_layout(data, pos)
+                if end is None:
+                    ids.append(None)
+                    break
+                if core is None:
+                    pos = end
+                    continue
+            key = data[pos:core]
+            layout = layouts.get(key)
+            if layout is None:
+                if hdr:
+                    check = _instruction_layout(data, pos)
+                    if check[:2] != (core, disp):
+                        raise NativeDecodeError("inconsistent instruction layout")
+                    end = check[2]
+                layout = layouts[key] = (disp - core, end - disp, {})
+            disp_len, tail, by_tail = layout
+            if disp - core != disp_len:
+                raise NativeDecodeError("inconsistent displacement")
+            p = disp + tail
+            if p > stop:
+                pos += 1
+                continue
+            tail_key = data[disp:p]
+            encoding = by_tail.get(tail_key)
+            if encoding is None:
+                encoding = by_tail[tail_key] = len(encodings)
+                encodings.append(key + bytes(disp_len) + tail_key)
+            ids.append(encoding)
+        pos = p
+    return instructions
+
+
+def _objdump_encodings(encodings: list) -> list:
+    """Disassemble each distinct encoding once: (counted, scores) per id.
+
+    scores is None when the instruction scores nothing and is in the base
+    level.  An encoding objdump reads with a different length than
+    _instruction_layout gets None instead of a tuple.
+    """
+    results = _objdump_run(encodings, b"")
+    retry = [number for number, result in enumerate(results) if result is None]
+    if retry:
+        # a misread encoding can run into the next one; 15 nops after each
+        # are more than the longest instruction, so objdump is back in step
+        # by the start of the next encoding
+        for number, result in zip(retry, _objdump_run([encodings[number] for number in retry], b"\x90" * 15)):
+            results[number] = result
+    return results
+
+
+def _objdump_run(encodings: list, padding: bytes) -> list:
+    """One objdump pass over the encodings, each followed by padding.
+
+    x86 decoding only looks forward, so every encoding objdump prints at its
+    expected offset and length is confirmed whatever happened to the bytes
+    before it.
+    """
+    if not encodings:
+        return []
+    starts = {}
+    offset = 0
+    for number, encoding in enumerate(encodings):
+        starts[offset] = number
+        offset += len(encoding) + len(padding)
+
+    with tempfile.NamedTemporaryFile(prefix="avxjudge-", suffix=".bin") as f:
+        f.write(padding.join(encodings) + padding)
+        f.flush()
+        output = subprocess.run(["objdump", "-D", "-w", "-b", "binary", "-m", "i386:x86-64", f.name],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+
+    results = [None] * len(encodings)
+    for line in output.splitlines():
+        match = _LISTED_AT.match(line)
+        if not match:
+            continue
+        number = starts.get(int(match.group(1), 16))
+        if number is None or len(match.group(2).split()) != len(encodings[number]):
+            continue
+        score = None
+        counted = False
+        comment = line.rfind(b"#")
+        if comment >= 0:
+            line = line[:comment]
+        match = _INSTRUCTION.search(line)
+        if match:
+            counted = True
+            score = _score(*match.groups())
+        results[number] = (counted, score)
+    return results
+
+
+def _objdump_block(filename: str, start: int, stop: int) -> FunctionRecord:
+    """Score one symbol block from objdump's own listing of its addresses."""
+    output = subprocess.run(["objdump", "-d", "--start-address=0x%x" % start,
+                             "--stop-address=0x%x" % stop, filename],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    records = RecordKeeper("")
+    started = False
+    for line in output.splitlines():
+        if _HEADER.search(line):
+            if started:
+                break
+            started = True
+        if started and line:
+            process_objdump_line(records, line, 0)
+    if not started:
+        raise NativeDecodeError("objdump printed no block at 0x%x" % start)
+    return records.function_record
+
+
+def _score(ins: bytes, args: bytes) -> tuple:
+    """process_objdump_line's scoring, None if nothing scores and the
+    instruction is in the base level.
+    """
+    score = classify(ins, args)
+    if max(score[:4]) < 0 and not score[4]:
+        return None
+    return score
+
+
+_SHF_EXECINSTR = 0x4
+_SHT_SYMTAB = 2
+_SHT_NOBITS = 8
+_SHT_DYNSYM = 11
+_SHT_GNU_VERDEF = 0x6ffffffd
+_SHT_GNU_VERNEED = 0x6ffffffe
+_SHT_GNU_VERSYM = 0x6fffffff
+_STT_OBJECT = 1
+_STT_FUNC = 2
+_STT_SECTION = 3
+_STT_FILE = 4
+_STT_GNU_IFUNC = 10
+_STB_LOCAL = 0
+_STB_GLOBAL = 1
+
+
+def _cstring(data: bytes, offset: int) -> str:
+    end = data.find(b"\0", offset)
+    if end < 0:
+        raise ValueError("unterminated string")
+    return data[offset:end].decode("latin-1")
+
+
+def _elf_version_names(data: bytes, sections: list, dynsym: int) -> tuple:
+    """Version suffix for each dynamic symbol, the way bfd appends them."""
+    verdefs, verneeds, versym = {}, {}, None
+    base = None
+    for index, (name, stype, flags, addr, offset, size, link, info, align, entsize) in enumerate(sections):
+        if stype == _SHT_GNU_VERSYM and link == dynsym:
+            versym = offset
+        elif stype in (_SHT_GNU_VERDEF, _SHT_GNU_VERNEED):
+            strtab = sections[link][4]
+            entry = offset
+            for _ in range(info):
+                if stype == _SHT_GNU_VERDEF:
+                    vd_version, vd_flags, vd_ndx, vd_cnt, vd_hash, vd_aux, vd_next = \
+                        struct.unpack_from("<HHHHIII", data, entry)
+                    vda_name = struct.unpack_from("<I", data, entry + vd_aux)[0]
+                    verdefs[vd_ndx] = _cstring(data, strtab + vda_name)
+                    if base is None:
+                        base = vd_flags & 1
+                    next_entry = vd_next
+                else:
+                    vn_version, vn_cnt, vn_file, vn_aux, vn_next = \
+                        struct.unpack_from("<HHIII", data, entry)
+                    aux = entry + vn_aux
+                    for _ in range(vn_cnt):
+                        vna_hash, vna_flags, vna_other, vna_name, vna_next = \
+                            struct.unpack_from("<IHHII", data, aux)
+                        verneeds[vna_other] = _cstring(data, strtab + vna_name)
+                        aux += vna_next
+                    next_entry = vn_next
+                if not next_entry:
+                    break
+                entry += next_entry
+    return versym, verdefs, verneeds, base
+
+
+def _elf_symbols(data: bytes, sections: list) -> list:
+    """Symbols objdump keeps for disassembly: (section, value, key, name, type)."""
+    for wanted in (_SHT_SYMTAB, _SHT_DYNSYM):
+        table = [i for i, section in enumerate(sections) if section[1] == wanted]
+        if table and sections[table[0]][5] > sections[table[0]][9]:
+            break
+    else:
+        return []
+    index = table[0]
+    offset, size, link, entsize = sections[index][4], sections[index][5], sections[index][6], sections[index][9]
+    strtab = sections[link][4]
+    versions = None
+    if wanted == _SHT_DYNSYM:
+        versym, verdefs, verneeds, base = _elf_version_names(data, sections, index)
+        if versym is not None and (verdefs or verneeds):
+            versions = versym, verdefs, verneeds, base
+
+    symbols = []
+    for number in range(1, size // entsize):
+        st_name, st_info, st_other, st_shndx, st_value, st_size = \
+            struct.unpack_from("<IBBHQQ", data, offset + number * entsize)
+        stype, bind = st_info & 15, st_info >> 4
+        if not st_name or stype in (_STT_SECTION, _STT_FILE):
+            continue
+        if st_shndx == 0 or st_shndx >= 0xff00:
+            if st_shndx == 0xffff:
+                raise NativeDecodeError("extended section index")
+            continue
+        name = _cstring(data, strtab + st_name)
+        if not name:
+            continue
+        label = name
+        if versions:
+            versym, verdefs, verneeds, base = versions
+            vernum = struct.unpack_from("<H", data, versym + 2 * number)[0]
+            hidden = vernum & 0x8000
+            vernum &= 0x7fff
+            version = ""
+            if vernum == 1 and (not verdefs or base):
+                version = "Base"
+            elif vernum in verdefs:
+                version = verdefs[vernum]
+            elif vernum > 1:
+                version = verneeds.get(vernum, "")
+            if version:
+                label += ("@" if hidden else "@@") + version
+        function = stype in (_STT_FUNC, _STT_GNU_IFUNC)
+        key = (st_value,
+               "gnu_compiled" in name or "gcc2_compiled" in name,
+               len(name) > 2 and name[-2] == "." and name[-1] in "oa",
+               not function,
+               stype != _STT_OBJECT,
+               bind == _STB_LOCAL,
+               bind != _STB_GLOBAL,
+               -st_size,
+               name[0] == ".",
+               name)
+        symbols.append((st_shndx, st_value, key, label, stype))
+    return symbols
+
+
+def _elf_sections(data: bytes) -> tuple:
+    """Section headers of an x86-64 ELF file and its section name table offset."""
+    if data[:4] != b"\x7fELF" or data[4:6] != b"\x02\x01":
+        raise NativeDecodeError("not a little endian ELF64 file")
+    e_type, e_machine = struct.unpack_from("<HH", data, 16)
+    if e_machine != 62 or e_type not in (2, 3):
+        raise NativeDecodeError("not an x86-64 executable or shared object")
+    e_shoff = struct.unpack_from("<Q", data, 0x28)[0]
+    e_shentsize, e_shnum, e_shstrndx = struct.unpack_from("<HHH", data, 0x3a)
+    if not e_shnum or e_shstrndx >= e_shnum or e_shentsize != 64:
+        raise NativeDecodeError("section headers")
+    sections = [struct.unpack_from("<IIQQQQIIQQ", data, e_shoff + i * 64)
+                for i in range(e_shnum)]
+    return sections, sections[e_shstrndx][4]
+
+
+def _elf_blocks(data: bytes) -> list:
+    """Split the executable sections into the symbol blocks objdump prints.
+
+    Returns (name, start, stop, address, stop address) tuples, start and
+    stop as file offsets of the bytes to decode.
+    """
+    sections, shstrtab = _elf_sections(data)
+    by_section = {}
+    for symbol in _elf_symbols(data, sections):
+        by_section.setdefault(symbol[0], []).append(symbol)
+
+    blocks = []
+    for index, (name, stype, flags, addr, offset, size, link, info, align, entsize) in enumerate(sections):
+        if not flags & _SHF_EXECINSTR or stype == _SHT_NOBITS or not size:
+            continue
+        if offset + size > len(data):
+            raise NativeDecodeError("truncated section")
+        section_name = _cstring(data, shstrtab + name)
+        symbols = sorted(by_section.get(index, ()), key=lambda symbol: symbol[2])
+        # first symbol of each distinct address, in address order
+        starts = []
+        for symbol in symbols:
+            if not starts or starts[-1][1] != symbol[1]:
+                starts.append(symbol)
+        end = addr + size
+        here = addr
+        place = 0
+        while here < end:
+            while place + 1 < len(starts) and starts[place + 1][1] <= here:
+                place += 1
+            if not starts:
+                symbol, label = None, section_name
+            else:
+                symbol = starts[place]
+                if symbol[1] == here:
+                    label = symbol[3]
+                elif symbol[1] > here:
+                    label = "%s-0x%x" % (symbol[3], symbol[1] - here)
+                else:
+                    label = "%s+0x%x" % (symbol[3], here - symbol[1])
+            if symbol is None:
+                stop = end
+            elif symbol[1] > here:
+                stop = symbol[1]
+            elif place + 1 < len(starts):
+                stop = starts[place + 1][1]
+            else:
+                stop = end
+            if stop > end or stop <= here:
+                stop = end
+            if symbol is not None and symbol[4] == _STT_OBJECT:
+                # objdump dumps data objects as rows of hex, none of which
+                # look like an instruction line
+                blocks.append((label, offset + here - addr, offset + here - addr, here, stop))
+            else:
+                blocks.append((label, offset + here - addr, offset + stop - addr, here, stop))
+            here = stop
+    return blocks
 
-    match = re.search(r'^[0-9a-f]+ <(.+)>:$', line)
-    if match:
-        records.function_record.name = match.group(1)
 
-    if sse_score >= 0.0:
-        sse_str = str(sse_score)
-        records.function_record.scores["sse"] += sse_score
-        records.function_record.counts["sse"] += 1
 
-    if avx2_score >= 0.0:
-        avx2_str = str(avx2_score)
-        records.function_record.scores["avx2"] += avx2_score
-        records.function_record.counts["avx2"] += 1
 
-    if avx512_score >= 0.0:
-        avx512_str = str(avx512_score)
-        records.function_record.scores["avx512"] += avx512_score
-        records.function_record.counts["avx512"] += 1
+def process_native(records: RecordKeeper, filename: str, quiet: int, whole: bool = False) -> None:
+    """Fill records from filename the way the objdump -d listing would.
 
-    if sse_score >=0.0 and avx2_score >= 0.0 and debug:
-        sse_avx2_duplicate_cnt +=1
-        print("duplicate count for sse & avx2 ?", ins, arg, sse_avx2_duplicate_cnt)
+    With quiet set, scoring stops as soon as the verdict is certain.  With
+    whole set, the last block, which the listing leaves unfinalized, is
+    finalized too.  Raises NativeDecodeError if the file holds anything the
+    length decoder does not model; records is left untouched in that case.
+    """
+    layouts = {}
+    encodings = []
+    functions = []
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        try:
+            with phase("decode"):
+                for name, start, stop, address, stop_address in _elf_blocks(data):
+                    ids = []
+                    instructions = _native_block(data, start, stop, layouts, encodings, ids)
+                    functions.append((name, instructions, ids, address, stop_address, stop - start))
+        except (IndexError, struct.error) as e:
+            raise NativeDecodeError("truncated instruction or table: %s" % e)
+    with phase("objdump"):
+        results = _objdump_encodings(encodings)
+
+    records.code_bytes = sum(function[5] for function in functions)
+    # objdump output never ends in a blank line, so the last block is not
+    # finalized and never needs scoring
+    scored = functions if whole else functions[:-1]
+    # the oracle already scored every instruction of a block it agrees on,
+    # so only the blocks objdump redoes are bounded by their size
+    column = ("sse", "avx2", "avx512", "apx").index(records.delete_type) if records.delete_type else 0
+    bounds = []
+    for name, instructions, ids, address, stop_address, size in scored:
+        if any(encoding is None or results[encoding] is None for encoding in ids):
+            bounds.append((size, 0))
+        else:
+            bounds.append((0, sum(1 for encoding in ids
+                                  if results[encoding][1] is not None and results[encoding][1][column] >= 0.0)))
+    remaining = sum(bound[0] for bound in bounds)
+    scoring = sum(bound[1] for bound in bounds)
+    with phase("score"):
+        redone = 0
+        for index, (name, instructions, ids, address, stop_address, size) in enumerate(scored):
+            if quiet != 0 and records.verdict_certain(remaining, scoring):
+                records.skipped_bytes = records.code_bytes - sum(function[5] for function in functions[:index])
+                # leaving only the last block, which is never scored, does
+                # not leave the totals partial
+                records.stopped = any(function[5] for function in scored[index:])
+                return
+            remaining -= bounds[index][0]
+            scoring -= bounds[index][1]
+            if any(encoding is None or results[encoding] is None for encoding in ids):
+                # data or malformed code the length decoder misread; this
+                # block's native instruction boundaries cannot be trusted
+                redone += 1
+                if redone > 64:
+                    raise NativeDecodeError("too many blocks objdump decodes differently")
+                with phase("objdump"):
+                    record = _objdump_block(filename, address, stop_address)
+                record.name = name
+            else:
+                record = FunctionRecord()
+                record.name = name
+                for encoding in ids:
+                    counted, score = results[encoding]
+                    if counted:
+                        instructions += 1
+                    if score is None:
+                        continue
+                    sse_score, avx2_score, avx512_score, apx_score, level = score
+                    if level > record.level:
+                        record.level = level
+                    if sse_score >= 0.0:
+                        record.scores["sse"] += sse_score
+                        record.counts["sse"] += 1
+                    if avx2_score >= 0.0:
+                        record.scores["avx2"] += avx2_score
+                        record.counts["avx2"] += 1
+                    if avx512_score >= 0.0:
+                        record.scores["avx512"] += avx512_score
+                        record.counts["avx512"] += 1
+                    if apx_score >= 0.0:
+                        record.scores["apx"] += apx_score
+                        record.counts["apx"] += 1
+                record.instructions = instructions
+            if record.instructions > 0:
+                records.function_record = record
+                records.finalize_function_attrs()
+    records.function_record = FunctionRecord()
+    if functions and not whole:
+        records.function_record.name = functions[-1][0]
+
+
+def code_digest(filename: str) -> str:
+    """Hash of the names, sizes and bytes of the executable sections of filename."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        sections, shstrtab = _elf_sections(data)
+        for name, stype, flags, addr, offset, size, link, info, align, entsize in sections:
+            if not flags & _SHF_EXECINSTR or stype == _SHT_NOBITS:
+                continue
+            if offset + size > len(data):
+                raise NativeDecodeError("truncated section")
+            name = data[shstrtab + name:data.find(b"\0", shstrtab + name)]
+            digest.update(name + b"\0" + struct.pack("<Q", size))
+            with memoryview(data) as view:
+                digest.update(view[offset:offset + size])
+    return digest.hexdigest()
+
+
+def _listed_blocks(filename: str) -> list:
+    """_elf_blocks of filename, None if it cannot be split into blocks."""
+    try:
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _elf_blocks(data)
+    except (NativeDecodeError, OSError, IndexError, ValueError, struct.error):
+        return None
+
+
+def _code_after(blocks: list) -> tuple:
+    """Bytes of code objdump -d lists for blocks, the size of the last
+    block, and by block address how many bytes are listed after that block.
+
+    Returns (None, 0, {}) if blocks is None.
+    """
+    if blocks is None:
+        return None, 0, {}
+    total = sum(stop - start for name, start, stop, address, stop_address in blocks)
+    after = {}
+    remaining = total
+    for name, start, stop, address, stop_address in blocks:
+        remaining -= stop - start
+        after[address] = remaining
+    return total, blocks[-1][2] - blocks[-1][1] if blocks else 0, after
+
+
+def _code_ranges(blocks: list, count: int) -> list:
+    """Split blocks into about count address ranges of similar size.
+
+    Ranges end on block boundaries, so no function is split between two of
+    them, and never span the gap between two sections.  Returns (start,
+    stop, address of the last block) tuples in listing order.
+    """
+    if not blocks:
+        return []
+    size = max(sum(block[4] - block[3] for block in blocks) // count, 1 << 20)
+    ranges = []
+    start = blocks[0][3]
+    for index, (name, offset, stop_offset, address, stop_address) in enumerate(blocks):
+        if index + 1 == len(blocks) or blocks[index + 1][3] != stop_address \
+                or stop_address - start >= size:
+            ranges.append((start, stop_address, address))
+            if index + 1 < len(blocks):
+                start = blocks[index + 1][3]
+    return ranges
+
+
+def _objdump_range(filename: str, start: int, stop: int) -> tuple:
+    """FunctionRecords of the blocks objdump lists from start to stop, in
+    order, and the number of lines listed.
+    """
+    records = RecordKeeper("")
+    functions = []
+    lines = 0
+    with subprocess.Popen(["objdump", "-d", "--start-address=0x%x" % start,
+                           "--stop-address=0x%x" % stop, filename], stdout=subprocess.PIPE) as p:
+        for lines, line in enumerate(p.stdout, 1):
+            if line.endswith(b">:\n") and line[:1] != b" ":
+                records.function_record = FunctionRecord()
+                functions.append(records.function_record)
+            process_objdump_line(records, line, 0)
+    return functions, lines
+
+
+def process_objdump_ranges(records: RecordKeeper, filename: str, ranges: list, jobs: int, quiet: int,
+                           after: dict, last: int) -> None:
+    """Fill records from objdump listings of ranges run on jobs workers.
+
+    The blocks are finalized in listing order, so records ends up exactly
+    as one objdump -d run over the whole file leaves it.  With quiet set,
+    scoring stops as soon as the verdict is certain.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_objdump_range, filename, start, stop) for start, stop, final in ranges]
+        for index, ((start, stop, final), future) in enumerate(zip(ranges, futures)):
+            functions, lines = future.result()
+            if stats is not None:
+                stats.lines += lines
+            if index + 1 == len(ranges):
+                # objdump output never ends in a blank line, so the last
+                # block is not finalized
+                last_record = functions.pop() if functions else FunctionRecord()
+            for record in functions:
+                if record.instructions > 0:
+                    records.function_record = record
+                    records.finalize_function_attrs()
+            if quiet != 0 and index + 1 < len(ranges) and \
+                    records.verdict_certain(max(after[final] - last, 0)):
+                records.skipped_bytes = after[final]
+                records.stopped = after[final] > last
+                executor.shutdown(cancel_futures=True)
+                return
+    records.function_record = last_record
+
+
+# Bump when the scoring code changes in a way the tables below do not show
+CACHE_VERSION = 2
+
+
+def scoring_fingerprint() -> str:
+    """Hash of everything besides the file itself that decides a verdict."""
+    fingerprint = hashlib.sha256()
+    tables = (sse_instructions_xmm, avx2_instructions_lv, avx2_instructions_ymm, avx512_instructions_lv,
+              avx2_instructions, avx512_instructions, avx2_instructions_hv, avx512_instructions_hv,
+              apx_instructions_ndd.items(), apx_instructions_lv, apx_instructions, apx_instructions_hv)
+    for table in tables:
+        fingerprint.update(repr(sorted(table)).encode())
+    fingerprint.update(repr((min_count, min_score, CACHE_VERSION)).encode())
+    try:
+        version = subprocess.run(["objdump", "--version"], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL).stdout.split(b"\n")[0]
+    except OSError:
+        version = b""
+    fingerprint.update(version)
+    return fingerprint.hexdigest()
+
+
+class VerdictCache():
+    """On-disk cache of scoring results, keyed by file content.
+
+    One JSON file per entry, readable by everyone sharing the directory,
+    written to a temporary name and renamed into place, so concurrent runs
+    only ever see whole entries.  A hit refreshes the entry's mtime.  The
+    size of the directory is scanned once and then tracked as entries are
+    added; once it grows past max_bytes the oldest entries are evicted
+    down to three quarters of it, so a full cache is not rescanned on
+    every put.  Copies made by for_workers only add entries, and the
+    size limit is enforced by one prune in the process that made them.
+    """
+    # temporary files older than this were left by a run that died
+    stale_seconds = 3600
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = scoring_fingerprint()
+        self.total = None
+        self.pruning = True
+        os.makedirs(directory, exist_ok=True)
+
+    def for_workers(self) -> "VerdictCache":
+        """A copy to pass to worker processes, whose puts leave the size
+        limit to prune() here once they are done."""
+        worker = copy.copy(self)
+        worker.pruning = False
+        return worker
+
+    def key(self, filename: str) -> str:
+        digest = hashlib.sha256(self.fingerprint.encode())
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str, records: RecordKeeper) -> bool:
+        """Fill records from the entry for key; False if there is none."""
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            return False
+        records.total_counts = entry["total_counts"]
+        records.total_scores = entry["total_scores"]
+        for tables, top in ((records.functions, entry["functions"]), (records.ratios, entry["ratios"])):
+            for i, table in tables.items():
+                for order, (name, value) in enumerate(top[i].items()):
+                    table.set(name, value, order)
+        return True
+
+    def put(self, key: str, records: RecordKeeper) -> None:
+        entry = {
+            "total_counts": records.total_counts,
+            "total_scores": records.total_scores,
+            "functions": {i: dict(records.functions[i].top()) for i in records.functions},
+            "ratios": {i: dict(records.ratios[i].top()) for i in records.ratios},
+        }
+        name = None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=".tmp-", delete=False) as f:
+                name = f.name
+                json.dump(entry, f)
+                size = f.tell()
+            os.chmod(name, 0o644)
+            os.replace(name, self.path(key))
+        except OSError:
+            if name is not None:
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+            return
+        if not self.pruning:
+            return
+        if self.total is None:
+            self.total = self.scan()[1]
+        else:
+            self.total += size
+        if self.total > self.max_bytes:
+            self.evict()
 
-    if avx512_score >= 0.0 and avx2_score >= 0.0 and debug:
-        avx2_avx512_duplicate_cnt +=1
-        print("duplicate count for avx2 & avx512 ?", ins, arg, avx2_avx512_duplicate_cnt)
+    def prune(self) -> None:
+        """Scan the directory once and evict if workers filled it past
+        max_bytes; a directory that cannot be listed is left as it is."""
+        try:
+            scanned = self.scan()
+            self.total = scanned[1]
+            if self.total > self.max_bytes:
+                self.evict(scanned)
+        except OSError:
+            self.total = None
+
+    def scan(self) -> tuple:
+        """(mtime, size, path) of every entry, and their total size.
+
+        Temporary files of runs that died are removed on the way.
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    if now - st.st_mtime > self.stale_seconds:
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                if not entry.name.endswith(".json"):
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return entries, total
+
+    def evict(self, scanned: tuple = None) -> None:
+        entries, total = scanned or self.scan()
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    # another run evicted it first
+                    pass
+                total -= size
+                if total <= self.max_bytes * 3 // 4:
+                    break
+        self.total = total
+
+
+def do_file(filename: str, verbose:int, quiet:int, delete_type:str, use_objdump: bool = False,
+            cache: VerdictCache = None, jobs: int = 1, profile: str = None, hotness: Hotness = None) -> None:
+    global debug
+    global stats
 
-    if not records.should_delete() and quiet != 0:
-        sys.exit(0)
+    records = RecordKeeper(delete_type, weights=hotness.for_file(filename) if hotness is not None else None)
+    weighted = records.weights is not None
+    if profile:
+        stats = FileStats(filename)
 
-    if verbose > 0:
-        print(sse_str,"\t",avx2_str,"\t", avx512_str,"\t", line)
+    if quiet == 0:
+        print("Analyzing", filename)
 
+    # verbose and debug output is objdump's listing, so only plain scoring
+    # runs natively or from the cache, and the cache holds no weighted totals
+    key = None
+    cached = False
+    if cache is not None and verbose == 0 and not debug and not weighted:
+        with phase("cache"):
+            try:
+                key = cache.key(filename)
+                cached = cache.get(key, records)
+            except OSError:
+                key = None
+        if stats is not None:
+            stats.cache = "hit" if cached else "miss"
+
+    # without a type to delete, -q has nothing to judge at all
+    done = cached or quiet != 0 and records.verdict_certain()
+    path = "cache" if cached else "none"
+    if not done:
+        records, path = scan_file(records, filename, verbose, quiet, use_objdump, jobs)
+    # a scan that stopped early leaves partial totals, which are not stored
+    if key is not None and not done and not records.stopped:
+        with phase("cache"):
+            cache.put(key, records)
+    with phase("report"):
+        if quiet <= 0:
+            print_top_functions(records)
+            print()
+            print("File total (SSE): ", records.total_counts["sse"],"instructions with score", round(records.total_scores["sse"]))
+            print("File total (AVX2): ", records.total_counts["avx2"],"instructions with score", round(records.total_scores["avx2"]))
+            print("File total (AVX512): ", records.total_counts["avx512"],"instructions with score", round(records.total_scores["avx512"]))
+            print("File total (APX): ", records.total_counts["apx"],"instructions with score", round(records.total_scores["apx"]))
+            print()
+            if weighted:
+                print_weighted_totals(records)
+                print()
+        if debug and quiet != 0:
+            print("Skipped", records.skipped_bytes, "of", records.code_bytes, "executable bytes")
+        if debug:
+            print("File duplicate count of sse&avx2", sse_avx2_duplicate_cnt, ", duplicate count of avx2&avx512", avx2_avx512_duplicate_cnt)
+
+        if records.should_delete():
+            # counts of a scan that stopped early only cover what was read
+            partial = ("\t (stopped early, %d of %d code bytes not read)" % (records.skipped_bytes, records.code_bytes)
+                       if records.stopped else "")
+            if weighted:
+                print(filename, "\t", delete_type, "weighted count:", ratio(records.weighted_counts[delete_type]), "\t",
+                      delete_type, "weighted value:", ratio(records.weighted_scores[delete_type]), partial)
+            else:
+                print(filename, "\t", delete_type, "count:", records.total_counts[delete_type],"\t", delete_type, "value:", ratio(records.total_scores[delete_type]), partial)
+            try:
+                os.unlink(filename)
+            except:
+                None
+
+    if stats is not None:
+        stats.path = path
+        write_stats(profile, stats.record(records))
+        stats = None
+
+
+def do_compare(base: str, filename: str, verbose: int, quiet: int, delete_type: str, use_objdump: bool = False,
+               jobs: int = 1, hotness: Hotness = None) -> None:
+    """Judge filename, an optimized build of the library base, by what it changes.
+
+    Functions are matched by symbol name.  With a delete type, filename is
+    unlinked when its executable sections are identical to those of base,
+    or when it gains fewer than min_count instructions and no more than
+    min_score of that type over base, weighted by hotness if given.
+    """
+    if quiet == 0:
+        print("Comparing", filename, "with", base)
+
+    try:
+        identical = code_digest(base) == code_digest(filename)
+    except (NativeDecodeError, OSError, ValueError, struct.error):
+        identical = False
+    if identical:
+        if quiet <= 0:
+            print("Executable sections identical to", base)
+            print()
+        gain_count, gain_score = 0, 0.0
+        weighted = False
+    else:
+        weights = {path: hotness.for_file(path) if hotness is not None else None for path in (base, filename)}
+        # both builds are weighted, or neither is
+        weighted = None not in weights.values()
+        if not weighted:
+            weights = dict.fromkeys(weights)
+        old = scan_file(RecordKeeper(delete_type, True, weights[base]), base, verbose, 0, use_objdump, jobs)[0]
+        new = scan_file(RecordKeeper(delete_type, True, weights[filename]), filename, verbose, 0, use_objdump,
+                        jobs)[0]
+        if quiet <= 0:
+            print_function_deltas(old, new)
+            print()
+            for i, set_name in (("sse", "SSE"), ("avx2", "AVX2"), ("avx512", "AVX512"), ("apx", "APX")):
+                print("File delta (%s): " % set_name, "%+d" % (new.total_counts[i] - old.total_counts[i]),
+                      "instructions with score", "%+d" % round(new.total_scores[i] - old.total_scores[i]))
+            if weighted:
+                for i, set_name in (("sse", "SSE"), ("avx2", "AVX2"), ("avx512", "AVX512"), ("apx", "APX")):
+                    print("Weighted delta (%s): " % set_name,
+                          "%+.2f" % (new.weighted_counts[i] - old.weighted_counts[i]), "instructions with score",
+                          "%+.2f" % (new.weighted_scores[i] - old.weighted_scores[i]))
+            print()
+        if delete_type:
+            old_counts, old_scores = old.decision_totals()
+            new_counts, new_scores = new.decision_totals()
+            gain_count = new_counts[delete_type] - old_counts[delete_type]
+            gain_score = new_scores[delete_type] - old_scores[delete_type]
+
+    if delete_type and gain_count < min_count and gain_score <= min_score:
+        print(filename, "\t", delete_type, "count delta:", ratio(gain_count) if weighted else gain_count,
+              "\t", delete_type, "value delta:", ratio(gain_score))
+        try:
+            os.unlink(filename)
+        except:
+            None
 
-def do_file(filename: str, verbose:int, quiet:int, delete_type:str) -> None:
-    global debug
 
-    records = RecordKeeper(delete_type)
+def do_level(filename: str, verbose: int, quiet: int, max_level: int = None, unlink: bool = False,
+             use_objdump: bool = False, jobs: int = 1) -> bool:
+    """Report the x86-64 level filename needs, and the functions needing
+    each level above v1.
 
+    With max_level, a file needing a higher level is listed with the
+    functions that do, and unlinked with unlink set.  Returns whether it
+    was rejected instead.
+    """
     if quiet == 0:
         print("Analyzing", filename)
 
-    p = subprocess.Popen(["objdump","-d", filename], stdout=subprocess.PIPE)
-    for line in p.stdout:
-        process_objdump_line(records, line.decode("latin-1"), verbose, quiet)
-    output, _ =  p.communicate()
-    for line in output.decode("latin-1").splitlines():
-        process_objdump_line(records, line, verbose, quiet)
+    records = scan_file(RecordKeeper("", True), filename, verbose, 0, use_objdump, jobs, True)[0]
+    functions = records.function_records.values()
+    level = max((record.level for record in functions), default=0)
     if quiet <= 0:
-        print_top_functions(records)
+        for i in range(len(levels) - 1, 0, -1):
+            names = [record.name for record in functions if record.level == i]
+            if names:
+                print("Functions needing %s" % levels[i])
+                for name in names:
+                    print("    %s" % name)
+                print()
+        print("File level:", levels[level])
         print()
-        print("File total (SSE): ", records.total_counts["sse"],"instructions with score", round(records.total_scores["sse"]))
-        print("File total (AVX2): ", records.total_counts["avx2"],"instructions with score", round(records.total_scores["avx2"]))
-        print("File total (AVX512): ", records.total_counts["avx512"],"instructions with score", round(records.total_scores["avx512"]))
-        print()
-    if debug:
-        print("File duplicate count of sse&avx2", sse_avx2_duplicate_cnt, ", duplicate count of avx2&avx512", avx2_avx512_duplicate_cnt)
 
-    if records.should_delete():
-        print(filename, "\t", delete_type, "count:", records.total_counts[delete_type],"\t", delete_type, "value:", ratio(records.total_scores[delete_type]))
+    if max_level is None or level <= max_level:
+        return False
+    above = [record for record in functions if record.level > max_level]
+    print(filename, "\t", "level:", levels[level], "\t", "functions above %s:" % levels[max_level], len(above))
+    for record in above:
+        print("    %-30s\t%s" % (record.name, levels[record.level]))
+    if not unlink:
+        return True
+    try:
+        os.unlink(filename)
+    except:
+        None
+    return False
+
+
+def print_weighted_totals(records: RecordKeeper) -> None:
+    """The file totals with each function weighted by its hotness."""
+    for i, set_name in (("sse", "SSE"), ("avx2", "AVX2"), ("avx512", "AVX512"), ("apx", "APX")):
+        print("Weighted total (%s): " % set_name, ratio(records.weighted_counts[i]), "instructions with score",
+              ratio(records.weighted_scores[i]))
+
+
+def print_function_deltas(old: RecordKeeper, new: RecordKeeper) -> None:
+    """The functions whose counts differ between two builds, most changed score first."""
+    isas = ("sse", "avx2", "avx512", "apx")
+    empty = FunctionRecord()
+    deltas = []
+    names = list(new.function_records) + [name for name in old.function_records if name not in new.function_records]
+    for name in names:
+        before = old.function_records.get(name, empty)
+        after = new.function_records.get(name, empty)
+        counts = [after.counts[i] - before.counts[i] for i in isas]
+        scores = [after.scores[i] - before.scores[i] for i in isas]
+        if not any(counts) and not any(scores):
+            continue
+        if name not in old.function_records:
+            change = "added"
+        elif name not in new.function_records:
+            change = "removed"
+        else:
+            change = "changed"
+        deltas.append((sum(abs(score) for score in scores), name, change, counts, scores))
+
+    print("Functions changed from the base build: count deltas, then score deltas (SSE, AVX2, AVX512, APX)")
+    for weight, name, change, counts, scores in sorted(deltas, key=lambda delta: delta[0], reverse=True):
+        print("    %-30s\t%s" % (name, change),
+              "\t", "\t".join("%+d" % count for count in counts),
+              "\t", "\t".join("%+.2f" % score for score in scores))
+
+
+def scan_file(records: RecordKeeper, filename: str, verbose: int, judge_quiet: int, use_objdump: bool,
+              jobs: int, whole: bool = False) -> tuple:
+    """Score filename into records, natively or from objdump's listing.
+
+    With judge_quiet set it stops once the verdict is certain.  With whole
+    set, the last block is finalized too.  Returns the records, new ones if
+    the native decoder gave up on the file, and the path that scored them.
+    """
+    if verbose == 0 and not debug and not use_objdump:
         try:
-            os.unlink(filename)
-        except:
-            None
+            process_native(records, filename, judge_quiet, whole)
+            return records, "native"
+        except (NativeDecodeError, OSError, ValueError):
+            records = RecordKeeper(records.delete_type, records.function_records is not None, records.weights)
+
+    # the listing itself is verbose and debug output, so only plain
+    # scoring splits it into ranges, and only with CPUs to run them on
+    jobs = min(jobs, len(os.sched_getaffinity(0)))
+    split = jobs > 1 and verbose == 0 and not debug
+    blocks = _listed_blocks(filename) if judge_quiet != 0 or split else None
+    remaining, last, after = _code_after(blocks)
+    if judge_quiet != 0:
+        records.code_bytes = remaining or 0
+    ranges = _code_ranges(blocks, jobs * 4) if split and (remaining or 0) >= range_min_bytes else []
+    if len(ranges) > 1:
+        with phase("listing"):
+            process_objdump_ranges(records, filename, ranges, jobs, judge_quiet, after, last)
+        path = "ranges"
+    else:
+        lines = 0
+        with phase("listing"), subprocess.Popen(["objdump", "-d", filename], stdout=subprocess.PIPE) as p:
+            for lines, line in enumerate(p.stdout, 1):
+                process_objdump_line(records, line, verbose)
+                if judge_quiet == 0:
+                    continue
+                # totals only change at the blank line ending a block
+                if line == b"\n":
+                    counted = None if remaining is None else max(remaining - last, 0)
+                    if records.verdict_certain(counted):
+                        records.skipped_bytes = remaining or 0
+                        # only the last block, never scored, may be left
+                        records.stopped = counted != 0
+                        p.kill()
+                        break
+                elif line.endswith(b">:\n") and line[:1] != b" ":
+                    remaining = after.get(int(line.split(b" ", 1)[0], 16))
+        if stats is not None:
+            stats.lines += lines
+        path = "objdump"
+    if whole and records.function_record.instructions > 0:
+        records.finalize_function_attrs()
+        records.function_record = FunctionRecord()
+    return records, path
+
+
+def write_stats(profile: str, entry: dict) -> None:
+    """Append entry as one JSON line to profile, or to stderr for "-"."""
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    if profile == "-":
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return
+    # one write per line in append mode, so parallel runs do not interleave
+    fd = os.open(profile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def judge_file(filename: str, verbose: int, quiet: int, delete_type: str, use_objdump: bool,
+               cache: VerdictCache, profile: str, base: str = None, hotness: Hotness = None,
+               level: tuple = None) -> tuple:
+    """Run do_file, do_compare against base, or with level set to its
+    (max_level, unlink) do_level, in a worker.
+
+    Returns everything it printed and whether the file was rejected.
+    """
+    global sse_avx2_duplicate_cnt
+    global avx2_avx512_duplicate_cnt
 
+    sse_avx2_duplicate_cnt = 0
+    avx2_avx512_duplicate_cnt = 0
+    output = io.StringIO()
+    rejected = False
+    with contextlib.redirect_stdout(output):
+        if level is not None:
+            rejected = do_level(filename, verbose, quiet, *level, use_objdump)
+        elif base:
+            do_compare(base, filename, verbose, quiet, delete_type, use_objdump, hotness=hotness)
+        else:
+            do_file(filename, verbose, quiet, delete_type, use_objdump, cache, profile=profile, hotness=hotness)
+    return output.getvalue(), rejected
 
-def main():
-    global debug
 
-    verbose = 0
-    quiet = 0
+def is_elf(filename: str) -> bool:
+    try:
+        with open(filename, "rb") as f:
+            return f.read(4) == b"\x7fELF"
+    except OSError:
+        return False
+
+
+def expand_paths(paths: list) -> list:
+    """Files to judge: each file as given, and the ELF files under each directory."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                filename = os.path.join(root, name)
+                if not os.path.islink(filename) and os.path.isfile(filename) and is_elf(filename):
+                    files.append(filename)
+    return files
+
+
+def do_files(filenames: list, verbose: int, quiet: int, delete_type: str, use_objdump: bool, jobs: int,
+             cache: VerdictCache = None, profile: str = None, hotness: Hotness = None, level: tuple = None) -> bool:
+    """Judge filenames on a pool of jobs workers, reporting in the given order.
+
+    Like make -k, a file that cannot be judged or is rejected by do_level
+    does not stop the others; returns whether any failed.
+    """
+    if len(filenames) == 1:
+        if level is not None:
+            return do_level(filenames[0], verbose, quiet, *level, use_objdump, jobs)
+        do_file(filenames[0], verbose, quiet, delete_type, use_objdump, cache, jobs, profile, hotness)
+        return False
+
+    failed = False
+    worker_cache = cache.for_workers() if cache is not None else None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(judge_file, filename, verbose, quiet, delete_type, use_objdump, worker_cache,
+                                   profile, hotness=hotness, level=level)
+                   for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                output, rejected = future.result()
+                sys.stdout.write(output)
+                failed = failed or rejected
+            except Exception as e:
+                print("avxjudge:", filename + ":", e, file=sys.stderr)
+                failed = True
+            sys.stdout.flush()
+    if cache is not None:
+        cache.prune()
+    return failed
+
+
+def _parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
     parser.add_argument("-q", "--quiet", help="decrease output verbosity", action="store_true")
     parser.add_argument("-d", "--debug", help="print out more debug info", action="store_true")
-    parser.add_argument("filename", help = "The filename to inspect")
+    parser.add_argument("--objdump", help="always disassemble with objdump instead of the built-in decoder", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of files, or parts of one file, to judge in parallel (default: all CPUs)", type=int,
+                        default=len(os.sched_getaffinity(0)))
+    parser.add_argument("--cache", help="directory of cached verdicts to reuse for identical files "
+                        "(default: $AVXJUDGE_CACHE, none if unset)", default=os.environ.get("AVXJUDGE_CACHE"))
+    parser.add_argument("--cache-size", help="size limit of the cache directory in MiB (default: 256)", type=int,
+                        default=256)
+    parser.add_argument("--profile", metavar="FILE", help="append time per phase and work done for each file "
+                        "to FILE as one JSON object per line ('-' for stderr)")
+    parser.add_argument("--base", metavar="FILE", help="judge the one file given, an optimized build, by the "
+                        "functions it changes from FILE, the same library built for the baseline; with -1, -2, -5 "
+                        "or -a it is unlinked if its code is identical or gains too little of that type")
+    parser.add_argument("--hotness", metavar="FILE", help="weight each function's counts and scores by its "
+                        "share of the run profiled in FILE, the output of perf report --stdio or perf script, or "
+                        "'symbol weight' lines, and judge -1, -2, -5 and -a by the weighted totals; a file the profile "
+                        "has no samples for is judged unweighted")
+    parser.add_argument("--level", help="instead of scoring, report the x86-64 level (v1 to v4, or apx for "
+                        "the apx build type) each file and each function in it needs", action="store_true")
+    parser.add_argument("--max-level", metavar="LEVEL", choices=levels, help="with --level, list the files "
+                        "needing a higher level than LEVEL with the functions that do, and fail")
+    parser.add_argument("--unlink-above", help="with --max-level, unlink those files instead of failing",
+                        action="store_true")
+    parser.add_argument("--serve", metavar="SOCKET", help="instead of judging files, judge the requests of "
+                        "avxjudge-client.py on the Unix socket SOCKET with -j workers until terminated")
+    parser.add_argument("filenames", help = "The files to inspect, or directories to search for ELF files", nargs="*")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-1", "--unlinksse", help="unlink the file if it has no SSE instructions", action="store_true")
     group.add_argument("-2", "--unlinkavx2", help="unlink the file if it has no AVX2 instructions", action="store_true")
     group.add_argument("-5", "--unlinkavx512", help="unlink the file if it has no AVX512 instructions", action="store_true")
+    group.add_argument("-a", "--unlinkapx", help="unlink the file if it has no APX instructions", action="store_true")
+    return parser
 
-    args = parser.parse_args()
+
+def _options(args: argparse.Namespace) -> tuple:
+    """(verbose, quiet, delete type) from the parsed command line."""
+    verbose = 0
+    quiet = 0
     if args.verbose:
         verbose = 1
 
@@ -328,19 +2288,236 @@ def main():
         verbose = 0
         quiet = 1
 
-    if args.debug:
-        debug = 1
-
     if args.unlinksse:
         deltype = "sse"
     elif args.unlinkavx2:
         deltype = "avx2"
     elif args.unlinkavx512:
         deltype = "avx512"
+    elif args.unlinkapx:
+        deltype = "apx"
     else:
         deltype = ""
+    return verbose, quiet, deltype
+
+
+def _check(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Reject the combinations of arguments that make no sense."""
+    if args.base and (len(args.filenames) != 1 or os.path.isdir(args.filenames[0])):
+        parser.error("argument --base: compares exactly one file")
+    if args.max_level and not args.level:
+        parser.error("argument --max-level: only with --level")
+    if args.unlink_above and not args.max_level:
+        parser.error("argument --unlink-above: only with --max-level")
+    if args.level and args.base:
+        parser.error("argument --level: not allowed with argument --base")
+
+
+def _level(args: argparse.Namespace) -> tuple:
+    """do_level's (max_level, unlink) for --level, None without it."""
+    if not args.level:
+        return None
+    return levels.index(args.max_level) if args.max_level else None, args.unlink_above
+
+
+def _hotness(parser: argparse.ArgumentParser, filename: str) -> Hotness:
+    """The --hotness profile, None without one."""
+    if not filename:
+        return None
+    try:
+        return Hotness(filename)
+    except OSError as e:
+        parser.error("argument --hotness: %s" % e)
+
+
+def _client_request(cwd: str, argv: list, cache_dir: str) -> tuple:
+    """Parse a client's command line in its directory, as main would.
+
+    Returns the arguments for _client_file and the files to judge, or None
+    and what argparse printed with its exit status.
+    """
+    os.chdir(cwd)
+    parser = _parser()
+    parser.set_defaults(cache=cache_dir)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            args = parser.parse_args(argv)
+            if args.serve:
+                parser.error("argument --serve: not allowed in a request")
+            if not args.filenames:
+                parser.error("the following arguments are required: filenames")
+            _check(parser, args)
+            hotness = _hotness(parser, args.hotness)
+    except SystemExit as e:
+        return None, output.getvalue(), e.code or 0
+    verbose, quiet, deltype = _options(args)
+    cache = None
+    if args.cache:
+        cache = VerdictCache(args.cache, args.cache_size << 20).for_workers()
+    request = (verbose, quiet, deltype, args.objdump, cache, args.profile, int(args.debug), args.base, hotness,
+               _level(args))
+    return request, expand_paths(args.filenames), 0
+
+
+def _client_file(cwd: str, filename: str, verbose: int, quiet: int, delete_type: str, use_objdump: bool,
+                 cache: VerdictCache, profile: str, debug_level: int, base: str, hotness: Hotness,
+                 level: tuple) -> tuple:
+    """judge_file for a client, with its directory and -d."""
+    global debug
+
+    os.chdir(cwd)
+    debug = debug_level
+    return judge_file(filename, verbose, quiet, delete_type, use_objdump, cache, profile, base, hotness, level)
+
+
+class JudgeHandler(socketserver.StreamRequestHandler):
+    """One client connection.
+
+    The client sends one JSON line {"cwd": ..., "argv": [...], "cache": ...},
+    with its working directory, its avxjudge.py arguments and its
+    $AVXJUDGE_CACHE.  The reply is JSON lines {"stdout": text} and
+    {"stderr": text} in the order avxjudge.py would print them, ending with
+    {"status": exit status}.  Only the user running the server, and root,
+    are served, since requests unlink files with the server's privileges.
+    """
+    def reply(self, kind: str, value) -> None:
+        self.wfile.write(json.dumps({kind: value}).encode() + b"\n")
+        self.wfile.flush()
+
+    def peer_allowed(self) -> bool:
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        return uid in (0, os.getuid())
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+            cwd, argv, cache_dir = request["cwd"], request["argv"], request.get("cache")
+        except (ValueError, KeyError, TypeError):
+            return
+        try:
+            if not self.peer_allowed():
+                self.reply("stderr", "avxjudge: permission denied\n")
+                self.reply("status", 1)
+                return
+        except OSError:
+            return
+        executor = self.server.executor
+        futures = []
+        try:
+            try:
+                options, files, status = executor.submit(_client_request, cwd, argv, cache_dir).result()
+            except Exception as e:
+                self.reply("stderr", "avxjudge: %s\n" % e)
+                self.reply("status", 1)
+                return
+            if options is None:
+                if files:
+                    self.reply("stderr" if status else "stdout", files)
+                self.reply("status", status)
+                return
+
+            futures = [executor.submit(_client_file, cwd, filename, *options) for filename in files]
+            status = 0
+            for filename, future in zip(files, futures):
+                try:
+                    output, rejected = future.result()
+                    self.reply("stdout", output)
+                    if rejected:
+                        status = 1
+                except OSError:
+                    raise
+                except Exception as e:
+                    self.reply("stderr", "avxjudge: %s: %s\n" % (filename, e))
+                    status = 1
+            # the request's cache is the workers' copy
+            cache = options[4]
+            if cache is not None:
+                cache.prune()
+            self.reply("status", status)
+        except OSError:
+            # the client went away; what it asked for is no longer wanted
+            for future in futures:
+                future.cancel()
+
+
+class JudgeServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, executor: concurrent.futures.Executor):
+        self.executor = executor
+        super().__init__(path, JudgeHandler)
+
+
+def serve(path: str, jobs: int) -> None:
+    """Judge avxjudge-client.py requests on the Unix socket path until terminated.
+
+    The scoring tables are built once and the memoized classifications
+    persist in the jobs workers, which judge the files of all connected
+    clients concurrently.
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            sys.exit("avxjudge: %s: a server is already listening" % path)
+        finally:
+            probe.close()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        # start every worker now, so they fork before there are any threads
+        for future in [executor.submit(os.getpid) for _ in range(max(jobs, 1))]:
+            future.result()
+        # the socket is only for this user: requests unlink files
+        umask = os.umask(0o177)
+        try:
+            server = JudgeServer(path, executor)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        with server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(path)
+
+
+def main():
+    global debug
+
+    parser = _parser()
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.jobs)
+        return
+    if not args.filenames:
+        parser.error("the following arguments are required: filenames")
+
+    _check(parser, args)
+
+    verbose, quiet, deltype = _options(args)
+    if args.debug:
+        debug = 1
+    hotness = _hotness(parser, args.hotness)
+
+    if args.base:
+        do_compare(args.base, args.filenames[0], verbose, quiet, deltype, args.objdump, args.jobs, hotness)
+        return
+
+    cache = None
+    if args.cache:
+        cache = VerdictCache(args.cache, args.cache_size << 20)
 
-    do_file(args.filename, verbose, quiet, deltype)
+    if do_files(expand_paths(args.filenames), verbose, quiet, deltype, args.objdump, args.jobs, cache,
+                args.profile, hotness, _level(args)):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -95,3 +95,229 @@ function test_run() {
 test_run 2
 test_run 512
 test_run a
+
+# A file that cannot be opened, as one without read permission is for
+# anyone but root, is listed as not elf and the rest of the scan goes on
+function test_unreadable() {
+    local builddir=$(mktemp -d -p "${OUTDIR2}")
+
+    mkdir -p "${builddir}/usr/bin" "${builddir}/usr/lib64/sub"
+    echo -n -e \\x7f\\x45\\x4c\\x46\\xff > "${builddir}/usr/bin/aaa"
+    echo -n -e \\x7f\\x45\\x4c\\x46\\xff > "${builddir}/usr/bin/bfile"
+    echo -n -e \\x7f\\x45\\x4c\\x46\\xff > "${builddir}/usr/lib64/sub/lfile"
+    chmod 000 "${builddir}/usr/bin/aaa"
+
+    python3 - "${builddir}" > "${OUTDIR2}/scan" <<PYEOF
+import importlib.util
+import os
+import sys
+
+spec = importlib.util.spec_from_file_location("elf_move", "elf-move.py")
+elf_move = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(elf_move)
+real_open = os.open
+
+def deny_open(path, *args, **kwargs):
+    if os.path.basename(path) == 'aaa':
+        raise PermissionError(13, 'Permission denied', path)
+    return real_open(path, *args, **kwargs)
+
+elf_move.os.open = deny_open
+for path, elf in elf_move.walk_install(sys.argv[1] + '/'):
+    print(path.removeprefix(sys.argv[1] + '/'), elf)
+PYEOF
+
+    grep -qx "usr/bin/aaa False" "${OUTDIR2}/scan"
+    grep -qx "usr/bin/bfile True" "${OUTDIR2}/scan"
+    grep -qx "usr/lib64/sub/lfile True" "${OUTDIR2}/scan"
+}
+
+test_unreadable
+
+# Runs elf-move.py; with EXDEV=1 renames out of the installdir fail as
+# they do across filesystems, for hosts without a second one to build on
+function elf_move() {
+    if [ "${EXDEV:-0}" = 1 ]; then
+        python3 - "$@" <<PYEOF
+import errno
+import os
+import runpy
+import sys
+
+real_rename = os.rename
+
+def rename(src, dst):
+    if src.startswith(sys.argv[2]):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src)
+    real_rename(src, dst)
+
+os.rename = rename
+sys.argv = ['elf-move.py'] + sys.argv[1:]
+runpy.run_path('elf-move.py', run_name='__main__')
+PYEOF
+    else
+        python3 elf-move.py "$@"
+    fi
+}
+
+# Files moved across filesystems are copied with their mode and
+# timestamps, and hard links stay linked
+function test_cross_fs() {
+    local builddir
+    local outdir=$(mktemp -d -p "${OUTDIR2}")
+    local exdev=1
+    if [ -d /dev/shm ] && [ -w /dev/shm ]; then
+        builddir=$(mktemp -d -p /dev/shm)
+        if [ "$(stat -c %d "${builddir}")" != "$(stat -c %d "${outdir}")" ]; then
+            exdev=0
+        fi
+    else
+        builddir=$(mktemp -d -p "${OUTDIR2}")
+    fi
+    local bindir="${builddir}/usr/bin"
+    local obindir="${outdir}/V3/usr/bin"
+
+    mkdir -p "${bindir}"
+    head -c 100000 /dev/urandom > "${bindir}/big"
+    printf '\x7fELF' | dd of="${bindir}/big" conv=notrunc status=none
+    chmod 751 "${bindir}/big"
+    touch -d '2001-02-03 04:05:06' "${bindir}/big"
+    ln "${bindir}/big" "${bindir}/big2"
+    local hash=$(sha256sum < "${bindir}/big")
+
+    EXDEV=${exdev} elf_move avx2 "${builddir}" "${outdir}" -v > "${outdir}/out"
+    rm -fr "${builddir}"
+
+    [ "$(sha256sum < "${obindir}/big")" = "${hash}" ]
+    [ "$(stat -c %a "${obindir}/big")" = 751 ]
+    [ "$(stat -c %Y "${obindir}/big")" = "$(date -d '2001-02-03 04:05:06' +%s)" ]
+    [ "$(stat -c %i "${obindir}/big")" = "$(stat -c %i "${obindir}/big2")" ]
+    [ ! -e "${obindir}/.big.elf-move" ]
+    grep -q "^Moved .*hardlink 1 files 100000 bytes" "${outdir}/out"
+    ! grep -q "rename" "${outdir}/out"
+}
+
+test_cross_fs
+
+# With --judge, elf files with too few AVX2 instructions are deleted
+# instead of installed, and --path files are installed unjudged
+function test_judge() {
+    local builddir=$(mktemp -d -p "${OUTDIR2}")
+    local outdir=$(mktemp -d -p "${OUTDIR2}")
+    local libdir="${builddir}/usr/lib64"
+    local olibdir="${outdir}/V3/usr/lib64"
+
+    mkdir -p "${libdir}"
+    cat > "${builddir}/vector.c" <<CEOF
+void add(float *a, float *b, int n) { for (int i = 0; i < n; i++) a[i] += b[i] * 2.0f; }
+CEOF
+    cat > "${builddir}/scalar.c" <<CEOF
+int add(int a, int b) { return a + b; }
+CEOF
+    gcc -O3 -mavx2 -mfma -shared -fPIC -o "${libdir}/libvector.so" "${builddir}/vector.c"
+    gcc -O2 -shared -fPIC -o "${libdir}/libscalar.so" "${builddir}/scalar.c"
+    cp "${libdir}/libscalar.so" "${libdir}/libforced.so"
+    rm "${builddir}/vector.c" "${builddir}/scalar.c"
+
+    python3 elf-move.py avx2 "${builddir}" "${outdir}" --judge -j 2 \
+            --path /usr/lib64/libforced.so > "${outdir}/out"
+
+    [ -f "${olibdir}/libvector.so" ]
+    [ ! -e "${olibdir}/libscalar.so" ]
+    [ ! -e "${libdir}/libscalar.so" ]
+    [ -f "${olibdir}/libforced.so" ]
+    grep -q "^Judged elf files: kept 1 files [0-9]* bytes, dropped 1 files [0-9]* bytes$" "${outdir}/out"
+}
+
+test_judge
+
+# The filemap lists each elf file installed, at its installed path and
+# with the hash of its content, and filemap-verify.py accepts it; with
+# EXDEV=1 the hashes come from the copies and their hard links
+function test_filemap() {
+    local exdev=$1
+    local builddir=$(mktemp -d -p "${OUTDIR2}")
+    local outdir=$(mktemp -d -p "${OUTDIR2}")
+    local fmdir=$(mktemp -d -p "${OUTDIR2}")
+
+    mkdir -p "${builddir}/bin" "${builddir}/usr/lib64" "${builddir}/usr/share"
+    echo -n -e \\x7f\\x45\\x4c\\x46\\x01 > "${builddir}/bin/bfile"
+    echo -n -e \\x7f\\x45\\x4c\\x46\\x02 > "${builddir}/usr/lib64/lfile"
+    ln "${builddir}/usr/lib64/lfile" "${builddir}/usr/lib64/lfile2"
+    echo text > "${builddir}/usr/share/data"
+    local bhash=$(echo -n -e \\x7f\\x45\\x4c\\x46\\x01 | sha256sum | cut -d' ' -f1)
+    local lhash=$(echo -n -e \\x7f\\x45\\x4c\\x46\\x02 | sha256sum | cut -d' ' -f1)
+
+    EXDEV=${exdev} elf_move avx2 "${builddir}" "${outdir}" "${fmdir}/filemap-test" > /dev/null
+
+    [ "$(stat -c %a "${fmdir}/filemap-test")" = 644 ]
+    [ "$(wc -l < "${fmdir}/filemap-test")" = 9 ]
+    printf "avx2\n/usr/bin/bfile\n%s\n" "${bhash}" > "${fmdir}/expected"
+    grep -B1 -A1 -x /usr/bin/bfile "${fmdir}/filemap-test" | cmp - "${fmdir}/expected"
+    printf "avx2\n/usr/lib64/lfile\n%s\n" "${lhash}" > "${fmdir}/expected"
+    grep -B1 -A1 -x /usr/lib64/lfile "${fmdir}/filemap-test" | cmp - "${fmdir}/expected"
+    printf "avx2\n/usr/lib64/lfile2\n%s\n" "${lhash}" > "${fmdir}/expected"
+    grep -B1 -A1 -x /usr/lib64/lfile2 "${fmdir}/filemap-test" | cmp - "${fmdir}/expected"
+    rm "${fmdir}/expected"
+
+    python3 filemap-verify.py -f "${fmdir}" -o "${outdir}" > "${builddir}/out"
+    grep -qx "V3/usr/bin/bfile -> /usr/bin/bfile:avx2" "${builddir}/out"
+    grep -qx "V3/usr/lib64/lfile2 -> /usr/lib64/lfile2:avx2" "${builddir}/out"
+}
+
+test_filemap 0
+test_filemap 1
+
+# --libsubdir and --plugin-suffix lay files out as clr-avx2-move.pl does,
+# reporting a file that cannot be moved and moving the others
+function test_layout() {
+    local workdir=$(mktemp -d -p "${OUTDIR2}")
+    local root="${workdir}/root"
+
+    mkdir -p "${root}/usr/bin" "${root}/usr/lib64/sub" "${root}/usr/lib64/haswell" "${root}/usr/share"
+    echo 'int main(void) { return 0; }' > "${workdir}/prog.c"
+    echo 'int foo(void) { return 1; }' > "${workdir}/lib.c"
+    gcc -o "${root}/usr/bin/prog" "${workdir}/prog.c"
+    gcc -shared -fPIC -Wl,-soname,libfoo.so.1 -o "${root}/usr/lib64/libfoo.so.1" "${workdir}/lib.c"
+    ln -s libfoo.so.1 "${root}/usr/lib64/libfoo.so"
+    gcc -shared -fPIC -o "${root}/usr/lib64/plugin.so" "${workdir}/lib.c"
+    cp "${root}/usr/lib64/libfoo.so.1" "${root}/usr/lib64/libskip.so.1"
+    cp "${root}/usr/lib64/libfoo.so.1" "${root}/usr/lib64/sub/libblocked.so.1"
+    # the libsubdir of sub cannot be made
+    touch "${root}/usr/lib64/sub/haswell"
+    cp "${root}/usr/lib64/libfoo.so.1" "${root}/usr/lib64/haswell/libdone.so.1"
+    cp "${root}/usr/lib64/libfoo.so.1" "${root}/usr/share/libdata.so"
+    echo '#!/bin/sh' > "${root}/usr/bin/script"
+    chmod +x "${root}/usr/bin/script"
+    rm "${workdir}/prog.c" "${workdir}/lib.c"
+    cp -a "${root}" "${workdir}/perl"
+
+    python3 elf-move.py avx2 "${root}" "${root}" "${workdir}/filemap" --libsubdir haswell \
+            --plugin-suffix .avx2 --skip-path /usr/lib64/libskip.so.1 \
+            > "${workdir}/out" 2> "${workdir}/err"
+
+    [ -f "${root}/usr/bin/haswell/prog" ]
+    [ -f "${root}/usr/lib64/haswell/libfoo.so.1" ]
+    [ "$(readlink "${root}/usr/lib64/haswell/libfoo.so")" = libfoo.so.1 ]
+    [ -f "${root}/usr/lib64/plugin.so.avx2" ]
+    [ -f "${root}/usr/lib64/libskip.so.1" ]
+    [ -f "${root}/usr/lib64/sub/libblocked.so.1" ]
+    grep -q "^${root}/usr/lib64/sub/libblocked.so.1 -> ${root}/usr/lib64/sub/haswell/libblocked.so.1: " \
+         "${workdir}/err"
+    grep -qx "${root}/usr/lib64/plugin.so -> ${root}/usr/lib64/plugin.so.avx2" "${workdir}/out"
+    ! grep -q "libblocked" "${workdir}/out"
+
+    # the filemap has the installed paths of the files, not of symlinks
+    grep -qx /usr/lib64/haswell/libfoo.so.1 "${workdir}/filemap"
+    grep -qx /usr/lib64/plugin.so.avx2 "${workdir}/filemap"
+    grep -qx /usr/bin/haswell/prog "${workdir}/filemap"
+    [ "$(wc -l < "${workdir}/filemap")" = 9 ]
+
+    # the same tree as the script leaves, but for the skipped file
+    perl clr-avx2-move.pl haswell .avx2 "${workdir}/perl" > /dev/null 2>&1
+    mv "${workdir}/perl/usr/lib64/haswell/libskip.so.1" "${workdir}/perl/usr/lib64/"
+    diff <(cd "${root}" && find . -printf '%p %y\n' | sort) \
+         <(cd "${workdir}/perl" && find . -printf '%p %y\n' | sort)
+}
+
+test_layout
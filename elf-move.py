@@ -1,11 +1,49 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import errno
+import fcntl
+import hashlib
+import importlib.util
 import itertools
+import mmap
 import os
+import re
+import shutil
+import stat
+import struct
 import sys
+import tempfile
 from collections import OrderedDict
 
+ELF_MAGIC = b'\x7fELF'
+
+# ioctl sharing the extents of one file with another on the same
+# filesystem (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Where make install puts avxjudge.py
+AVXJUDGE_DATADIR = '/usr/share/clr-avx-tools'
+
+# avxjudge.py, once --judge loads it
+avxjudge = None
+
+# ELF header fields read by elf_info
+ET_EXEC = 2
+ET_DYN = 3
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_SONAME = 14
+
+# Directories clr-avx2-move.pl took executables from, and the one it took
+# libraries from, recursively
+LAYOUT_BIN_DIRS = ('/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin',
+                   '/usr/local/sbin')
+LAYOUT_LIB_DIR = '/usr/lib64'
+LAYOUT_LIB_NAME = re.compile(r'\.so($|\.(?!avx))')
+
 
 def setup_parser():
     """Create commandline argument parser."""
@@ -18,7 +56,7 @@ def setup_parser():
     parser.add_argument("targetdir", help="Target directory for output")
 
     parser.add_argument("outfile", nargs='?', default="",
-                        help="Deprecated: unused")
+                        help="Filemap to write for the installed files")
 
     parser.add_argument("-s", "--skip", action="store_true",
                         default=False,
@@ -36,50 +74,603 @@ def setup_parser():
                         action="append",
                         help="Handle path regardless of file type (overrides skip)")
 
+    parser.add_argument("--judge", action="store_true", default=False,
+                        help="Judge each elf file with avxjudge while "
+                        "scanning and delete those with too few instructions "
+                        "of the btype instead of installing them")
+
+    parser.add_argument("--avxjudge", default=None,
+                        help="avxjudge.py to judge with (default: the one "
+                        f"next to this script, or in {AVXJUDGE_DATADIR})")
+
+    parser.add_argument("--libsubdir", default=None,
+                        help="Instead of installing into V3/V4/VA, move "
+                        "libraries and executables to this subdirectory of "
+                        "their directory and plugins to their name with "
+                        "--plugin-suffix, as clr-avx2-move.pl did; "
+                        "targetdir is usually the installdir then")
+
+    parser.add_argument("--plugin-suffix", default=None,
+                        help="Suffix of plugins moved with --libsubdir")
+
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of threads scanning the installdir and "
+                        "copying files across filesystems "
+                        "(default: a few more than the CPUs)")
+
     return parser
 
 
-def process_install(args):
+def scan_directory(path, links=False):
+    """List one directory of the installdir.
+
+    Returns the files in it as (path, elf) pairs, in directory order and
+    leaving out symlinks and setuid files, and its subdirectories.
+    Subdirectories that are symlinks are not followed, as os.walk does not.
+    The DirEntry type and stat are reused, and only regular files big
+    enough to hold the ELF magic are opened, to read just that; one that
+    cannot be opened or read is listed as not ELF.  With links
+    set, symlinks to files are listed as what they point to, and setuid
+    files are listed too.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    if entry.is_symlink() and not links:
+                        continue
+                    st = entry.stat(follow_symlinks=links)
+                except OSError:
+                    continue
+                if st.st_mode & stat.S_ISUID != 0 and not links:
+                    continue
+                elf = False
+                if stat.S_ISREG(st.st_mode) and st.st_size >= len(ELF_MAGIC):
+                    try:
+                        fd = os.open(entry.path, os.O_RDONLY)
+                        try:
+                            elf = os.read(fd, len(ELF_MAGIC)) == ELF_MAGIC
+                        finally:
+                            os.close(fd)
+                    except OSError:
+                        pass
+                files.append((entry.path, elf))
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def walk_install(installdir, jobs=None, found=None, links=False):
+    """Yield (path, elf) for the files under installdir, in os.walk order.
+
+    Directories are listed on a pool of jobs threads as they are found,
+    and found, if given, is called with the path and elf flag of each file
+    as soon as its directory is listed.  links is passed on to
+    scan_directory.
+    """
+    listings = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(scan_directory, installdir, links): installdir}
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                listings[path] = future.result()
+                if found is not None:
+                    for filepath, elf in listings[path][0]:
+                        found(filepath, elf)
+                for subdir in listings[path][1]:
+                    pending[executor.submit(scan_directory, subdir, links)] = subdir
+
+    stack = [installdir]
+    while stack:
+        files, subdirs = listings.pop(stack.pop())
+        yield from files
+        stack.extend(reversed(subdirs))
+
+
+def copy_data(src, dst, size):
+    """Copy size bytes from the file src to dst without reading them into
+    Python when the kernel can.
+
+    Returns the strategy that did: reflink, copy_file_range, sendfile or
+    copy.
+    """
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except OSError:
+        pass
+    for strategy in ('copy_file_range', 'sendfile'):
+        offset = 0
+        try:
+            while offset < size:
+                if strategy == 'copy_file_range':
+                    done = os.copy_file_range(src.fileno(), dst.fileno(),
+                                              size - offset, offset, offset)
+                else:
+                    done = os.sendfile(dst.fileno(), src.fileno(), offset,
+                                       size - offset)
+                if done == 0:
+                    break
+                offset += done
+            return strategy
+        except OSError as e:
+            if offset or e.errno not in (errno.EXDEV, errno.ENOSYS,
+                                         errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    src.seek(0)
+    shutil.copyfileobj(src, dst)
+    return 'copy'
+
+
+def hash_file(path):
+    """Hex sha256 of the contents of path, hashed from a mapping of it."""
+    with open(path, 'rb') as ifile:
+        if os.fstat(ifile.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+
+def copy_file(source, dest, size):
+    """Copy source to dest with its permissions and timestamps, then remove
+    source.
+
+    The copy is written next to dest and renamed over it, so dest never
+    holds part of a file.  Returns the strategy copy_data used.
+    """
+    tmp = os.path.join(os.path.dirname(dest),
+                       f".{os.path.basename(dest)}.elf-move")
+    try:
+        with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+            strategy = copy_data(src, dst, size)
+        shutil.copystat(source, tmp)
+        os.rename(tmp, dest)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    os.unlink(source)
+    return strategy
+
+
+def copy_and_hash(source, dest, size):
+    """copy_file, then hash_file of the copy."""
+    return copy_file(source, dest, size), hash_file(dest)
+
+
+class Mover:
+    """Move files into targetdir, across filesystems if need be.
+
+    A rename is tried first.  When source and dest are on different
+    filesystems the file is copied on a pool of threads instead, and a
+    file with several hard links is copied once and the other links to it
+    are linked to the copy.  Counts and bytes are kept per strategy.  With
+    hashing set, every file moved is also hashed on the pool once it is in
+    place, for the filemap.
+    """
+
+    def __init__(self, jobs=None, hashing=False):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.hashing = hashing
+        self.copies = []
+        self.links = []
+        # (st_dev, st_ino) -> dest of the first link of a file being copied
+        self.copied = {}
+        # dest -> future of its hash, or dest it is a link to
+        self.hashes = OrderedDict()
+        self.stats = OrderedDict()
+        # dests finish could not copy or link, with on_error
+        self.failed = set()
+
+    def count(self, strategy, size):
+        entry = self.stats.setdefault(strategy, [0, 0])
+        entry[0] += 1
+        entry[1] += size
+
+    def move(self, source, dest):
+        """Move source to dest, or start copying it.
+
+        Symlinks are moved as they are and never hashed.
+        """
+        st = os.lstat(source)
+        symlink = stat.S_ISLNK(st.st_mode)
+        try:
+            os.rename(source, dest)
+            self.count('rename', st.st_size)
+            if self.hashing and not symlink:
+                self.hashes[dest] = self.executor.submit(hash_file, dest)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        if symlink:
+            if os.path.lexists(dest):
+                os.unlink(dest)
+            os.symlink(os.readlink(source), dest)
+            os.unlink(source)
+            self.count('symlink', st.st_size)
+            return
+        # the copy of another link may already have removed its source,
+        # so the link count alone does not tell
+        first = self.copied.get((st.st_dev, st.st_ino))
+        if first is not None:
+            self.links.append((source, dest, first, st.st_size))
+            if self.hashing:
+                self.hashes[dest] = first
+            return
+        if st.st_nlink > 1:
+            self.copied[(st.st_dev, st.st_ino)] = dest
+        future = self.executor.submit(copy_and_hash if self.hashing else copy_file,
+                                      source, dest, st.st_size)
+        self.copies.append((future, st.st_size, source, dest))
+        if self.hashing:
+            self.hashes[dest] = future
+
+    def finish(self, on_error=None):
+        """Wait for the copies, then make the hard links to them.
+
+        With on_error, a copy or link failing with OSError is passed to
+        on_error(source, dest, error) instead of raising, and its dest is
+        added to failed.
+        """
+        try:
+            for future, size, source, dest in self.copies:
+                try:
+                    result = future.result()
+                except OSError as e:
+                    if on_error is None:
+                        raise
+                    self.failed.add(dest)
+                    on_error(source, dest, e)
+                    continue
+                self.count(result[0] if self.hashing else result, size)
+        finally:
+            self.executor.shutdown()
+        for source, dest, first, size in self.links:
+            try:
+                if os.path.lexists(dest):
+                    os.unlink(dest)
+                os.link(first, dest)
+                os.unlink(source)
+            except OSError as e:
+                if on_error is None:
+                    raise
+                self.failed.add(dest)
+                on_error(source, dest, e)
+                continue
+            self.count('hardlink', size)
+
+    def digest(self, dest):
+        """The hash of dest, once finish has returned."""
+        result = self.hashes[dest]
+        if isinstance(result, str):
+            result = self.hashes[result]
+        result = result.result()
+        return result[1] if isinstance(result, tuple) else result
+
+    def summary(self):
+        """One line of counts and bytes per strategy."""
+        return ', '.join(f"{strategy} {count} files {size} bytes"
+                         for strategy, (count, size) in self.stats.items())
+
+
+def elf_info(path):
+    """(type, SONAME, INTERP) of the ELF file path, as readelf -hdl shows them.
+
+    Only the ELF header, the program headers and the dynamic segment are
+    read.  type is the e_type number, and SONAME and INTERP say whether
+    the dynamic segment has a DT_SONAME entry and whether there is a
+    PT_INTERP program header.  Returns None for anything that is not a
+    well-formed ELF file.
+    """
+    try:
+        with open(path, 'rb') as ifile:
+            ident = ifile.read(64)
+            if ident[:4] != ELF_MAGIC or ident[4] not in (1, 2) \
+                    or ident[5] not in (1, 2):
+                return None
+            order = '<' if ident[5] == 1 else '>'
+            if ident[4] == 2:
+                (etype, phoff, phentsize,
+                 phnum) = struct.unpack_from(order + 'H14xQ14xHH', ident, 16)
+                phdr, dyn = order + 'I4xQ16xQ', order + 'qQ'
+            else:
+                (etype, phoff, phentsize,
+                 phnum) = struct.unpack_from(order + 'H10xI10xHH', ident, 16)
+                phdr, dyn = order + 'II8xI', order + 'iI'
+            if phnum and phentsize < struct.calcsize(phdr):
+                return None
+            soname = interp = False
+            table = os.pread(ifile.fileno(), phentsize * phnum, phoff)
+            if len(table) < phentsize * phnum:
+                return None
+            for index in range(phnum):
+                ptype, offset, filesz = struct.unpack_from(phdr, table,
+                                                           index * phentsize)
+                if ptype == PT_INTERP:
+                    interp = True
+                elif ptype == PT_DYNAMIC and not soname:
+                    data = os.pread(ifile.fileno(), filesz, offset)
+                    for tag, _ in struct.iter_unpack(
+                            dyn, data[:len(data) - len(data) % struct.calcsize(dyn)]):
+                        if tag == DT_NULL:
+                            break
+                        if tag == DT_SONAME:
+                            soname = True
+                            break
+    except (OSError, struct.error):
+        return None
+    return etype, soname, interp
+
+
+def layout_candidate(virtpath, st_mode, libsubdir):
+    """Whether clr-avx2-move.pl would have looked at the file virtpath.
+
+    That is an executable directly in one of LAYOUT_BIN_DIRS, or a file
+    named like a library anywhere under LAYOUT_LIB_DIR, except under
+    directories named libsubdir.
+    """
+    dirname = os.path.dirname(virtpath)
+    if dirname in LAYOUT_BIN_DIRS:
+        return st_mode & 0o111 != 0
+    if not (dirname + '/').startswith(LAYOUT_LIB_DIR + '/'):
+        return False
+    while dirname != LAYOUT_LIB_DIR:
+        if dirname.endswith('/' + libsubdir):
+            return False
+        dirname = os.path.dirname(dirname)
+    return LAYOUT_LIB_NAME.search(virtpath) is not None
+
+
+def layout_dest(args, virtpath, info):
+    """Where the file virtpath with elf_info info goes, None if it stays.
+
+    Executables and libraries, which have an INTERP or a SONAME, go to
+    libsubdir under their directory; other executable or shared objects
+    are plugins and get the plugin suffix.
+    """
+    if info is None or info[0] not in (ET_EXEC, ET_DYN):
+        return None
+    dest = os.path.join(args.targetdir, virtpath[1:])
+    if info[1] or info[2]:
+        return os.path.join(os.path.dirname(dest), args.libsubdir,
+                            os.path.basename(dest))
+    return dest + args.plugin_suffix
+
+
+def move_layout(args, judge=None):
+    """Move the ELF files of installdir the way clr-avx2-move.pl did.
+
+    The installdir is scanned once with walk_install, following symlinks
+    to files as the script's -f did, and each candidate is classified
+    with elf_info on the Mover's thread pool instead of running readelf.
+    --skip-path, --skip and --path apply as they do to move_content, and
+    --path also makes a file a candidate wherever it is.  Like the script,
+    a file that cannot be moved is reported and the others still are.
+    """
+    always_process = set(itertools.chain.from_iterable(args.path))
+    args.path = always_process
+    skips = set(itertools.chain.from_iterable(args.skip_path))
+    virtpaths = OrderedDict()
+    for filepath, elf in walk_install(args.installdir, args.jobs, links=True):
+        virtpath = os.path.join('/', filepath.removeprefix(args.installdir))
+        if virtpath in skips:
+            if args.verbose:
+                print(f"Skipping path {virtpath}")
+            continue
+        if not elf and virtpath not in args.path:
+            continue
+        if not installs_elf(args, virtpath, skips):
+            if args.verbose:
+                print(f"Skipping elf file {virtpath}")
+            continue
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        if virtpath in args.path or \
+                layout_candidate(virtpath, st.st_mode, args.libsubdir):
+            virtpaths[virtpath] = filepath
+
+    def report(source, dest, error):
+        print(f"{source} -> {dest}: {error}", file=sys.stderr)
+
+    mover = Mover(args.jobs, bool(args.outfile))
+    moved = []
+    try:
+        infos = list(mover.executor.map(elf_info, virtpaths.values()))
+        moves = []
+        for (virtpath, source), info in zip(virtpaths.items(), infos):
+            dest = layout_dest(args, virtpath, info)
+            if dest is None:
+                if virtpath in args.path:
+                    print(f"{virtpath} is not an executable or shared "
+                          "object, not moved", file=sys.stderr)
+                continue
+            if judge is not None and not os.path.islink(source):
+                judge.submit(source)
+            moves.append((virtpath, source, dest))
+        for virtpath, source, dest in moves:
+            symlink = os.path.islink(source)
+            try:
+                if judge is not None and not judge.keep(source):
+                    if args.verbose:
+                        print(f"Dropping {virtpath}")
+                    os.unlink(source)
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                mover.move(source, dest)
+            except OSError as e:
+                report(source, dest, e)
+                continue
+            moved.append((source, dest, symlink))
+    finally:
+        mover.finish(report)
+    installed = []
+    for source, dest, symlink in moved:
+        if dest in mover.failed:
+            continue
+        print(f"{source} -> {dest}")
+        if not symlink:
+            installed.append(('/' + os.path.relpath(dest, args.targetdir), dest))
+    if args.outfile:
+        write_filemap(args.outfile, args.btype,
+                      ((virtpath, mover.digest(dest))
+                       for virtpath, dest in installed))
+    if args.verbose and mover.stats:
+        print(f"Moved {mover.summary()}")
+    if judge is not None:
+        print(f"Judged elf files: {judge.summary()}")
+
+
+def load_avxjudge(path):
+    """Load avxjudge.py from path, or from where it is usually found."""
+    global avxjudge
+
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'avxjudge.py')
+        if not os.path.exists(path):
+            path = os.path.join(AVXJUDGE_DATADIR, 'avxjudge.py')
+    spec = importlib.util.spec_from_file_location("avxjudge", path)
+    avxjudge = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(avxjudge)
+
+
+def judge_elf(path, delete_type):
+    """Whether avxjudge would keep path, judging it for delete_type."""
+    records = avxjudge.RecordKeeper(delete_type)
+    records = avxjudge.scan_file(records, path, 0, 1, False, 1)[0]
+    return not records.should_delete()
+
+
+class Judge:
+    """Judge elf files with avxjudge on a pool of jobs processes.
+
+    Files are submitted as the scan finds them, and their verdicts are
+    waited for only when they are about to be moved.  Counts and bytes of
+    the files kept and dropped are kept for the summary.
+    """
+
+    def __init__(self, btype, jobs=None):
+        self.delete_type = btype
+        jobs = jobs or len(os.sched_getaffinity(0))
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        # start every worker now, so they fork before the scan threads
+        for future in [self.executor.submit(os.getpid)
+                       for _ in range(jobs)]:
+            future.result()
+        self.verdicts = {}
+        self.kept = [0, 0]
+        self.dropped = [0, 0]
+
+    def submit(self, path):
+        self.verdicts[path] = self.executor.submit(judge_elf, path,
+                                                   self.delete_type)
+
+    def keep(self, path):
+        """Wait for the verdict on path, counting it as kept or dropped.
+
+        Files never submitted are kept without being counted.
+        """
+        verdict = self.verdicts.pop(path, None)
+        if verdict is None:
+            return True
+        size = os.lstat(path).st_size
+        keep = verdict.result()
+        counts = self.kept if keep else self.dropped
+        counts[0] += 1
+        counts[1] += size
+        return keep
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def summary(self):
+        return (f"kept {self.kept[0]} files {self.kept[1]} bytes, "
+                f"dropped {self.dropped[0]} files {self.dropped[1]} bytes")
+
+
+def write_filemap(outfile, btype, entries):
+    """Write (path, hash) entries to outfile as filemap-verify.py reads them.
+
+    Each entry is three lines: btype, the installed path and the hash.
+    The filemap is written to a temporary file and renamed into place, so
+    outfile is either the old filemap or the whole new one.
+    """
+    directory = os.path.dirname(os.path.abspath(outfile))
+    with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=directory,
+                                     prefix='.filemap-', delete=False) as ofile:
+        try:
+            for virtpath, fhash in entries:
+                ofile.write(f"{btype}\n{virtpath}\n{fhash}\n")
+        except BaseException:
+            os.unlink(ofile.name)
+            raise
+    os.chmod(ofile.name, 0o644)
+    os.replace(ofile.name, outfile)
+
+
+def installs_elf(args, virtpath, skips):
+    """Whether move_content would install virtpath as an elf file."""
+    if virtpath in skips:
+        return False
+    return not args.skip or virtpath in args.path
+
+
+def process_install(args, judge=None):
     """Create output based on the installdir.
 
     Also output to stdout the non-elf file paths and hashes (useful to compare
-    different build types).
+    different build types).  With judge, the elf files to install, except
+    those given with --path, are submitted to it as they are found.
     """
     always_process = set()
     for item in args.path:
         always_process.add(item[0])
     args.path = always_process
+    skips = set(itertools.chain.from_iterable(args.skip_path))
+
+    def found(filepath, elf):
+        virtpath = os.path.join('/',
+                                filepath.removeprefix(args.installdir))
+        if elf and virtpath not in args.path and \
+                installs_elf(args, virtpath, skips):
+            judge.submit(filepath)
+
     filemap = OrderedDict()
-    for root, _, files in os.walk(args.installdir):
-        for name in files:
-            filepath = os.path.join(root, name)
-            if os.path.islink(filepath):
-                continue
-            try:
-                if os.stat(filepath).st_mode & os.path.stat.S_ISUID != 0:
-                    continue
-            except:
-                continue
-            data = bytearray(4096)
-            memv = memoryview(data)
-            virtpath = os.path.join('/',
-                                    filepath.removeprefix(args.installdir))
-
-            with open(filepath, 'rb', buffering=0) as ifile:
-                ifile.readinto(memv)
-                elf = memv[:4] == b'\x7fELF'
-                if elf or virtpath in args.path:
-                    filemap[virtpath] = [True,
-                                         filepath]
-                else:
-                    filemap[virtpath] = [False,
-                                         filepath]
+    for filepath, elf in walk_install(args.installdir, args.jobs,
+                                      found if judge is not None else None):
+        virtpath = os.path.join('/',
+                                filepath.removeprefix(args.installdir))
+        if elf or virtpath in args.path:
+            filemap[virtpath] = [True,
+                                 filepath]
+        else:
+            filemap[virtpath] = [False,
+                                 filepath]
     return filemap
 
 
-def move_content(args, filemap):
-    """Use the filemap to populate targetidr."""
+def move_content(args, filemap, judge=None):
+    """Use the filemap to populate targetidr.
+
+    With judge, the elf files it does not keep are deleted instead.
+    """
     if len(filemap) == 0:
+        if args.outfile:
+            write_filemap(args.outfile, args.btype, ())
         return
 
     skips = set(itertools.chain.from_iterable(args.skip_path))
@@ -94,6 +685,30 @@ def move_content(args, filemap):
         return
     optimized_dir = os.path.join(args.targetdir, optimized_prefix)
     os.makedirs(optimized_dir, exist_ok=True)
+    mover = Mover(args.jobs, bool(args.outfile))
+    installed = []
+    try:
+        install_files(args, filemap, skips, optimized_dir, mover, judge,
+                      installed)
+    finally:
+        mover.finish()
+    if args.outfile:
+        write_filemap(args.outfile, args.btype,
+                      ((virtpath, mover.digest(dest))
+                       for virtpath, dest in installed))
+    if args.verbose and mover.stats:
+        print(f"Moved {mover.summary()}")
+    if judge is not None:
+        print(f"Judged elf files: {judge.summary()}")
+
+
+def install_files(args, filemap, skips, optimized_dir, mover, judge=None,
+                  installed=None):
+    """Move the files of filemap to install into optimized_dir.
+
+    The installed path and dest of each file moved are appended to
+    installed if given.
+    """
     for virtpath, val in filemap.items():
         elf = val[0]
         source = val[1]
@@ -106,6 +721,11 @@ def move_content(args, filemap):
                 if args.verbose:
                     print(f"Skipping elf file {virtpath}")
                 continue
+            if judge is not None and not judge.keep(source):
+                if args.verbose:
+                    print(f"Dropping {virtpath}")
+                os.unlink(source)
+                continue
             vdname = os.path.dirname(virtpath)
             vbname = os.path.basename(virtpath)
             if vdname in ('/bin', '/sbin', '/usr/sbin'):
@@ -118,7 +738,9 @@ def move_content(args, filemap):
             os.makedirs(os.path.dirname(dest), exist_ok=True)
             if args.verbose:
                 print(f"Installing {dest}")
-            os.rename(source, dest)
+            mover.move(source, dest)
+            if installed is not None:
+                installed.append((virtpath, dest))
         elif args.verbose:
             print(f"{virtpath} not installed")
 
@@ -130,8 +752,6 @@ def main():
     if args.btype not in ("avx2", "avx512", "apx"):
         print(f"Error: btype '{args.btype}' not supported (needs to be either avx2, avx512 or apx)")
         sys.exit(-1)
-    if args.outfile:
-        print('Warning: outfile argument is longer used, ignoring.')
     if args.targetdir.endswith('/usr/share/clear/optimized-elf/'):
         # Catch previous invocation with targetdir being the
         # optimized-elf directory that is no longer correct.
@@ -139,9 +759,25 @@ def main():
         print(' targetdir should be the root of the output directory.')
         sys.exit(-1)
 
-    filemap = process_install(args)
+    if (args.libsubdir is None) != (args.plugin_suffix is None):
+        print('Error: --libsubdir and --plugin-suffix go together')
+        sys.exit(-1)
+
+    judge = None
+    if args.judge and not args.skip:
+        load_avxjudge(args.avxjudge)
+        judge = Judge(args.btype, args.jobs)
+    try:
+        if args.libsubdir is not None:
+            move_layout(args, judge)
+            return
+
+        filemap = process_install(args, judge)
 
-    move_content(args, filemap)
+        move_content(args, filemap, judge)
+    finally:
+        if judge is not None:
+            judge.shutdown()
 
 
 if __name__ == '__main__':
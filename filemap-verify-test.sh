@@ -0,0 +1,43 @@
+#!/bin/bash
+
+set -eEu -o pipefail
+
+FMDIR=$(mktemp -d)
+OEDIR=$(mktemp -d)
+OUTDIR=$(mktemp -d)
+
+function cleanup() {
+    rm -fr "${FMDIR}"
+    rm -fr "${OEDIR}"
+    rm -fr "${OUTDIR}"
+}
+trap 'cleanup' EXIT
+
+mkdir -p "${OEDIR}/V3/usr/bin"
+echo -n same > "${OEDIR}/V3/usr/bin/ls"
+ln "${OEDIR}/V3/usr/bin/ls" "${OEDIR}/V3/usr/bin/ls2"
+echo -n other > "${OEDIR}/V3/usr/bin/cp"
+same=$(echo -n same | sha256sum | cut -d' ' -f1)
+other=$(echo -n other | sha256sum | cut -d' ' -f1)
+printf "avx2\n/usr/bin/ls2\n%s\navx2\n/usr/bin/ls\n%s\navx2\n/usr/bin/cp\n%s\n" \
+       "${same}" "${same}" "${other}" > "${FMDIR}/filemap-test"
+
+function test_run() {
+    python3 filemap-verify.py -f "${FMDIR}" -o "${OEDIR}" "$@" > "${OUTDIR}/out"
+    # identical files are each reported at their own path
+    grep -qx "V3/usr/bin/ls -> /usr/bin/ls:avx2" "${OUTDIR}/out"
+    grep -qx "V3/usr/bin/ls2 -> /usr/bin/ls2:avx2" "${OUTDIR}/out"
+    grep -qx "V3/usr/bin/cp -> /usr/bin/cp:avx2" "${OUTDIR}/out"
+
+    echo -n changed > "${OEDIR}/V3/usr/bin/cp"
+    ! python3 filemap-verify.py -f "${FMDIR}" -o "${OEDIR}" "$@" &> "${OUTDIR}/out"
+    grep -q "V3/usr/bin/cp does not match filemap hash ${other}" "${OUTDIR}/out"
+    echo -n other > "${OEDIR}/V3/usr/bin/cp"
+}
+
+test_run
+test_run -i "${OUTDIR}/index"
+
+# -m is still accepted, and does nothing
+python3 filemap-verify.py -f "${FMDIR}" -o "${OEDIR}" -m /usr/ > "${OUTDIR}/out"
+grep -qx "V3/usr/bin/cp -> /usr/bin/cp:avx2" "${OUTDIR}/out"
@@ -1,71 +1,478 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import concurrent.futures
 import hashlib
+import json
+import mmap
 import os
+import stat
+import struct
 import sys
+import tempfile
 
+# Files bigger than this are hashed in chunks of it rather than mapped
+# whole, so a huge file never needs that much address space at once
+CHUNK_SIZE = 1 << 26
 
-def get_full_map(fmdir):
-    full_map = {}
+# Binary filemap index: a header, the filemap files it was built from, the
+# btypes, the entries sorted by digest, the entry numbers sorted by path and
+# a string table the other records point into
+INDEX_MAGIC = b'FMIDX001'
+INDEX_HEADER = struct.Struct('<8sIIII')  # magic, files, btypes, entries, string table size
+INDEX_FILE = struct.Struct('<IIqQ')  # name offset, name length, mtime_ns, size
+INDEX_BTYPE = struct.Struct('<II')  # offset, length
+INDEX_ENTRY = struct.Struct('<32sIIII')  # digest, file, btype, path offset, path length
+INDEX_ORDER = struct.Struct('<I')
+
+
+def read_filemap(path):
+    """Yield (btype, opath, hash) for the entries of a filemap file, each
+    three lines; an incomplete last entry is left out.
+    """
+    with open(path, encoding='utf8') as mfile:
+        lines = mfile.read().splitlines()
+    for i in range(0, len(lines) - 2, 3):
+        yield lines[i].strip(), lines[i + 1].strip(), lines[i + 2].strip()
+
+
+def read_filemaps(fmdir):
+    """Yield the entries of every filemap file in fmdir."""
     for fmfile in os.listdir(fmdir):
         if not fmfile.startswith('filemap-'):
             print(f"Skipping {fmfile}")
             continue
-        with open(os.path.join(fmdir, fmfile), encoding='utf8') as mfile:
-            iter_mfile = iter(mfile.readlines())
-            for line in iter_mfile:
-                btype = line
-                opath = next(iter_mfile)
-                fhash = next(iter_mfile)
-                full_map[fhash.strip()] = (btype.strip(), opath.strip())
-    return full_map
-
-
-def get_hash_map(path):
-    hash_map = {}
-    for root, dirs, files in os.walk(path):
-        for fname in files:
-            try:
-                with open(os.path.join(root, fname), 'rb') as ifile:
-                    sha = hashlib.sha256()
-                    sha.update(ifile.read())
-                    hash_map[sha.hexdigest()] = os.path.join(root, fname)
-            except Exception:
-                pass
-    return hash_map
+        yield from read_filemap(os.path.join(fmdir, fmfile))
+
+
+def filemap_files(fmdir):
+    """Sorted (name, stat) of the filemap files in fmdir."""
+    files = []
+    for fmfile in sorted(os.listdir(fmdir)):
+        if not fmfile.startswith('filemap-'):
+            print(f"Skipping {fmfile}")
+            continue
+        files.append((fmfile, os.stat(os.path.join(fmdir, fmfile))))
+    return files
+
+
+class FilemapIndex:
+    """The filemap entries of fmdir, by hash and by installed path."""
+
+    def __init__(self, fmdir):
+        self.by_hash = {}
+        self.by_path = {}
+        for btype, opath, fhash in read_filemaps(fmdir):
+            self.by_hash.setdefault(fhash, []).append((btype, opath))
+            self.by_path.setdefault(opath, []).append(fhash)
+
+    def lookup(self, fhash):
+        """The (btype, opath) entries with hash fhash."""
+        return self.by_hash.get(fhash, [])
+
+    def lookup_path(self, opath):
+        """The hashes of the entries for opath."""
+        return self.by_path.get(opath, [])
+
+    def entries(self):
+        """Every (btype, opath, hash) entry."""
+        for fhash, entries in self.by_hash.items():
+            for btype, opath in entries:
+                yield btype, opath, fhash
+
+
+class _Column:
+    """Read-only sequence of key(i) for i in range(length), for bisect."""
+
+    def __init__(self, length, key):
+        self.length = length
+        self.key = key
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.key(i)
+
+
+class MappedFilemapIndex:
+    """A binary filemap index written by build_index, mapped read-only.
+
+    Hashes are looked up by bisecting the entries sorted by digest, and
+    installed paths by bisecting the entry numbers sorted by path, so
+    nothing is decoded beyond the records a lookup touches.  Raises
+    ValueError when the file is not a complete index.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as ifile:
+            self.data = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.nfiles, self.nbtypes, self.nentries, strsize = \
+                INDEX_HEADER.unpack_from(self.data, 0)
+        except struct.error as error:
+            self.data.close()
+            raise ValueError(f"{filename}: truncated index") from error
+        self.files_at = INDEX_HEADER.size
+        self.btypes_at = self.files_at + self.nfiles * INDEX_FILE.size
+        self.entries_at = self.btypes_at + self.nbtypes * INDEX_BTYPE.size
+        self.order_at = self.entries_at + self.nentries * INDEX_ENTRY.size
+        self.strings_at = self.order_at + self.nentries * INDEX_ORDER.size
+        if magic != INDEX_MAGIC or len(self.data) != self.strings_at + strsize:
+            self.data.close()
+            raise ValueError(f"{filename}: not a filemap index")
+        self.btypes = [self._string(*INDEX_BTYPE.unpack_from(self.data, self.btypes_at + i * INDEX_BTYPE.size))
+                       for i in range(self.nbtypes)]
+
+    def close(self):
+        self.data.close()
+
+    def _string(self, offset, length):
+        start = self.strings_at + offset
+        return self.data[start:start + length].decode('utf8')
+
+    def _entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.data, self.entries_at + i * INDEX_ENTRY.size)
+
+    def _digest(self, i):
+        start = self.entries_at + i * INDEX_ENTRY.size
+        return self.data[start:start + 32]
+
+    def _path_entry(self, i):
+        return INDEX_ORDER.unpack_from(self.data, self.order_at + i * INDEX_ORDER.size)[0]
+
+    def _path(self, i):
+        _, _, _, offset, length = self._entry(self._path_entry(i))
+        start = self.strings_at + offset
+        return self.data[start:start + length]
+
+    def files(self):
+        """{name: (mtime_ns, size)} of the filemap files indexed."""
+        files = {}
+        for i in range(self.nfiles):
+            offset, length, mtime_ns, size = INDEX_FILE.unpack_from(self.data, self.files_at + i * INDEX_FILE.size)
+            files[self._string(offset, length)] = (mtime_ns, size)
+        return files
+
+    def lookup(self, fhash):
+        """The (btype, opath) entries with hash fhash."""
+        try:
+            digest = bytes.fromhex(fhash)
+        except ValueError:
+            return []
+        found = []
+        i = bisect.bisect_left(_Column(self.nentries, self._digest), digest)
+        while i < self.nentries and self._digest(i) == digest:
+            _, _, btype, offset, length = self._entry(i)
+            found.append((self.btypes[btype], self._string(offset, length)))
+            i += 1
+        return found
+
+    def lookup_path(self, opath):
+        """The hashes of the entries for opath."""
+        path = opath.encode('utf8')
+        found = []
+        i = bisect.bisect_left(_Column(self.nentries, self._path), path)
+        while i < self.nentries and self._path(i) == path:
+            found.append(self._entry(self._path_entry(i))[0].hex())
+            i += 1
+        return found
+
+    def entries(self):
+        """Every (btype, opath, hash) entry."""
+        for i in range(self.nentries):
+            digest, _, btype, offset, length = self._entry(i)
+            yield self.btypes[btype], self._string(offset, length), digest.hex()
 
+    def raw_entries_by_file(self, file_numbers):
+        """{file number: [(btype, opath, digest), ...]} for the filemap
+        files numbered in file_numbers, from one pass over the entries,
+        with opath as encoded bytes and the digest as 32 bytes."""
+        buckets = {number: [] for number in file_numbers}
+        strings = self.data[self.strings_at:]
+        for digest, fileno, btype, offset, length in \
+                INDEX_ENTRY.iter_unpack(self.data[self.entries_at:self.order_at]):
+            bucket = buckets.get(fileno)
+            if bucket is not None:
+                bucket.append((self.btypes[btype], strings[offset:offset + length], digest))
+        return buckets
 
-def find_match(path, hash_map):
+
+def build_index(fmdir, filename, files, old=None):
+    """Write the binary index of the filemap files in fmdir to filename.
+
+    files are the (name, stat) of filemap_files; the entries of the files
+    whose mtime and size match the old index are taken from it, in one
+    pass over its entries, rather than parsed again.  The index is
+    replaced atomically.
+    """
+    reused = {}
+    if old is not None:
+        current = {name: (st.st_mtime_ns, st.st_size) for name, st in files}
+        unchanged = {number: name for number, (name, signature) in enumerate(old.files().items())
+                     if current.get(name) == signature}
+        for number, fentries in old.raw_entries_by_file(unchanged).items():
+            reused[unchanged[number]] = fentries
+    strings = bytearray()
+    interned = {}
+
+    def intern(data):
+        if data not in interned:
+            interned[data] = (len(strings), len(data))
+            strings.extend(data)
+        return interned[data]
+
+    btypes = {}
+    entries = []
+    file_records = []
+    for number, (name, st) in enumerate(files):
+        signature = (st.st_mtime_ns, st.st_size)
+        file_records.append(INDEX_FILE.pack(*intern(name.encode('utf8')), *signature))
+        if name in reused:
+            fentries = reused[name]
+        else:
+            fentries = []
+            for btype, opath, fhash in read_filemap(os.path.join(fmdir, name)):
+                try:
+                    digest = bytes.fromhex(fhash)
+                except ValueError:
+                    continue
+                if len(digest) == 32:
+                    fentries.append((btype, opath.encode('utf8'), digest))
+        for btype, opath, digest in fentries:
+            btype_number = btypes.setdefault(btype, len(btypes))
+            entries.append((digest, number, btype_number, *intern(opath)))
+    entries.sort()
+    order = sorted(range(len(entries)),
+                   key=lambda i: strings[entries[i][3]:entries[i][3] + entries[i][4]])
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.filemap-index-', delete=False) as ofile:
+        btype_records = [INDEX_BTYPE.pack(*intern(btype.encode('utf8'))) for btype in btypes]
+        ofile.write(INDEX_HEADER.pack(INDEX_MAGIC, len(file_records), len(btype_records),
+                                      len(entries), len(strings)))
+        ofile.write(b''.join(file_records))
+        ofile.write(b''.join(btype_records))
+        ofile.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        ofile.write(b''.join(INDEX_ORDER.pack(i) for i in order))
+        ofile.write(strings)
+    os.chmod(ofile.name, 0o644)
+    os.replace(ofile.name, filename)
+
+
+def open_index(fmdir, filename):
+    """The binary index of fmdir at filename, rebuilt first when a filemap
+    file was added, removed or changed since it was written.  The filemap
+    files stay the source of truth: when the index cannot be written, they
+    are read into a FilemapIndex instead.
+    """
+    try:
+        index = MappedFilemapIndex(filename)
+    except (OSError, ValueError):
+        index = None
+    files = filemap_files(fmdir)
+    current = {name: (st.st_mtime_ns, st.st_size) for name, st in files}
+    if index is not None and index.files() == current:
+        return index
+    try:
+        build_index(fmdir, filename, files, index)
+    except OSError as error:
+        print(f"Cannot write filemap index {filename}: {error}", file=sys.stderr)
+        return FilemapIndex(fmdir)
+    finally:
+        if index is not None:
+            index.close()
+    return MappedFilemapIndex(filename)
+
+
+class HashCache:
+    """Persistent file hashes keyed by stat signature.
+
+    The signature (st_dev, st_ino, st_size, st_mtime_ns) changes whenever a
+    file is replaced or rewritten, so a file with a known signature is not
+    read again.  Only the signatures looked up in this run are saved, and
+    the cache file is replaced atomically.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hashes = {}
+        self.used = {}
+        try:
+            with open(filename, encoding='utf8') as cfile:
+                self.hashes = json.load(cfile)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def signature(st):
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, st):
+        key = self.signature(st)
+        fhash = self.hashes.get(key)
+        if fhash is not None:
+            self.used[key] = fhash
+        return fhash
+
+    def put(self, st, fhash):
+        self.used[self.signature(st)] = fhash
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=directory,
+                                             prefix='.hashes-', delete=False) as cfile:
+                json.dump(self.used, cfile)
+            os.replace(cfile.name, self.filename)
+        except OSError:
+            pass
+
+
+def hash_file(path, size):
+    """Hex sha256 of the size bytes of path, from mappings of at most
+    CHUNK_SIZE bytes, with the GIL released while hashing.
+    """
     sha = hashlib.sha256()
     with open(path, 'rb') as ifile:
-        sha.update(ifile.read())
-    if sha in hash_map and hash_map[sha] != path:
-        return hash_map[sha]
+        for offset in range(0, size, CHUNK_SIZE):
+            length = min(CHUNK_SIZE, size - offset)
+            with mmap.mmap(ifile.fileno(), length, access=mmap.ACCESS_READ,
+                           offset=offset) as data:
+                sha.update(data)
+    return sha.hexdigest()
+
+
+def hash_files(paths, jobs=None, cache=None):
+    """Yield (path, hash) for each regular file in paths, in order.
+
+    Files are hashed on a pool of jobs threads, or taken from cache when
+    their stat signature is known.  Files that cannot be read are left out.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            fhash = cache.get(st) if cache is not None else None
+            if fhash is None:
+                fhash = executor.submit(hash_file, path, st.st_size)
+            pending.append((path, st, fhash))
+        for path, st, fhash in pending:
+            if not isinstance(fhash, str):
+                try:
+                    fhash = fhash.result()
+                except (OSError, ValueError):
+                    # unreadable, or shrunk since it was stat'ed
+                    continue
+                if cache is not None:
+                    cache.put(st, fhash)
+            yield path, fhash
+
+
+def walk_files(path):
+    """Yield the paths of the files under path, in os.walk order."""
+    for root, _, files in os.walk(path):
+        for fname in files:
+            yield os.path.join(root, fname)
+
+
+def installed_paths(relpath):
+    """The installed paths an optimized file at relpath stands for: below
+    its V3/V4/VA directory, then as it is."""
+    parts = relpath.split(os.sep, 1)
+    return ['/' + parts[-1], '/' + relpath]
+
+
+def verify(index, oedir, jobs=None, cache=None):
+    """Check the files under oedir against the filemap index.
+
+    An optimized file is verified when it is named by a filemap hash and
+    has that content, or otherwise when its content has a filemap entry;
+    of several entries with that content, the one at its installed path
+    is reported.
+    It is mismatched when it is named by a filemap hash, or sits at the
+    path of a filemap entry below its V3/V4/VA directory, but has other
+    content; and orphaned when the filemap knows neither it nor its
+    content.  Filemap entries whose hash no optimized file has, by name or
+    content, are missing.  The files are hashed in parallel with
+    hash_files.
+
+    Returns (verified, mismatched, orphaned, missing): (path, btype, opath)
+    tuples, (path, expected hash) pairs, paths relative to oedir, and
+    (btype, opath, hash) entries.
+    """
+    verified = []
+    mismatched = []
+    orphaned = []
+    seen = set()
+    for path, fhash in hash_files(walk_files(oedir), jobs, cache):
+        relpath = os.path.relpath(path, oedir)
+        name = os.path.basename(path)
+        seen.add(fhash)
+        if index.lookup(name):
+            seen.add(name)
+            if name == fhash:
+                btype, opath = index.lookup(name)[0]
+                verified.append((relpath, btype, opath))
+            else:
+                mismatched.append((relpath, name))
+            continue
+        paths = installed_paths(relpath)
+        entries = index.lookup(fhash)
+        if entries:
+            btype, opath = next((entry for entry in entries if entry[1] in paths), entries[0])
+            verified.append((relpath, btype, opath))
+            continue
+        expected = index.lookup_path(paths[0]) or index.lookup_path(paths[1])
+        if expected:
+            mismatched.append((relpath, expected[0]))
+        else:
+            orphaned.append(relpath)
+    missing = sorted(entry for entry in index.entries() if entry[2] not in seen)
+    return verified, mismatched, orphaned, missing
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--fmdir', '-f', default='/usr/share/clear/filemap/', help='The filemap directory')
-    parser.add_argument('--match_base', '-m', default='/usr/', help='The base directory of os content')
     parser.add_argument('--oedir', '-o', default='/usr/share/clear/optimized-elf/', help='The optimized elf directory')
+    parser.add_argument('--match_base', '-m', default='/usr/',
+                        help='Ignored; files are matched to the filemap by path and hash')
     parser.add_argument('--quiet', '-q', action='store_true', default=False, help='Do not print results')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='Number of files to hash in parallel (default: a few more than the CPUs)')
+    parser.add_argument('--hash-cache', '-c', default=None,
+                        help='File keeping hashes by stat signature, so unchanged files are not read again')
+    parser.add_argument('--index', '-i', default=None,
+                        help='Binary filemap index to use, rebuilt from the filemap files that changed')
     args = parser.parse_args()
 
-    full_map = get_full_map(args.fmdir)
-    match_list = []
-
-    for root, _, files in os.walk(args.oedir):
-        for oefile in files:
-            if oefile in full_map and not args.quiet:
-                print(f"{oefile} -> {full_map[oefile][1]}:{full_map[oefile][0]}")
-            else:
-                match_list.append((root, oefile))
+    if args.index:
+        index = open_index(args.fmdir, args.index)
+    else:
+        index = FilemapIndex(args.fmdir)
+    cache = HashCache(args.hash_cache) if args.hash_cache else None
+    verified, mismatched, orphaned, missing = verify(index, args.oedir, args.jobs, cache)
+    if cache is not None:
+        cache.save()
 
-    if match_list:
-        if not args.quiet:
-            for _, oefile in match_list:
-                print(f"Error: {oefile} not in filemap", file=sys.stderr)
+    if not args.quiet:
+        for oefile, btype, opath in verified:
+            print(f"{oefile} -> {opath}:{btype}")
+        for oefile, fhash in mismatched:
+            print(f"Error: {oefile} does not match filemap hash {fhash}", file=sys.stderr)
+        for oefile in orphaned:
+            print(f"Error: {oefile} not in filemap", file=sys.stderr)
+        for btype, opath, fhash in missing:
+            print(f"Error: {opath}:{btype} ({fhash}) missing", file=sys.stderr)
+    if mismatched or orphaned or missing:
         sys.exit(-1)
 
 
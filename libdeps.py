@@ -1,7 +1,18 @@
 #!/usr/bin/python3
 
-import subprocess
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
 import sys
+import tempfile
+import time
 import copy
 
 libprovides = dict()
@@ -10,20 +21,533 @@ librequires = dict()
 matrix = dict()
 visited = dict()
 
+# Libraries in the order ld.so loads them, breadth first from the binary
+load_order = list()
 
-def add_provides(lib, function):
+# symbol -> the libraries providing it, in load order
+providers = dict()
+
+# Providers left out of the matrix, by path or file name, because nearly
+# everything binds to them
+EXCLUDED_PROVIDERS = [
+    'ld-linux-x86-64.so.2',
+    'libc.so.6',
+    'libpthread.so.0',
+]
+
+ELF_MAGIC = b'\x7fELF'
+EM_X86_64 = 62
+SHN_UNDEF = 0
+SHF_EXECINSTR = 0x4
+SHT_DYNAMIC = 6
+SHT_DYNSYM = 11
+SHT_GNU_VERDEF = 0x6ffffffd
+SHT_GNU_VERNEED = 0x6ffffffe
+SHT_GNU_VERSYM = 0x6fffffff
+STB_GLOBAL = 1
+STB_WEAK = 2
+STT_OBJECT = 1
+STT_GNU_IFUNC = 10
+ET_EXEC = 2
+ET_DYN = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+VER_FLG_BASE = 0x1
+
+# Directories ld.so searches after the ld.so.cache, by ELF class
+SYSTEM_DIRS = {1: ['/lib', '/usr/lib'], 2: ['/lib64', '/usr/lib64']}
+LD_SO_CONF = '/etc/ld.so.conf'
+
+# x86-64 hwcaps subdirectories ld.so prefers in every search directory, best
+# first, with the cpuinfo flags each one needs
+HWCAPS = [
+    ('glibc-hwcaps/x86-64-v4', {'avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl'}),
+    ('haswell/avx512_1', {'avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl'}),
+    ('glibc-hwcaps/x86-64-v3', {'avx2', 'bmi1', 'bmi2', 'fma', 'movbe', 'f16c', 'abm', 'xsave'}),
+    ('haswell', {'avx2', 'bmi1', 'bmi2', 'fma', 'movbe', 'f16c', 'abm', 'xsave'}),
+    ('glibc-hwcaps/x86-64-v2', {'sse4_2', 'popcnt', 'ssse3', 'cx16', 'lahf_lm'}),
+]
+
+# Bump when what ElfFile reads or how SymbolCache stores it changes
+CACHE_VERSION = 1
+
+elf_files = dict()
+system_dirs = dict()
+hwcaps_dirs = None
+symbol_cache = None
+
+
+class ElfFile:
+    """The dynamic section, symbols and symbol versions of a shared object.
+
+    Only the section headers and the sections they point at are read, so
+    nothing in the file is run.  defined maps each symbol nm -D would list
+    as T or W to {version: hidden}, and undefined each global undefined
+    symbol to the version it needs, None when unversioned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.soname = None
+        self.needed = []
+        self.rpath = []
+        self.runpath = []
+        self.defined = dict()
+        self.undefined = dict()
+        with open(path, 'rb') as ifile:
+            with mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.parse(data)
+
+    def to_entry(self):
+        """A JSON-able form of everything but the path; no version is ''."""
+        return {
+            'elf_class': self.elf_class,
+            'machine': self.machine,
+            'soname': self.soname,
+            'needed': self.needed,
+            'rpath': self.rpath,
+            'runpath': self.runpath,
+            'defined': {name: [[version or '', hidden] for version, hidden in versions.items()]
+                        for name, versions in self.defined.items()},
+            'undefined': {name: version or '' for name, version in self.undefined.items()},
+        }
+
+    @classmethod
+    def from_entry(cls, path, entry):
+        elf = cls.__new__(cls)
+        elf.path = path
+        for key in ('elf_class', 'machine', 'soname', 'needed', 'rpath', 'runpath'):
+            setattr(elf, key, entry[key])
+        elf.defined = {name: {version or None: hidden for version, hidden in versions}
+                       for name, versions in entry['defined'].items()}
+        elf.undefined = {name: version or None for name, version in entry['undefined'].items()}
+        return elf
+
+    def parse(self, data):
+        if data[:4] != ELF_MAGIC or data[4] not in (1, 2) or data[5] not in (1, 2):
+            raise ValueError("not an ELF file")
+        self.elf_class = data[4]
+        end = '<' if data[5] == 1 else '>'
+        is64 = self.elf_class == 2
+        self.machine = struct.unpack_from(end + 'H', data, 18)[0]
+        if is64:
+            shoff, = struct.unpack_from(end + 'Q', data, 40)
+            shentsize, shnum = struct.unpack_from(end + 'HH', data, 58)
+            shdr = struct.Struct(end + 'IIQQQQIIQQ')
+        else:
+            shoff, = struct.unpack_from(end + 'I', data, 32)
+            shentsize, shnum = struct.unpack_from(end + 'HH', data, 46)
+            shdr = struct.Struct(end + 'IIIIIIIIII')
+        sections = []
+        for i in range(shnum):
+            _, stype, flags, _, offset, size, link, _, _, _ = shdr.unpack_from(data, shoff + i * shentsize)
+            sections.append((stype, flags, offset, size, link))
+
+        def strings(index):
+            _, _, offset, size, _ = sections[index]
+            table = data[offset:offset + size]
+            return lambda at: table[at:table.index(b'\0', at)].decode('utf8', 'replace')
+
+        symtab = versym = None
+        verdef = verneed = None
+        for stype, _, offset, size, link in sections:
+            if stype == SHT_DYNAMIC:
+                self.parse_dynamic(data, end, is64, offset, size, strings(link))
+            elif stype == SHT_DYNSYM:
+                symtab = (offset, size, strings(link))
+            elif stype == SHT_GNU_VERSYM:
+                versym = (offset, size)
+            elif stype == SHT_GNU_VERDEF:
+                verdef = (offset, size, strings(link))
+            elif stype == SHT_GNU_VERNEED:
+                verneed = (offset, size, strings(link))
+        if symtab is None:
+            return
+        versions = dict()
+        if verdef is not None:
+            self.parse_verdef(data, end, verdef, versions)
+        if verneed is not None:
+            self.parse_verneed(data, end, verneed, versions)
+        self.parse_symbols(data, end, is64, symtab, versym, versions, sections)
+
+    def parse_dynamic(self, data, end, is64, offset, size, string):
+        dyn = struct.Struct(end + ('qQ' if is64 else 'iI'))
+        for at in range(offset, offset + size - dyn.size + 1, dyn.size):
+            tag, value = dyn.unpack_from(data, at)
+            if tag == DT_NULL:
+                break
+            if tag == DT_NEEDED:
+                self.needed.append(string(value))
+            elif tag == DT_SONAME:
+                self.soname = string(value)
+            elif tag == DT_RPATH:
+                self.rpath = string(value).split(':')
+            elif tag == DT_RUNPATH:
+                self.runpath = string(value).split(':')
+        # ld.so ignores DT_RPATH when DT_RUNPATH is present
+        if self.runpath:
+            self.rpath = []
+
+    @staticmethod
+    def parse_verdef(data, end, verdef, versions):
+        offset, size, string = verdef
+        at = offset
+        while offset <= at < offset + size:
+            _, flags, index, count, _, aux, following = struct.unpack_from(end + 'HHHHIII', data, at)
+            if count and not flags & VER_FLG_BASE:
+                versions[index] = string(struct.unpack_from(end + 'I', data, at + aux)[0])
+            if not following:
+                break
+            at += following
+
+    @staticmethod
+    def parse_verneed(data, end, verneed, versions):
+        offset, size, string = verneed
+        at = offset
+        while offset <= at < offset + size:
+            _, count, _, aux, following = struct.unpack_from(end + 'HHIII', data, at)
+            aux_at = at + aux
+            for _ in range(count):
+                _, _, index, name, aux_next = struct.unpack_from(end + 'IHHII', data, aux_at)
+                versions[index] = string(name)
+                if not aux_next:
+                    break
+                aux_at += aux_next
+            if not following:
+                break
+            at += following
+
+    def parse_symbols(self, data, end, is64, symtab, versym, versions, sections):
+        offset, size, string = symtab
+        if is64:
+            sym = struct.Struct(end + 'IBBHQQ')
+        else:
+            sym = struct.Struct(end + 'IIIBBH')
+        for i in range(1, size // sym.size):
+            fields = sym.unpack_from(data, offset + i * sym.size)
+            if is64:
+                name, info, _, shndx, _, _ = fields
+            else:
+                name, _, _, info, _, shndx = fields
+            bind = info >> 4
+            stype = info & 0xf
+            if bind not in (STB_GLOBAL, STB_WEAK):
+                continue
+            version = None
+            hidden = False
+            if versym is not None and 2 * i < versym[1]:
+                index, = struct.unpack_from(end + 'H', data, versym[0] + 2 * i)
+                version = versions.get(index & 0x7fff)
+                hidden = bool(index & 0x8000)
+            if shndx == SHN_UNDEF:
+                if bind == STB_GLOBAL:
+                    self.undefined[string(name)] = version
+                continue
+            # the symbols nm -D shows as T (global code) or W (weak, not an object)
+            if stype == STT_GNU_IFUNC:
+                continue
+            if bind == STB_GLOBAL:
+                if shndx >= len(sections) or not sections[shndx][1] & SHF_EXECINSTR:
+                    continue
+            elif stype == STT_OBJECT:
+                continue
+            self.defined.setdefault(string(name), dict())[version] = hidden
+
+
+class SymbolCache():
+    """On-disk cache of ElfFile tables, keyed by file content.
+
+    One JSON file per library, readable by everyone sharing the directory,
+    written to a temporary name and renamed into place, so the workers of a
+    batch and concurrent runs sharing the directory only ever see whole
+    entries.  A library is parsed again only when its content or
+    CACHE_VERSION changes.  A hit refreshes the entry's mtime, and once the
+    directory grows past max_bytes the oldest entries are evicted down to
+    three quarters of it.  The size is scanned once and then tracked as
+    entries are added; with pruning unset, as in the workers of a batch,
+    entries are only added and prune() enforces the limit afterwards.
+    """
+    # temporary files older than this were left by a run that died
+    stale_seconds = 3600
+
+    def __init__(self, directory, max_bytes, pruning=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pruning = pruning
+        self.total = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(path):
+        digest = hashlib.sha256(f'libdeps {CACHE_VERSION}\n'.encode())
+        with open(path, 'rb') as ifile:
+            for chunk in iter(lambda: ifile.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, path):
+        """The ElfFile for path, from the cache when its content is known."""
+        key = self.key(path)
+        try:
+            with open(self.path(key), encoding='utf8') as cfile:
+                elf = ElfFile.from_entry(path, json.load(cfile))
+            os.utime(self.path(key))
+            return elf
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        elf = ElfFile(path)
+        self.put(key, elf)
+        return elf
+
+    def put(self, key, elf):
+        name = None
+        try:
+            with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=self.directory,
+                                             prefix='.tmp-', delete=False) as cfile:
+                name = cfile.name
+                json.dump(elf.to_entry(), cfile)
+                size = cfile.tell()
+            os.chmod(name, 0o644)
+            os.replace(name, self.path(key))
+            name = None
+        except (OSError, ValueError, TypeError):
+            return
+        finally:
+            if name is not None:
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+        if not self.pruning:
+            return
+        if self.total is None:
+            self.prune()
+            return
+        self.total += size
+        if self.total > self.max_bytes:
+            self.prune()
+
+    def scan(self):
+        """(mtime, size, path) of every entry, and their total size.
+
+        Temporary files of runs that died are removed on the way.
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith('.tmp-'):
+                    if now - st.st_mtime > self.stale_seconds:
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                if not entry.name.endswith('.json'):
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return entries, total
+
+    def prune(self):
+        """Scan the directory and evict the oldest entries if it is past
+        max_bytes; a directory that cannot be listed is left as it is."""
+        try:
+            entries, total = self.scan()
+        except OSError:
+            self.total = None
+            return
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    # another run evicted it first
+                    pass
+                total -= size
+                if total <= self.max_bytes * 3 // 4:
+                    break
+        self.total = total
+
+
+def load_elf(path, quiet=False):
+    """The ElfFile for path, read once; None when it is not a readable ELF file."""
+    if path not in elf_files:
+        try:
+            if symbol_cache is not None:
+                elf_files[path] = symbol_cache.load(path)
+            else:
+                elf_files[path] = ElfFile(path)
+        except (OSError, ValueError, struct.error) as error:
+            if not quiet:
+                print(f"libdeps: cannot read {path}: {error}", file=sys.stderr)
+            elf_files[path] = None
+    return elf_files[path]
+
+
+def read_ld_so_conf(filename, dirs, seen):
+    if filename in seen:
+        return
+    seen.add(filename)
+    try:
+        with open(filename, encoding='utf8') as conf:
+            lines = conf.readlines()
+    except OSError:
+        return
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line.startswith('include'):
+            for pattern in line.split()[1:]:
+                pattern = os.path.join(os.path.dirname(filename), pattern)
+                for included in sorted(glob.glob(pattern)):
+                    read_ld_so_conf(included, dirs, seen)
+        elif line and not line.startswith('hwcap'):
+            dirs.extend(word for word in line.replace(',', ' ').replace(':', ' ').split() if word)
+
+
+def get_system_dirs(elf_class):
+    """The directories of ld.so.conf, which the ld.so.cache is built from,
+    then the trusted system directories."""
+    if elf_class not in system_dirs:
+        dirs = []
+        read_ld_so_conf(LD_SO_CONF, dirs, set())
+        system_dirs[elf_class] = dirs + SYSTEM_DIRS.get(elf_class, [])
+    return system_dirs[elf_class]
+
+
+def get_hwcaps_dirs():
+    """The hwcaps subdirectories this CPU can use, best first."""
+    global hwcaps_dirs
+
+    if hwcaps_dirs is None:
+        flags = set()
+        try:
+            with open('/proc/cpuinfo', encoding='utf8') as cpuinfo:
+                for line in cpuinfo:
+                    if line.startswith('flags'):
+                        flags = set(line.split(':', 1)[1].split())
+                        break
+        except OSError:
+            pass
+        hwcaps_dirs = [subdir for subdir, needs in HWCAPS if needs <= flags]
+    return hwcaps_dirs
+
+
+def expand_path(path, origin, elf_class):
+    lib = 'lib64' if elf_class == 2 else 'lib'
+    for token, value in (('$ORIGIN', origin), ('$LIB', lib)):
+        path = path.replace('${' + token[1:] + '}', value).replace(token, value)
+    return path or '.'
+
+
+def search_dirs(requester, loaders):
+    """The directories ld.so searches for the DT_NEEDED entries of requester:
+    the DT_RPATH of requester and the objects that loaded it up to the
+    binary (unless requester has a DT_RUNPATH), LD_LIBRARY_PATH, the
+    DT_RUNPATH of requester, then the ld.so.conf and system directories.
+    """
+    dirs = []
+    if not requester.runpath:
+        obj = requester
+        while obj is not None:
+            dirs.extend(expand_path(path, os.path.dirname(obj.path), obj.elf_class) for path in obj.rpath)
+            obj = loaders.get(obj.path)
+    for path in os.environ.get('LD_LIBRARY_PATH', '').replace(';', ':').split(':'):
+        if path:
+            dirs.append(path)
+    dirs.extend(expand_path(path, os.path.dirname(requester.path), requester.elf_class)
+                for path in requester.runpath)
+    dirs.extend(get_system_dirs(requester.elf_class))
+    return dirs
+
+
+def find_library(name, requester, loaders):
+    """The path ld.so would load for the DT_NEEDED name of requester, or None."""
+    if '/' in name:
+        candidates = [name]
+    else:
+        subdirs = get_hwcaps_dirs() if requester.machine == EM_X86_64 else []
+        candidates = []
+        for directory in search_dirs(requester, loaders):
+            candidates.extend(os.path.join(directory, subdir, name) for subdir in subdirs)
+            candidates.append(os.path.join(directory, name))
+    for candidate in candidates:
+        if not os.path.isfile(candidate):
+            continue
+        elf = load_elf(candidate, quiet=True)
+        if elf is not None and elf.elf_class == requester.elf_class and elf.machine == requester.machine:
+            return os.path.normpath(candidate)
+    return None
+
+
+def resolve_dependencies(filename):
+    """The binary and the libraries ld.so loads for it, breadth first, as ldd
+    would list them but without running the loader."""
+    binary = load_elf(filename)
+    if binary is None:
+        return []
+    order = [filename]
+    loaders = dict()
+    loaded = {filename: filename}
+    if binary.soname:
+        loaded[binary.soname] = filename
+    for path in order:
+        requester = load_elf(path)
+        for name in requester.needed:
+            if name in loaded:
+                continue
+            found = find_library(name, requester, loaders)
+            if found is None:
+                print(f"libdeps: {name} not found (needed by {path})", file=sys.stderr)
+                loaded[name] = None
+                continue
+            loaded[name] = found
+            if found in order:
+                continue
+            soname = load_elf(found).soname
+            if soname:
+                loaded.setdefault(soname, found)
+            loaders[found] = requester
+            order.append(found)
+    return order
+
+
+def add_provides(lib, function, version=None, hidden=False):
     global libprovides
     
     if not lib in libprovides.keys():
         libprovides[lib] = dict()
-    libprovides[lib][function] = "Yes"
+    if not function in libprovides[lib].keys():
+        libprovides[lib][function] = dict()
+    libprovides[lib][function][version] = hidden
     
-def add_requires(lib, function):
+def add_requires(lib, function, version=None):
     global librequires
     
     if not lib in librequires.keys():
         librequires[lib] = dict()
-    librequires[lib][function] = "Yes"
+    librequires[lib][function] = version
+
+
+def provides_symbol(lib, symbol, version):
+    """Whether ld.so would bind a reference to symbol, needing version, to lib."""
+    versions = libprovides[lib].get(symbol)
+    if versions is None:
+        return False
+    if version is None:
+        return not all(versions.values())
+    return version in versions or None in versions
     
     
 def add_from_to_func(req, prov, func):
@@ -37,48 +561,73 @@ def add_from_to_func(req, prov, func):
     matrix[req][prov].append(func)
 
 def process_library(filename):
-    
-    pipeout = subprocess.check_output(['nm', '-D', filename]).decode("utf-8")
-    
-    lines = pipeout.split('\n')
-    for line in lines:
-        words = line.split()
-
-        if len(words) > 1:        
-            if words[0] == 'U':
-                add_requires(filename, words[1])
-            if words[1] == 'T':
-                add_provides(filename, words[2])
-            if words[1] == 'W':
-                add_provides(filename, words[2])
+    elf = load_elf(filename)
+    if elf is None:
+        return
+
+    for symbol, version in elf.undefined.items():
+        add_requires(filename, symbol, version)
+    for symbol, versions in elf.defined.items():
+        for version, hidden in versions.items():
+            add_provides(filename, symbol, version, hidden)
     
 
 
 def process_binary(filename):
-    process_library(filename)
-    pipeout = subprocess.check_output(['ldd', '-r', filename]).decode("utf-8").replace("\t","")
-    lines = pipeout.split('\n')
-    for line in lines:
-        words = line.split()
-        if len(words) > 2:
-            process_library(words[2])
+    global load_order
 
+    load_order = resolve_dependencies(filename)
+    if not load_order:
+        sys.exit(f"libdeps: cannot read {filename}")
+    for library in load_order:
+        process_library(library)
 
-def create_matrix():
-    for file in librequires.keys():
-        for symbol in librequires[file].keys():
-            for file2 in libprovides.keys():
-                if file2 == '/usr/lib64/ld-linux-x86-64.so.2':
-                    continue
-                if file2 == '/usr/lib64/libc.so.6':
-                    continue
-                if file2 == '/usr/lib64/haswell/libc.so.6':
-                    continue
 
-                if file2 == '/usr/lib64/libpthread.so.0':
-                    continue
-                if file != file2 and symbol in libprovides[file2].keys():
-                    add_from_to_func(file, file2, symbol)
+def build_providers():
+    global providers
+
+    providers = dict()
+    order = [lib for lib in load_order if lib in libprovides]
+    order += [lib for lib in libprovides.keys() if lib not in load_order]
+    for lib in order:
+        for symbol in libprovides[lib].keys():
+            if not symbol in providers:
+                providers[symbol] = list()
+            providers[symbol].append(lib)
+
+
+def resolve_symbol(symbol, version):
+    """The first library in load order that provides symbol at version, as
+    ld.so binds it, or None."""
+    for lib in providers.get(symbol, ()):
+        if provides_symbol(lib, symbol, version):
+            return lib
+    return None
+
+
+def create_matrix(excludes=None):
+    """Add an edge from each library to the libraries its symbols bind to.
+
+    Each required symbol is resolved once through the providers index, the
+    first provider winning; symbols that bind to the library itself or to
+    an excluded provider (by path or file name) add no edge.
+    """
+    if excludes is None:
+        excludes = EXCLUDED_PROVIDERS
+    excludes = set(excludes)
+    build_providers()
+    resolved = dict()
+    for file in librequires.keys():
+        for symbol, version in librequires[file].items():
+            key = (symbol, version)
+            if not key in resolved:
+                resolved[key] = resolve_symbol(symbol, version)
+            file2 = resolved[key]
+            if file2 is None or file2 == file:
+                continue
+            if file2 in excludes or os.path.basename(file2) in excludes:
+                continue
+            add_from_to_func(file, file2, symbol)
 
 def print_matrix(req, level):
     if not req in matrix.keys():
@@ -108,10 +657,108 @@ def print_matrix(req, level):
             visited[prov] = "Yes"
             print_matrix(prov, level + 1)
 
+def analyse_binary(filename, excludes=None):
+    """The printed matrix of filename, from fresh provides and requires.
+
+    Libraries read for earlier binaries in this process are reused.
+    """
+    global libprovides, librequires, matrix, visited
+
+    libprovides = dict()
+    librequires = dict()
+    matrix = dict()
+    visited = dict()
+    if load_elf(filename) is None:
+        raise ValueError("not an ELF file")
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        process_binary(filename)
+        create_matrix(excludes)
+        print_matrix(filename, 0)
+    return output.getvalue()
+
+
+def init_worker(cache_dir, cache_bytes, pruning=True):
+    global symbol_cache
+
+    if cache_dir:
+        symbol_cache = SymbolCache(cache_dir, cache_bytes, pruning)
+
+
+def is_elf_binary(path):
+    try:
+        with open(path, 'rb') as ifile:
+            header = ifile.read(18)
+    except OSError:
+        return False
+    if len(header) < 18 or header[:4] != ELF_MAGIC or header[5] not in (1, 2):
+        return False
+    etype = struct.unpack_from('<H' if header[5] == 1 else '>H', header, 16)[0]
+    return etype in (ET_EXEC, ET_DYN)
+
+
+def find_binaries(targets):
+    """The files in targets, with directories replaced by the ELF
+    executables and shared objects below them."""
+    binaries = []
+    for target in targets:
+        if not os.path.isdir(target):
+            binaries.append(target)
+            continue
+        for root, dirs, files in os.walk(target):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if not os.path.islink(path) and os.path.isfile(path) and is_elf_binary(path):
+                    binaries.append(path)
+    return binaries
+
+
+def do_batch(binaries, excludes, jobs, cache_dir, cache_bytes):
+    """Analyse binaries on a pool of jobs workers, printing each matrix in
+    the given order; returns whether any failed.  The symbol cache is
+    pruned once, after the workers are done."""
+    failed = False
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(jobs, 1), initializer=init_worker,
+                                                initargs=(cache_dir, cache_bytes, False)) as executor:
+        futures = [executor.submit(analyse_binary, binary, excludes) for binary in binaries]
+        for binary, future in zip(binaries, futures):
+            try:
+                sys.stdout.write(future.result())
+            except Exception as e:
+                print("libdeps:", binary + ":", e, file=sys.stderr)
+                failed = True
+            sys.stdout.flush()
+    if symbol_cache is not None:
+        symbol_cache.prune()
+    return failed
+
+
 def main():
-    process_binary(sys.argv[1])
-    create_matrix()
-    print_matrix(sys.argv[1], 0)
+    parser = argparse.ArgumentParser(description='Show which libraries a binary pulls in, and for which symbols')
+    parser.add_argument('binaries', nargs='+', metavar='binary',
+                        help='The binary or library to analyse; with several, or a directory, all of them '
+                        'are analysed in parallel')
+    parser.add_argument('--exclude', '-x', action='append', default=None, metavar='LIB',
+                        help='Leave out a provider, by path or file name (may be repeated; '
+                        'replaces the default ' + ' '.join(EXCLUDED_PROVIDERS) + ')')
+    parser.add_argument('--jobs', '-j', type=int, default=len(os.sched_getaffinity(0)),
+                        help='Number of binaries to analyse in parallel (default: all CPUs)')
+    parser.add_argument('--cache', metavar='DIR', default=os.environ.get('LIBDEPS_CACHE'),
+                        help='Directory of library symbol tables to reuse for identical files '
+                        '(default: $LIBDEPS_CACHE, none if unset)')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='Size limit of the cache directory in MiB (default: 256)')
+    args = parser.parse_args()
+
+    init_worker(args.cache, args.cache_size << 20)
+    if len(args.binaries) == 1 and not os.path.isdir(args.binaries[0]):
+        process_binary(args.binaries[0])
+        create_matrix(args.exclude)
+        print_matrix(args.binaries[0], 0)
+        return
+    if do_batch(find_binaries(args.binaries), args.exclude, args.jobs, args.cache, args.cache_size << 20):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()